@@ -0,0 +1,256 @@
+"""
+Actor por sorteo (opcional, ACTORES_HABILITADOS=true)
+
+Cada sorteo con ventas activas puede tener en este worker un actor: una tarea asyncio
+con un buzón que aplica en orden los eventos del sorteo (ventas aprobadas, rechazos,
+cambios hechos por admins) sobre un estado cacheado, sin releer el documento en cada
+evento. El contador de vendidos se persiste con escritura diferida: los eventos que
+llegan dentro de ESCRITURA_DIFERIDA_SEGUNDOS se suman en un solo $inc. Si una venta
+cruza el umbral activo se persiste de inmediato y se evalúa la transición.
+
+Solo un worker puede tener el actor de un sorteo (lease 'actor_sorteo:<id>' en la
+colección leases). Los demás workers, o cualquier worker con los actores
+deshabilitados, aplican las ventas directamente con un $inc atómico, así ambos
+caminos pueden convivir. El reconciliador de contadores no toca los sorteos con lease
+de actor vigente (sus ventas pueden estar en memoria); si el proceso muere con ventas
+sin persistir, corrige la diferencia cuando el lease vence.
+
+El umbral se evalúa sobre el documento que devuelve el $inc, no sobre el estado
+cacheado, así un cambio hecho en otro worker no hace perder una transición. Las
+transiciones y los cambios de admins de este worker avisan al actor con 'refrescar'.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+import contadores_sorteo
+import liderazgo
+import state_machine
+
+logger = logging.getLogger(__name__)
+
+db = None
+
+ACTORES_HABILITADOS = os.environ.get('ACTORES_HABILITADOS', 'false').lower() == 'true'
+# Ventana para agrupar incrementos del contador en una sola escritura
+ESCRITURA_DIFERIDA_SEGUNDOS = float(os.environ.get('ACTORES_ESCRITURA_DIFERIDA_SEGUNDOS', '0.2'))
+# Un actor sin eventos durante este tiempo se detiene y suelta su lease
+INACTIVIDAD_SEGUNDOS = int(os.environ.get('ACTORES_INACTIVIDAD_SEGUNDOS', '60'))
+PREFIJO_LEASE = 'actor_sorteo:'
+
+
+class ActorSorteo:
+    """Dueño en memoria del estado y el contador de vendidos de un sorteo"""
+
+    def __init__(self, sorteo_id: str, token: int):
+        self.sorteo_id = sorteo_id
+        self.token = token
+        self.buzon: asyncio.Queue = asyncio.Queue()
+        self.estado: Optional[dict] = None
+        self.vendidos_pendientes = 0
+        self.pendiente_desde: Optional[float] = None
+        # Disparador de la última venta pendiente (para la línea de tiempo)
+        self.disparador_pendiente = 'aprobacion'
+        self.tarea: Optional[asyncio.Task] = None
+
+    async def _cargar(self):
+        self.estado = await db.sorteos.find_one(
+            {'id': self.sorteo_id},
+            contadores_sorteo.PROYECCION_CONTADOR
+        )
+
+    async def _persistir(self):
+        """
+        Escribir los vendidos acumulados en un solo $inc, emitir el progreso y evaluar
+        la transición con el documento actualizado
+        """
+        if not self.vendidos_pendientes:
+            return
+        delta = self.vendidos_pendientes
+        disparador = self.disparador_pendiente
+        self.vendidos_pendientes = 0
+        self.pendiente_desde = None
+
+        sorteo = await contadores_sorteo.incrementar_vendidos(self.sorteo_id, delta)
+        if not sorteo:
+            return
+        self.estado = sorteo
+
+        from websocket_manager import emit_sorteo_updated
+        await emit_sorteo_updated(self.sorteo_id, {
+            'sorteo_id': self.sorteo_id,
+            'cantidad_vendida': sorteo.get('cantidad_vendida', 0),
+            'progreso_porcentaje': sorteo.get('progreso_porcentaje', 0)
+        })
+
+        # El estado cacheado puede estar atrasado: decidir con el documento recién escrito
+        if delta > 0 and state_machine.umbral_alcanzado(sorteo):
+            await state_machine.verificar_transicion_estado_nuevo(self.sorteo_id, disparador=disparador)
+
+    async def _aplicar(self, tipo: str, valor, disparador: str):
+        if tipo == 'venta':
+            self.vendidos_pendientes += valor
+            if valor > 0:
+                self.disparador_pendiente = disparador
+            if self.pendiente_desde is None:
+                self.pendiente_desde = time.monotonic()
+            if not self.estado:
+                return
+            self.estado['cantidad_vendida'] = self.estado.get('cantidad_vendida', 0) + valor
+            if valor > 0 and state_machine.umbral_alcanzado(self.estado):
+                # Según el estado cacheado cruzó el umbral: persistir ya (y evaluar)
+                await self._persistir()
+
+        elif tipo == 'refrescar':
+            await self._persistir()
+            await self._cargar()
+
+    async def _renovar_lease(self) -> bool:
+        token = await liderazgo.intentar_adquirir(PREFIJO_LEASE + self.sorteo_id)
+        return token == self.token
+
+    async def ejecutar(self):
+        ultima_actividad = time.monotonic()
+        ultima_renovacion = time.monotonic()
+        try:
+            await self._cargar()
+            while True:
+                espera = liderazgo.LEASE_HEARTBEAT_SEGUNDOS
+                if self.pendiente_desde is not None:
+                    espera = max(0.0, self.pendiente_desde + ESCRITURA_DIFERIDA_SEGUNDOS - time.monotonic())
+
+                try:
+                    tipo, valor, disparador = await asyncio.wait_for(self.buzon.get(), timeout=espera)
+                    ultima_actividad = time.monotonic()
+                    try:
+                        await self._aplicar(tipo, valor, disparador)
+                    except Exception as e:
+                        logger.error(f"Error aplicando evento {tipo} en actor de sorteo {self.sorteo_id}: {e}")
+                except asyncio.TimeoutError:
+                    pass
+
+                ahora = time.monotonic()
+                if self.pendiente_desde is not None and ahora - self.pendiente_desde >= ESCRITURA_DIFERIDA_SEGUNDOS:
+                    await self._persistir()
+
+                if ahora - ultima_renovacion >= liderazgo.LEASE_HEARTBEAT_SEGUNDOS:
+                    ultima_renovacion = ahora
+                    if not await self._renovar_lease():
+                        logger.warning(f"Actor de sorteo {self.sorteo_id} perdió su lease")
+                        break
+
+                if ahora - ultima_actividad >= INACTIVIDAD_SEGUNDOS and self.buzon.empty():
+                    break
+        finally:
+            if _actores.get(self.sorteo_id) is self:
+                del _actores[self.sorteo_id]
+            # Los eventos que quedaron en el buzón se aplican directo
+            while not self.buzon.empty():
+                tipo, valor, _ = self.buzon.get_nowait()
+                if tipo == 'venta':
+                    self.vendidos_pendientes += valor
+            try:
+                await self._persistir()
+                await liderazgo.liberar(PREFIJO_LEASE + self.sorteo_id)
+            except Exception as e:
+                logger.error(f"Error cerrando actor de sorteo {self.sorteo_id}: {e}")
+            logger.info(f"Actor de sorteo {self.sorteo_id} detenido")
+
+
+_actores: Dict[str, ActorSorteo] = {}
+# Reclamos de lease en curso (uno por sorteo; se quitan al terminar)
+_reclamos: Dict[str, asyncio.Future] = {}
+# Sorteos cuyo actor tiene otro worker: no se reintenta reclamarlo hasta este momento
+_tomados_por_otros: Dict[str, float] = {}
+
+def init_actores(database):
+    global db
+    db = database
+
+async def _obtener_actor(sorteo_id: str) -> Optional[ActorSorteo]:
+    """Actor local del sorteo, reclamándolo si nadie lo tiene. None si lo tiene otro worker."""
+    if not ACTORES_HABILITADOS:
+        return None
+
+    actor = _actores.get(sorteo_id)
+    if actor:
+        return actor
+    if _tomados_por_otros.get(sorteo_id, 0) > time.monotonic():
+        return None
+
+    # Las llamadas concurrentes esperan el mismo reclamo en lugar de repetirlo
+    reclamo = _reclamos.get(sorteo_id)
+    if reclamo is None:
+        reclamo = asyncio.ensure_future(_reclamar_actor(sorteo_id))
+        _reclamos[sorteo_id] = reclamo
+        reclamo.add_done_callback(lambda _: _reclamos.pop(sorteo_id, None))
+    return await asyncio.shield(reclamo)
+
+async def _reclamar_actor(sorteo_id: str) -> Optional[ActorSorteo]:
+    ahora = time.monotonic()
+    # Olvidar los sorteos de otros workers cuyo reintento ya venció
+    for otro_id, hasta in list(_tomados_por_otros.items()):
+        if hasta <= ahora:
+            del _tomados_por_otros[otro_id]
+
+    token = await liderazgo.intentar_adquirir(PREFIJO_LEASE + sorteo_id)
+    if token is None:
+        _tomados_por_otros[sorteo_id] = time.monotonic() + liderazgo.LEASE_DURACION_SEGUNDOS
+        return None
+
+    actor = ActorSorteo(sorteo_id, token)
+    _actores[sorteo_id] = actor
+    actor.tarea = asyncio.create_task(actor.ejecutar())
+    logger.info(f"Actor de sorteo {sorteo_id} iniciado (token {token})")
+    return actor
+
+async def aplicar_venta_directa(sorteo_id: str, cantidad: int, disparador: str = 'aprobacion'):
+    """Sumar vendidos con un $inc atómico y evaluar la transición si se cruzó el umbral"""
+    sorteo_contador = await contadores_sorteo.incrementar_vendidos(sorteo_id, cantidad)
+    if cantidad > 0 and sorteo_contador and state_machine.umbral_alcanzado(sorteo_contador):
+        await state_machine.verificar_transicion_estado_nuevo(sorteo_id, disparador=disparador)
+
+async def registrar_venta(sorteo_id: str, cantidad: int, disparador: str = 'aprobacion'):
+    """
+    Registrar boletos aprobados (cantidad negativa para rechazos).
+    Con actor se encola y se persiste en lote; sin actor se aplica directo.
+    disparador ('compra' o 'aprobacion') se registra si la venta provoca una transición.
+    """
+    actor = await _obtener_actor(sorteo_id)
+    if actor:
+        actor.buzon.put_nowait(('venta', cantidad, disparador))
+        return
+    await aplicar_venta_directa(sorteo_id, cantidad, disparador)
+
+def notificar_cambio(sorteo_id: str):
+    """
+    Avisar al actor local (si existe) que el sorteo cambió fuera de él: pausas y
+    ediciones de admins y todas las transiciones de estado de este worker
+    """
+    actor = _actores.get(sorteo_id)
+    if actor:
+        actor.buzon.put_nowait(('refrescar', None, 'admin'))
+
+def obtener_metricas() -> dict:
+    return {
+        'habilitados': ACTORES_HABILITADOS,
+        'actores': {
+            sorteo_id: {
+                'buzon': actor.buzon.qsize(),
+                'vendidos_pendientes': actor.vendidos_pendientes,
+                'cantidad_vendida': (actor.estado or {}).get('cantidad_vendida'),
+                'estado': (actor.estado or {}).get('estado')
+            }
+            for sorteo_id, actor in _actores.items()
+        }
+    }
+
+async def detener_actores():
+    """Persistir lo pendiente y soltar los leases (al apagar el worker)"""
+    tareas = [actor.tarea for actor in list(_actores.values()) if actor.tarea]
+    for tarea in tareas:
+        tarea.cancel()
+    if tareas:
+        await asyncio.gather(*tareas, return_exceptions=True)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark de escritura de una compra: latencia vs tamaño del pedido
+
+Compara la ruta anterior (un insert_one por boleto y por comisión) con la ruta
+en lote (un insert_many para boletos y otro para comisiones).
+Usa una base de datos temporal <DB_NAME>_benchmark que se elimina al terminar.
+
+Uso: python benchmark_compra_boletos.py [repeticiones]
+"""
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+TAMANOS_PEDIDO = [1, 10, 50, 100, 500]
+
+def construir_documentos(sorteo_id: str, cantidad: int):
+    """Boletos y comisiones equivalentes a una compra con vendedor"""
+    vendedor_id = str(uuid.uuid4())
+    usuario_id = str(uuid.uuid4())
+    ahora = datetime.now(timezone.utc).isoformat()
+
+    boletos = []
+    comisiones = []
+    for numero in range(1, cantidad + 1):
+        boleto_id = str(uuid.uuid4())
+        boletos.append({
+            'id': boleto_id,
+            'sorteo_id': sorteo_id,
+            'usuario_id': usuario_id,
+            'vendedor_id': vendedor_id,
+            'numero_boleto': numero,
+            'fecha_compra': ahora,
+            'metodo_pago': 'transferencia',
+            'precio_pagado': 10.0,
+            'estado': 'activo',
+            'etapas_participantes': [],
+            'pago_confirmado': False,
+            'reserva_activa': True
+        })
+        comisiones.append({
+            'id': str(uuid.uuid4()),
+            'vendedor_id': vendedor_id,
+            'sorteo_id': sorteo_id,
+            'boleto_id': boleto_id,
+            'monto': 1.0,
+            'estado': 'pendiente',
+            'fecha': ahora
+        })
+    return boletos, comisiones
+
+async def ruta_individual(db, boletos, comisiones):
+    for boleto, comision in zip(boletos, comisiones):
+        await db.boletos.insert_one(boleto)
+        await db.comisiones.insert_one(comision)
+
+async def ruta_en_lote(db, boletos, comisiones):
+    await db.boletos.insert_many(boletos, ordered=False)
+    await db.comisiones.insert_many(comisiones, ordered=False)
+
+async def medir(db, ruta, cantidad: int, repeticiones: int) -> float:
+    """Latencia promedio en milisegundos de una compra de 'cantidad' boletos"""
+    tiempos = []
+    for _ in range(repeticiones):
+        boletos, comisiones = construir_documentos(str(uuid.uuid4()), cantidad)
+        inicio = time.perf_counter()
+        await ruta(db, boletos, comisiones)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return sum(tiempos) / len(tiempos)
+
+async def main(repeticiones: int):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    nombre_db = f"{os.environ['DB_NAME']}_benchmark"
+    db = client[nombre_db]
+
+    print(f"📊 Benchmark de compra ({repeticiones} repeticiones por tamaño) en {nombre_db}")
+    print("=" * 60)
+    print(f"{'boletos':>8} | {'individual (ms)':>16} | {'en lote (ms)':>13} | {'mejora':>7}")
+    print("-" * 60)
+
+    try:
+        for cantidad in TAMANOS_PEDIDO:
+            individual = await medir(db, ruta_individual, cantidad, repeticiones)
+            en_lote = await medir(db, ruta_en_lote, cantidad, repeticiones)
+            mejora = individual / en_lote if en_lote > 0 else 0
+            print(f"{cantidad:>8} | {individual:>16.2f} | {en_lote:>13.2f} | {mejora:>6.1f}x")
+    finally:
+        await client.drop_database(nombre_db)
+        client.close()
+
+    print("=" * 60)
+
+if __name__ == "__main__":
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    asyncio.run(main(repeticiones))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Benchmark de tráfico de Socket.IO: JSON vs codificación compacta
+
+Arma los eventos que recibe un espectador durante un WAITING de 5 minutos y un
+sorteo LIVE (2 minutos por premio) y mide, para cada formato:
+- bytes en el cable por espectador: paquete Socket.IO codificado con python-socketio,
+  prefijo de Engine.IO y cabecera de frame WebSocket (los adjuntos binarios van en
+  un frame aparte)
+- egreso total para N espectadores
+- CPU de serialización por emit (el servidor codifica una vez por room)
+
+No necesita Mongo ni servidor. Uso:
+    python benchmark_eventos_socketio.py [--espectadores 10000] [--participantes 5000] [--premios 3]
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+import time
+import uuid
+
+from socketio import packet
+
+import codificacion_compacta
+
+DURACION_POR_PREMIO = 120
+DURACION_WAITING = 300
+HORA_SYNC_SEGUNDOS = 30
+
+def _cabecera_websocket(longitud: int) -> int:
+    """Cabecera de un frame servidor → cliente (sin máscara)"""
+    if longitud < 126:
+        return 2
+    if longitud < 65536:
+        return 4
+    return 10
+
+def bytes_en_cable(evento: str, datos) -> int:
+    codificado = packet.Packet(packet.EVENT, data=[evento, datos], namespace='/').encode()
+    partes = codificado if isinstance(codificado, list) else [codificado]
+    total = 0
+    for parte in partes:
+        # Texto: paquete MESSAGE de Engine.IO ('4' + paquete); binario: frame crudo
+        carga = ('4' + parte).encode('utf-8') if isinstance(parte, str) else parte
+        total += len(carga) + _cabecera_websocket(len(carga))
+    return total
+
+def construir_eventos(participantes: int, premios: int):
+    """[(fase, evento, datos, es_periodico)] en el orden en que los recibe un espectador"""
+    sorteo_id = str(uuid.uuid4())
+    inicio = datetime(2026, 1, 1, 20, 0, 0, 123456, tzinfo=timezone.utc)
+    waiting_hasta = inicio + timedelta(seconds=DURACION_WAITING)
+    eventos = []
+
+    eventos.append(('waiting', 'waiting_countdown_update', {
+        'sorteo_id': sorteo_id,
+        'waiting_hasta': waiting_hasta.isoformat(),
+        'server_time': inicio.isoformat(),
+        'tiempo_restante': DURACION_WAITING,
+        'etapa_actual': 1,
+        'tipo': 'etapas'
+    }, True))
+    for segundo in range(HORA_SYNC_SEGUNDOS, DURACION_WAITING, HORA_SYNC_SEGUNDOS):
+        eventos.append(('waiting', 'hora_servidor', {
+            'sorteo_id': sorteo_id,
+            'server_time': (inicio + timedelta(seconds=segundo)).isoformat()
+        }, True))
+
+    fecha_live = waiting_hasta
+    eventos.append(('live', 'live_animation_start', {
+        'sorteo_id': sorteo_id,
+        'participantes': [
+            {'nombre': f"Participante {n}", 'email': f"participante{n}@correo.test", 'numero_boleto': n}
+            for n in range(1, participantes + 1)
+        ],
+        'num_premios': premios,
+        'timestamp': fecha_live.isoformat()
+    }, True))
+    for idx in range(premios):
+        premio_nombre = f"Premio {idx + 1}"
+        inicio_premio = fecha_live + timedelta(seconds=idx * DURACION_POR_PREMIO)
+        eventos.append(('live', 'live_prize_drawing', {
+            'premio_index': idx,
+            'premio_nombre': premio_nombre,
+            'duracion_segundos': DURACION_POR_PREMIO,
+            'total_premios': premios,
+            'timestamp': inicio_premio.isoformat(),
+            'tiempo_restante': DURACION_POR_PREMIO
+        }, False))
+        for avance in range(DURACION_POR_PREMIO):
+            eventos.append(('live', 'live_time_update', {
+                'premio_index': idx,
+                'premio_nombre': premio_nombre,
+                'tiempo_restante': DURACION_POR_PREMIO - avance,
+                'total_premios': premios,
+                'timestamp': (inicio_premio + timedelta(seconds=avance, microseconds=1500)).isoformat()
+            }, True))
+        eventos.append(('live', 'live_winner_announced', {
+            'premio_index': idx,
+            'premio_nombre': premio_nombre,
+            'ganador': {
+                'boleto_id': str(uuid.uuid4()),
+                'usuario_id': str(uuid.uuid4()),
+                'numero_boleto': idx + 1,
+                'nombre': f"Participante {idx + 1}",
+                'email': f"participante{idx + 1}@correo.test",
+                'premio': premio_nombre
+            },
+            'timestamp': (inicio_premio + timedelta(seconds=DURACION_POR_PREMIO)).isoformat()
+        }, False))
+    return sorteo_id, eventos
+
+def medir(sorteo_id: str, eventos, compacto: bool):
+    """Bytes por espectador y segundos de CPU de serialización, por evento"""
+    bytes_por_evento = {}
+    cpu_por_evento = {}
+    for _, evento, datos, es_periodico in eventos:
+        inicio = time.perf_counter()
+        if compacto and es_periodico:
+            nombre = codificacion_compacta.EVENTO_COMPACTO
+            carga = codificacion_compacta.codificar(evento, sorteo_id, datos)
+        else:
+            nombre, carga = evento, datos
+        n_bytes = bytes_en_cable(nombre, carga)
+        cpu_por_evento[evento] = cpu_por_evento.get(evento, 0.0) + time.perf_counter() - inicio
+        bytes_por_evento[evento] = bytes_por_evento.get(evento, 0) + n_bytes
+    return bytes_por_evento, cpu_por_evento
+
+def _mb(n_bytes: float) -> str:
+    return f"{n_bytes / (1024 * 1024):,.1f} MB"
+
+def main():
+    parser = argparse.ArgumentParser(description="Tráfico de Socket.IO de un sorteo: JSON vs compacto")
+    parser.add_argument('--espectadores', type=int, default=10000)
+    parser.add_argument('--participantes', type=int, default=5000)
+    parser.add_argument('--premios', type=int, default=3)
+    args = parser.parse_args()
+
+    sorteo_id, eventos = construir_eventos(args.participantes, args.premios)
+    conteos = {}
+    for _, evento, _, _ in eventos:
+        conteos[evento] = conteos.get(evento, 0) + 1
+
+    bytes_json, cpu_json = medir(sorteo_id, eventos, compacto=False)
+    bytes_compacto, cpu_compacto = medir(sorteo_id, eventos, compacto=True)
+
+    print(f"📊 Sorteo LIVE con {args.premios} premio(s), {args.participantes} participantes, "
+          f"{args.espectadores} espectadores")
+    print("=" * 96)
+    print(f"{'evento':<28} | {'n':>5} | {'JSON B/esp.':>12} | {'compacto B/esp.':>15} | {'ahorro':>7} | "
+          f"{'CPU JSON':>9} | {'CPU comp.':>9}")
+    for evento, n in conteos.items():
+        ahorro = 1 - bytes_compacto[evento] / bytes_json[evento]
+        print(f"{evento:<28} | {n:>5} | {bytes_json[evento]:>12,} | {bytes_compacto[evento]:>15,} | "
+              f"{ahorro:>6.1%} | {cpu_json[evento] * 1000:>7.2f}ms | {cpu_compacto[evento] * 1000:>7.2f}ms")
+    print("-" * 96)
+
+    total_json = sum(bytes_json.values())
+    total_compacto = sum(bytes_compacto.values())
+    print(f"Por espectador: JSON {total_json:,} B  compacto {total_compacto:,} B  "
+          f"(ahorro {1 - total_compacto / total_json:.1%})")
+    print(f"Egreso total ({args.espectadores} espectadores): JSON {_mb(total_json * args.espectadores)}  "
+          f"compacto {_mb(total_compacto * args.espectadores)}")
+    print(f"CPU de serialización (una vez por room): JSON {sum(cpu_json.values()) * 1000:.1f} ms  "
+          f"compacto {sum(cpu_compacto.values()) * 1000:.1f} ms")
+    print("=" * 96)
+
+if __name__ == "__main__":
+    main()
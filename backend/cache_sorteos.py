@@ -0,0 +1,176 @@
+"""
+Caché en proceso de sorteos ya validados (modelo Sorteo)
+
+Evita releer y revalidar con Sorteo(**doc) el mismo sorteo varias veces por request.
+Las entradas se indexan por id y por landing_slug, con tamaño máximo y desalojo LRU.
+
+Cada escritura sobre un sorteo aumenta su campo 'version'. Una entrada se usa sin
+consultar durante FRESCURA_SEGUNDOS; después (o con verificar=True) se compara su
+versión con una consulta mínima y solo se recarga el documento completo si cambió.
+Los writers de este worker invalidan la entrada explícitamente (invalidar).
+
+El contador de vendidos cambia con cada venta sin aumentar la versión (así las ventas
+no invalidan el compare-and-set de las transiciones): la consulta de versión trae
+también los contadores y los actualiza en la entrada.
+"""
+from collections import Counter, OrderedDict
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Optional
+
+import reloj
+
+logger = logging.getLogger(__name__)
+
+db = None
+Sorteo = None
+
+CACHE_SORTEOS_HABILITADO = os.environ.get('CACHE_SORTEOS_HABILITADO', 'true').lower() == 'true'
+CACHE_SORTEOS_MAX = int(os.environ.get('CACHE_SORTEOS_MAX', '500'))
+# Tiempo durante el cual una entrada se usa sin comprobar su versión
+FRESCURA_SEGUNDOS = float(os.environ.get('CACHE_SORTEOS_FRESCURA_SEGUNDOS', '1'))
+
+# Campos que cambian sin aumentar la versión; se refrescan al comprobarla
+CAMPOS_CONTADOR = ('cantidad_vendida', 'progreso_porcentaje')
+PROYECCION_VERSION = {"_id": 0, "version": 1, **{campo: 1 for campo in CAMPOS_CONTADOR}}
+
+
+class EntradaSorteo:
+    def __init__(self, sorteo, version: int):
+        self.sorteo = sorteo
+        self.version = version
+        self.verificada_en = reloj.monotonic()
+
+
+_entradas: "OrderedDict[str, EntradaSorteo]" = OrderedDict()
+_ids_por_slug: Dict[str, str] = {}
+_metricas = Counter()
+
+def init_cache(database, sorteo_model):
+    global db, Sorteo
+    db = database
+    Sorteo = sorteo_model
+
+def normalizar_documento(sorteo_doc: dict) -> dict:
+    """Convertir fechas guardadas como texto (y compatibilidad con sorteos antiguos)"""
+    if sorteo_doc.get('fecha_cierre') and isinstance(sorteo_doc['fecha_cierre'], str):
+        sorteo_doc['fecha_cierre'] = datetime.fromisoformat(sorteo_doc['fecha_cierre'])
+    if sorteo_doc.get('created_at') and isinstance(sorteo_doc['created_at'], str):
+        sorteo_doc['created_at'] = datetime.fromisoformat(sorteo_doc['created_at'])
+
+    # Compatibilidad: si existe fecha_inicio pero no fecha_cierre, usar fecha_inicio
+    if sorteo_doc.get('fecha_inicio') and not sorteo_doc.get('fecha_cierre'):
+        if isinstance(sorteo_doc['fecha_inicio'], str):
+            sorteo_doc['fecha_cierre'] = datetime.fromisoformat(sorteo_doc['fecha_inicio'])
+        else:
+            sorteo_doc['fecha_cierre'] = sorteo_doc['fecha_inicio']
+
+    for etapa in sorteo_doc.get('etapas', []):
+        if etapa.get('fecha_sorteo') and isinstance(etapa['fecha_sorteo'], str):
+            etapa['fecha_sorteo'] = datetime.fromisoformat(etapa['fecha_sorteo'])
+    return sorteo_doc
+
+def _guardar(sorteo) -> None:
+    anterior = _entradas.pop(sorteo.id, None)
+    if anterior and anterior.sorteo.landing_slug != sorteo.landing_slug:
+        _ids_por_slug.pop(anterior.sorteo.landing_slug, None)
+
+    _entradas[sorteo.id] = EntradaSorteo(sorteo, sorteo.version)
+    _ids_por_slug[sorteo.landing_slug] = sorteo.id
+    while len(_entradas) > CACHE_SORTEOS_MAX:
+        _, desalojada = _entradas.popitem(last=False)
+        _ids_por_slug.pop(desalojada.sorteo.landing_slug, None)
+        _metricas['desalojos'] += 1
+
+async def _cargar(filtro: dict):
+    _metricas['fallos'] += 1
+    sorteo_doc = await db.sorteos.find_one(filtro, {"_id": 0})
+    if not sorteo_doc:
+        return None
+    sorteo = Sorteo(**normalizar_documento(sorteo_doc))
+    if CACHE_SORTEOS_HABILITADO:
+        _guardar(sorteo)
+    return sorteo.model_copy()
+
+async def _vigente(entrada: EntradaSorteo, verificar: bool):
+    """La entrada si sigue vigente (comprobando la versión si hace falta), o None"""
+    if not verificar and reloj.monotonic() - entrada.verificada_en < FRESCURA_SEGUNDOS:
+        return entrada
+
+    _metricas['verificaciones'] += 1
+    actual = await db.sorteos.find_one({'id': entrada.sorteo.id}, PROYECCION_VERSION)
+    if not actual or (actual.get('version') or 0) != entrada.version:
+        invalidar(entrada.sorteo.id)
+        return None
+
+    contadores = {campo: actual[campo] for campo in CAMPOS_CONTADOR if campo in actual}
+    if contadores:
+        entrada.sorteo = entrada.sorteo.model_copy(update=contadores)
+    entrada.verificada_en = reloj.monotonic()
+    return entrada
+
+async def _obtener_entrada(sorteo_id: str, verificar: bool):
+    entrada = _entradas.get(sorteo_id)
+    if not entrada:
+        return None
+    entrada = await _vigente(entrada, verificar)
+    if not entrada:
+        return None
+    _entradas.move_to_end(sorteo_id)
+    _metricas['aciertos'] += 1
+    # Copia superficial: reasignar campos no afecta la caché (no mutar listas anidadas)
+    return entrada.sorteo.model_copy()
+
+async def obtener(sorteo_id: str, verificar: bool = False):
+    """
+    Sorteo por id, o None si no existe.
+    verificar=True compara la versión con Mongo aunque la entrada sea reciente
+    (para decisiones que escriben: compras, aprobaciones, transiciones).
+    """
+    if CACHE_SORTEOS_HABILITADO:
+        sorteo = await _obtener_entrada(sorteo_id, verificar)
+        if sorteo:
+            return sorteo
+    return await _cargar({'id': sorteo_id})
+
+async def obtener_por_slug(slug: str, verificar: bool = False):
+    """Sorteo por landing_slug, o None si no existe"""
+    sorteo_id = _ids_por_slug.get(slug) if CACHE_SORTEOS_HABILITADO else None
+    if sorteo_id:
+        sorteo = await _obtener_entrada(sorteo_id, verificar)
+        if sorteo and sorteo.landing_slug == slug:
+            return sorteo
+    return await _cargar({'landing_slug': slug})
+
+def invalidar(sorteo_id: str):
+    """Descartar la entrada de un sorteo después de escribirlo"""
+    entrada = _entradas.pop(sorteo_id, None)
+    if entrada:
+        if _ids_por_slug.get(entrada.sorteo.landing_slug) == sorteo_id:
+            del _ids_por_slug[entrada.sorteo.landing_slug]
+        _metricas['invalidaciones'] += 1
+
+def actualizar_contadores(sorteo_id: str, sorteo_contador: Optional[dict]):
+    """Aplicar a la entrada los contadores devueltos por una venta de este worker"""
+    entrada = _entradas.get(sorteo_id)
+    if not entrada or not sorteo_contador:
+        return
+    contadores = {campo: sorteo_contador[campo] for campo in CAMPOS_CONTADOR if campo in sorteo_contador}
+    if contadores:
+        entrada.sorteo = entrada.sorteo.model_copy(update=contadores)
+
+def obtener_metricas() -> dict:
+    consultas = _metricas['aciertos'] + _metricas['fallos']
+    return {
+        'habilitada': CACHE_SORTEOS_HABILITADO,
+        'entradas': len(_entradas),
+        'max_entradas': CACHE_SORTEOS_MAX,
+        'frescura_segundos': FRESCURA_SEGUNDOS,
+        'aciertos': _metricas['aciertos'],
+        'fallos': _metricas['fallos'],
+        'tasa_aciertos': round(_metricas['aciertos'] / consultas, 3) if consultas else 0.0,
+        'verificaciones_version': _metricas['verificaciones'],
+        'invalidaciones': _metricas['invalidaciones'],
+        'desalojos': _metricas['desalojos']
+    }
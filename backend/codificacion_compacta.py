@@ -0,0 +1,140 @@
+"""
+Codificación compacta (binaria) de los eventos periódicos de Socket.IO
+
+Los clientes que la piden (evento formato_compacto) reciben live_time_update,
+waiting_countdown_update, hora_servidor y live_animation_start como un único evento
+'c' con un blob MessagePack en lugar del dict JSON:
+
+    [codigo_evento, codigo_sorteo, campo1, campo2, ...]
+
+- codigo_evento: ver EVENTOS_COMPACTOS (el orden de los campos es fijo por evento)
+- codigo_sorteo: entero de 32 bits estable entre workers (codigo_sorteo()), devuelto
+  al cliente al activar el formato; reemplaza el uuid de 36 caracteres
+- fechas ISO → milisegundos desde epoch
+- se omiten los campos repetidos que el cliente ya tiene (premio_nombre llega en
+  live_prize_drawing)
+- participantes en columnas: [nombres, emails, numeros_boleto]
+
+empaquetar() implementa el subconjunto de MessagePack que usan estos eventos (nil,
+bool, enteros, float, str, bin, array y map), así que el cliente puede decodificar
+con cualquier librería MessagePack sin agregar dependencias al backend.
+"""
+from datetime import datetime
+from functools import lru_cache
+import hashlib
+import struct
+from typing import Dict, Tuple
+
+# Nombre del evento Socket.IO que transporta los blobs compactos
+EVENTO_COMPACTO = 'c'
+
+EVENTOS_COMPACTOS: Dict[str, Tuple[int, Tuple[str, ...]]] = {
+    'live_time_update': (1, ('premio_index', 'tiempo_restante', 'total_premios', 'timestamp')),
+    'waiting_countdown_update': (2, ('waiting_hasta', 'server_time', 'etapa_actual', 'tipo')),
+    'hora_servidor': (3, ('server_time',)),
+    'live_animation_start': (4, ('num_premios', 'timestamp', 'participantes')),
+}
+CAMPOS_FECHA = {'timestamp', 'waiting_hasta', 'server_time'}
+
+
+@lru_cache(maxsize=4096)
+def codigo_sorteo(sorteo_id: str) -> int:
+    """Código corto del sorteo (igual en todos los workers)"""
+    return int.from_bytes(hashlib.blake2b(sorteo_id.encode(), digest_size=4).digest(), 'big')
+
+def _epoch_ms(fecha) -> int:
+    if isinstance(fecha, str):
+        fecha = datetime.fromisoformat(fecha.replace('Z', '+00:00'))
+    return int(fecha.timestamp() * 1000)
+
+def _participantes_en_columnas(participantes: list) -> list:
+    return [
+        [p.get('nombre', '') for p in participantes],
+        [p.get('email', '') for p in participantes],
+        [p.get('numero_boleto', 0) for p in participantes]
+    ]
+
+def codificar(evento: str, sorteo_id: str, datos: dict) -> bytes:
+    """Blob compacto de un evento periódico (ver EVENTOS_COMPACTOS)"""
+    codigo, campos = EVENTOS_COMPACTOS[evento]
+    valores = [codigo, codigo_sorteo(sorteo_id)]
+    for campo in campos:
+        valor = datos.get(campo)
+        if valor is not None and campo in CAMPOS_FECHA:
+            valor = _epoch_ms(valor)
+        elif campo == 'participantes':
+            valor = _participantes_en_columnas(valor or [])
+        valores.append(getattr(valor, 'value', valor))
+    return empaquetar(valores)
+
+# ==================== MESSAGEPACK ====================
+
+def empaquetar(valor) -> bytes:
+    """Serializar a MessagePack (subconjunto: nil, bool, int, float, str, bin, array, map)"""
+    partes = []
+    _empaquetar(valor, partes)
+    return b''.join(partes)
+
+def _longitud(partes: list, n: int, corto: int, limite_corto: int, codigos: Tuple[int, int, int]):
+    """Cabecera de str/array/map: forma fija si cabe, si no 8/16/32 bits"""
+    if n < limite_corto:
+        partes.append(bytes([corto | n]))
+    elif codigos[0] and n <= 0xff:
+        partes.append(struct.pack('>BB', codigos[0], n))
+    elif n <= 0xffff:
+        partes.append(struct.pack('>BH', codigos[1], n))
+    else:
+        partes.append(struct.pack('>BI', codigos[2], n))
+
+def _empaquetar(valor, partes: list):
+    if valor is None:
+        partes.append(b'\xc0')
+    elif valor is True:
+        partes.append(b'\xc3')
+    elif valor is False:
+        partes.append(b'\xc2')
+    elif isinstance(valor, int):
+        if 0 <= valor < 0x80 or -32 <= valor < 0:
+            partes.append(struct.pack('>b' if valor < 0 else '>B', valor))
+        elif valor >= 0:
+            for codigo, formato, limite in ((0xcc, '>B', 0xff), (0xcd, '>H', 0xffff),
+                                            (0xce, '>I', 0xffffffff), (0xcf, '>Q', 0xffffffffffffffff)):
+                if valor <= limite:
+                    partes.append(bytes([codigo]) + struct.pack(formato, valor))
+                    return
+            raise OverflowError(f"Entero fuera de rango para MessagePack: {valor}")
+        else:
+            for codigo, formato, limite in ((0xd0, '>b', -0x80), (0xd1, '>h', -0x8000),
+                                            (0xd2, '>i', -0x80000000), (0xd3, '>q', -0x8000000000000000)):
+                if valor >= limite:
+                    partes.append(bytes([codigo]) + struct.pack(formato, valor))
+                    return
+            raise OverflowError(f"Entero fuera de rango para MessagePack: {valor}")
+    elif isinstance(valor, float):
+        partes.append(b'\xcb' + struct.pack('>d', valor))
+    elif isinstance(valor, str):
+        datos = valor.encode('utf-8')
+        _longitud(partes, len(datos), 0xa0, 32, (0xd9, 0xda, 0xdb))
+        partes.append(datos)
+    elif isinstance(valor, (bytes, bytearray)):
+        n = len(valor)
+        if n <= 0xff:
+            partes.append(struct.pack('>BB', 0xc4, n))
+        elif n <= 0xffff:
+            partes.append(struct.pack('>BH', 0xc5, n))
+        else:
+            partes.append(struct.pack('>BI', 0xc6, n))
+        partes.append(bytes(valor))
+    elif isinstance(valor, (list, tuple)):
+        _longitud(partes, len(valor), 0x90, 16, (0, 0xdc, 0xdd))
+        for elemento in valor:
+            _empaquetar(elemento, partes)
+    elif isinstance(valor, dict):
+        _longitud(partes, len(valor), 0x80, 16, (0, 0xde, 0xdf))
+        for clave, elemento in valor.items():
+            _empaquetar(clave, partes)
+            _empaquetar(elemento, partes)
+    elif isinstance(valor, datetime):
+        _empaquetar(_epoch_ms(valor), partes)
+    else:
+        raise TypeError(f"Tipo no soportado en MessagePack: {type(valor).__name__}")
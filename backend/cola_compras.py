@@ -0,0 +1,184 @@
+"""
+Cola de admisión de compras por sorteo (opcional)
+
+Cuando se activa (COLA_COMPRAS_HABILITADA=true), las compras de un mismo sorteo pasan
+por una etapa de admisión antes de tocar Mongo:
+- se limita cuántas compras del sorteo se procesan a la vez
+- si otra compra en cola o en proceso tiene alguno de los números pedidos, la compra
+  que llega después espera a que esa termine y vuelve a revisar: si la primera falló
+  el número sigue libre, y si se concretó lo rechaza la reserva en Mongo.
+  Solo se responde el conflicto en memoria si la espera supera COLA_COMPRAS_ESPERA_CONFLICTO_SEGUNDOS
+- si la cola supera la profundidad máxima se responde 429 con Retry-After
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+COLA_COMPRAS_HABILITADA = os.environ.get('COLA_COMPRAS_HABILITADA', 'false').lower() == 'true'
+# Compras en cola + en proceso permitidas por sorteo antes de responder 429
+COLA_COMPRAS_MAX_PROFUNDIDAD = int(os.environ.get('COLA_COMPRAS_MAX_PROFUNDIDAD', '200'))
+# Compras del mismo sorteo procesadas en paralelo (1 = serializadas)
+COLA_COMPRAS_CONCURRENCIA = int(os.environ.get('COLA_COMPRAS_CONCURRENCIA', '1'))
+# Espera máxima a que terminen las compras que tienen alguno de los números pedidos
+COLA_COMPRAS_ESPERA_CONFLICTO_SEGUNDOS = float(os.environ.get('COLA_COMPRAS_ESPERA_CONFLICTO_SEGUNDOS', '30'))
+
+# Cantidad de tiempos de espera recientes usados para las métricas
+MUESTRAS_ESPERA = 1000
+
+
+class ColaSorteo:
+    """Estado de admisión de un sorteo"""
+
+    def __init__(self):
+        self.semaforo = asyncio.Semaphore(COLA_COMPRAS_CONCURRENCIA)
+        self.profundidad = 0
+        self.profundidad_maxima = 0
+        # numero -> compra que lo tiene en cola o en proceso
+        self.numeros_en_proceso: Dict[int, str] = {}
+        # compra -> evento que se activa cuando termina (éxito o error)
+        self.terminadas: Dict[str, asyncio.Event] = {}
+
+
+_colas: Dict[str, ColaSorteo] = {}
+
+# Métricas globales
+_metricas = {
+    'admitidas': 0,
+    'rechazadas_cola_llena': 0,
+    'esperas_por_conflicto': 0,
+    'conflictos_en_memoria': 0
+}
+_esperas_ms = deque(maxlen=MUESTRAS_ESPERA)
+_servicio_ms = deque(maxlen=MUESTRAS_ESPERA)
+
+def _segundos_reintento(cola: ColaSorteo) -> int:
+    """Estimar cuándo reintentar según el tiempo de servicio reciente y la profundidad"""
+    if not _servicio_ms:
+        return 1
+    servicio_promedio = sum(_servicio_ms) / len(_servicio_ms) / 1000
+    return max(1, int(servicio_promedio * cola.profundidad / COLA_COMPRAS_CONCURRENCIA) + 1)
+
+async def _esperar_numeros(cola: ColaSorteo, numeros: List[int]) -> List[int]:
+    """
+    Esperar a que terminen las compras que tienen alguno de los números.
+    Retorna los números que siguen tomados si se agotó la espera (vacía si quedaron libres).
+    """
+    limite = time.monotonic() + COLA_COMPRAS_ESPERA_CONFLICTO_SEGUNDOS
+    espero = False
+    while True:
+        compras = {cola.numeros_en_proceso[n] for n in numeros if n in cola.numeros_en_proceso}
+        if not compras:
+            return []
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            return sorted({n for n in numeros if n in cola.numeros_en_proceso})
+        if not espero:
+            espero = True
+            _metricas['esperas_por_conflicto'] += 1
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(cola.terminadas[compra_id].wait() for compra_id in compras)),
+                restante
+            )
+        except asyncio.TimeoutError:
+            pass
+
+@asynccontextmanager
+async def admitir_compra(sorteo_id: str, numeros: List[int]):
+    """
+    Admitir una compra del sorteo. Entrega la lista de números que otra compra en curso
+    no soltó dentro de la espera máxima (vacía si la compra puede continuar).
+    Si la cola está deshabilitada no hace nada.
+    """
+    if not COLA_COMPRAS_HABILITADA:
+        yield []
+        return
+
+    cola = _colas.setdefault(sorteo_id, ColaSorteo())
+
+    if cola.profundidad >= COLA_COMPRAS_MAX_PROFUNDIDAD:
+        _metricas['rechazadas_cola_llena'] += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Hay demasiadas compras en proceso para este sorteo. Intenta nuevamente en unos segundos",
+            headers={'Retry-After': str(_segundos_reintento(cola))}
+        )
+
+    compra_id = str(uuid.uuid4())
+    cola.profundidad += 1
+    cola.profundidad_maxima = max(cola.profundidad_maxima, cola.profundidad)
+    llegada = time.monotonic()
+
+    try:
+        conflictos = await _esperar_numeros(cola, numeros)
+        if conflictos:
+            _metricas['conflictos_en_memoria'] += 1
+            yield conflictos
+            return
+
+        # Sin await entre la revisión y el registro: otra compra que esperaba lo verá tomado
+        for numero in numeros:
+            cola.numeros_en_proceso[numero] = compra_id
+        cola.terminadas[compra_id] = asyncio.Event()
+
+        async with cola.semaforo:
+            inicio = time.monotonic()
+            _esperas_ms.append((inicio - llegada) * 1000)
+            _metricas['admitidas'] += 1
+            try:
+                yield []
+            finally:
+                _servicio_ms.append((time.monotonic() - inicio) * 1000)
+    finally:
+        cola.profundidad -= 1
+        for numero in numeros:
+            if cola.numeros_en_proceso.get(numero) == compra_id:
+                del cola.numeros_en_proceso[numero]
+        terminada = cola.terminadas.pop(compra_id, None)
+        if terminada:
+            terminada.set()
+        if cola.profundidad == 0 and not cola.numeros_en_proceso:
+            _colas.pop(sorteo_id, None)
+
+def _percentil(valores, percentil: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(len(ordenados) * percentil))
+    return round(ordenados[indice], 2)
+
+def obtener_metricas() -> dict:
+    """Profundidad de cola por sorteo y tiempos de espera recientes"""
+    return {
+        'habilitada': COLA_COMPRAS_HABILITADA,
+        'max_profundidad': COLA_COMPRAS_MAX_PROFUNDIDAD,
+        'concurrencia_por_sorteo': COLA_COMPRAS_CONCURRENCIA,
+        **_metricas,
+        'espera_ms': {
+            'promedio': round(sum(_esperas_ms) / len(_esperas_ms), 2) if _esperas_ms else 0.0,
+            'p50': _percentil(_esperas_ms, 0.50),
+            'p95': _percentil(_esperas_ms, 0.95),
+            'p99': _percentil(_esperas_ms, 0.99)
+        },
+        'servicio_ms': {
+            'promedio': round(sum(_servicio_ms) / len(_servicio_ms), 2) if _servicio_ms else 0.0,
+            'p95': _percentil(_servicio_ms, 0.95)
+        },
+        'colas': {
+            sorteo_id: {
+                'profundidad': cola.profundidad,
+                'profundidad_maxima': cola.profundidad_maxima,
+                'numeros_en_proceso': len(cola.numeros_en_proceso)
+            }
+            for sorteo_id, cola in _colas.items()
+        }
+    }
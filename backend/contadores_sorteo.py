@@ -0,0 +1,149 @@
+"""
+Contadores de boletos vendidos por sorteo
+
+'cantidad_vendida' se mantiene con incrementos atómicos en cada aprobación, compra
+confirmada o rechazo de un boleto aprobado, y es el valor que usa la máquina de estados.
+Un reconciliador periódico recalcula los conteos reales con una sola agregación,
+corrige las diferencias y las reporta. Los sorteos con actor (actores_sorteo) se saltan
+mientras su lease esté vigente: el actor puede tener ventas sin persistir que el
+conteo real ya incluye, y sumarlas después de corregir las contaría dos veces.
+"""
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+from pymongo import ReturnDocument
+
+import cache_sorteos
+import liderazgo
+
+logger = logging.getLogger(__name__)
+
+db = None
+
+# Cada cuánto se reconcilian los contadores con la colección boletos
+RECONCILIACION_SEGUNDOS = int(os.environ.get('CONTADORES_RECONCILIACION_SEGUNDOS', '600'))
+
+# Campos que devuelve incrementar_vendidos (suficientes para decidir transiciones)
+PROYECCION_CONTADOR = {
+    "_id": 0,
+    "id": 1,
+    "estado": 1,
+    "tipo": 1,
+    "cantidad_vendida": 1,
+    "cantidad_total_boletos": 1,
+    "progreso_porcentaje": 1,
+    "etapa_actual": 1,
+    "umbrales_etapas": 1,
+    "etapas.porcentaje": 1,
+    "ventas_pausadas": 1
+}
+
+def init_contadores(database):
+    global db
+    db = database
+
+def _pipeline_progreso(cantidad_vendida) -> list:
+    """Actualización (pipeline) que fija cantidad_vendida y recalcula progreso en la misma escritura"""
+    return [
+        {'$set': {'cantidad_vendida': {'$max': [0, cantidad_vendida]}}},
+        {'$set': {'progreso_porcentaje': {'$cond': [
+            {'$gt': ['$cantidad_total_boletos', 0]},
+            {'$multiply': [{'$divide': ['$cantidad_vendida', '$cantidad_total_boletos']}, 100]},
+            0
+        ]}}}
+    ]
+
+async def incrementar_vendidos(sorteo_id: str, delta: int) -> Optional[dict]:
+    """
+    Sumar 'delta' boletos vendidos (negativo para restar) de forma atómica.
+    Retorna el sorteo actualizado con PROYECCION_CONTADOR, o None si no existe.
+    """
+    sorteo = await db.sorteos.find_one_and_update(
+        {'id': sorteo_id},
+        _pipeline_progreso({'$add': [{'$ifNull': ['$cantidad_vendida', 0]}, delta]}),
+        projection=PROYECCION_CONTADOR,
+        return_document=ReturnDocument.AFTER
+    )
+    cache_sorteos.actualizar_contadores(sorteo_id, sorteo)
+    return sorteo
+
+async def reconciliar_contadores(token_lider: Optional[int] = None) -> List[dict]:
+    """
+    Comparar cantidad_vendida con el conteo real de boletos aprobados de cada sorteo
+    no completado (y sin actor vigente), corregir las diferencias y devolverlas.
+    token_lider (reconciliador en background) protege las correcciones con fencing.
+    """
+    from actores_sorteo import PREFIJO_LEASE
+
+    sorteos = await db.sorteos.find(
+        {'estado': {'$nin': ['completed', 'completado']}},
+        {"_id": 0, "id": 1, "cantidad_vendida": 1}
+    ).to_list(None)
+    con_actor = await liderazgo.leases_vigentes([PREFIJO_LEASE + s['id'] for s in sorteos])
+    sorteos = [s for s in sorteos if PREFIJO_LEASE + s['id'] not in con_actor]
+    if not sorteos:
+        return []
+
+    conteos = await db.boletos.aggregate([
+        {'$match': {
+            'sorteo_id': {'$in': [s['id'] for s in sorteos]},
+            'pago_confirmado': True
+        }},
+        {'$group': {'_id': '$sorteo_id', 'aprobados': {'$sum': 1}}}
+    ]).to_list(None)
+    aprobados_por_sorteo = {c['_id']: c['aprobados'] for c in conteos}
+
+    diferencias = []
+    for sorteo in sorteos:
+        registrado = sorteo.get('cantidad_vendida', 0)
+        real = aprobados_por_sorteo.get(sorteo['id'], 0)
+        if registrado == real:
+            continue
+
+        pipeline = _pipeline_progreso(real)
+        if token_lider:
+            pipeline.append({'$set': liderazgo.set_token(token_lider)})
+        # Solo si el contador sigue como se leyó: un $inc concurrente no se pisa
+        # (la diferencia que quede se corrige en el próximo ciclo)
+        result = await db.sorteos.update_one({
+            'id': sorteo['id'],
+            'cantidad_vendida': registrado if registrado else {'$in': [0, None]},
+            **liderazgo.filtro_token(token_lider)
+        }, pipeline)
+        cache_sorteos.invalidar(sorteo['id'])
+        if result.modified_count == 0:
+            continue
+        diferencias.append({
+            'sorteo_id': sorteo['id'],
+            'registrado': registrado,
+            'real': real,
+            'diferencia': real - registrado
+        })
+        logger.warning(f"Contador corregido en sorteo {sorteo['id']}: {registrado} → {real}")
+
+    return diferencias
+
+async def monitorear_reconciliacion():
+    """Reconciliar los contadores periódicamente"""
+    while True:
+        try:
+            # Confirmar el lease antes de cada ciclo: un líder que lo perdió no corrige
+            token = await liderazgo.token_vigente()
+            if token is None:
+                logger.warning("⚠️  Reconciliación omitida: este worker ya no tiene el lease de líder")
+            else:
+                diferencias = await reconciliar_contadores(token)
+                if diferencias:
+                    logger.warning(f"Reconciliación de contadores: {len(diferencias)} sorteo(s) corregido(s)")
+        except Exception as e:
+            logger.error(f"Error en reconciliación de contadores: {e}")
+
+        await asyncio.sleep(RECONCILIACION_SEGUNDOS)
+
+def iniciar_reconciliador():
+    """Iniciar tarea en background"""
+    tarea = asyncio.create_task(monitorear_reconciliacion())
+    logger.info(f"✅ Reconciliador de contadores iniciado (cada {RECONCILIACION_SEGUNDOS}s)")
+    return tarea
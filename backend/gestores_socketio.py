@@ -0,0 +1,105 @@
+"""
+Gestor de clientes de Socket.IO elegido con SOCKETIO_GESTOR
+
+- memoria (por defecto): los eventos solo llegan a los clientes conectados a este proceso
+- redis: pub/sub de Redis (SOCKETIO_REDIS_URL) con el AsyncRedisManager de python-socketio
+- mongo: colección capped 'socketio_mensajes' leída con un cursor tailable
+
+Con redis o mongo cada emit se publica en el canal y todos los workers lo reenvían a
+sus propios clientes: los emit_* de websocket_manager llegan a todos los clientes sin
+importar a qué worker esté conectado cada uno.
+"""
+import asyncio
+import logging
+import os
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger(__name__)
+
+SOCKETIO_GESTOR = os.environ.get('SOCKETIO_GESTOR', 'memoria').lower()
+SOCKETIO_CANAL = os.environ.get('SOCKETIO_CANAL', 'sorteos_socketio')
+SOCKETIO_REDIS_URL = os.environ.get('SOCKETIO_REDIS_URL', 'redis://localhost:6379/0')
+
+COLECCION_MENSAJES = 'socketio_mensajes'
+# Tamaño de la colección capped: solo guarda los mensajes recientes
+TAMANO_MENSAJES_BYTES = int(os.environ.get('SOCKETIO_MONGO_BYTES', str(16 * 1024 * 1024)))
+
+
+class AsyncMongoManager(AsyncPubSubManager):
+    """
+    Pub/sub sobre una colección capped de Mongo. Cada mensaje se inserta como
+    documento y los workers lo leen con un cursor tailable en orden de inserción.
+    """
+    name = 'mongo'
+
+    def __init__(self, url: str, db_name: str, channel: str = SOCKETIO_CANAL,
+                 write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.db = AsyncIOMotorClient(url)[db_name]
+        self._coleccion_lista = False
+
+    async def _asegurar_coleccion(self):
+        if self._coleccion_lista:
+            return
+        try:
+            await self.db.create_collection(COLECCION_MENSAJES, capped=True, size=TAMANO_MENSAJES_BYTES)
+        except CollectionInvalid:
+            pass  # ya existe
+        self._coleccion_lista = True
+
+    async def _publish(self, data):
+        await self._asegurar_coleccion()
+        await self.db[COLECCION_MENSAJES].insert_one({'canal': self.channel, 'datos': data})
+
+    async def _ultimo_id(self):
+        ultimo = await self.db[COLECCION_MENSAJES].find_one({}, {'_id': 1}, sort=[('$natural', -1)])
+        return ultimo['_id'] if ultimo else None
+
+    async def _listen(self):
+        await self._asegurar_coleccion()
+        coleccion = self.db[COLECCION_MENSAJES]
+        # Empezar después del último mensaje existente: no reenviar emits viejos
+        ultimo_id = await self._ultimo_id()
+
+        while True:
+            # Los _id los generan workers distintos y no son crecientes entre ellos:
+            # al reabrir el cursor se saltan documentos hasta el último procesado
+            pendiente = ultimo_id
+            if pendiente is not None and not await coleccion.find_one({'_id': pendiente}, {'_id': 1}):
+                # Ya lo descartó la colección capped: seguir desde el último actual
+                pendiente = await self._ultimo_id()
+
+            cursor = coleccion.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for documento in cursor:
+                    if pendiente is not None:
+                        if documento['_id'] == pendiente:
+                            pendiente = None
+                        continue
+                    ultimo_id = documento['_id']
+                    if documento.get('canal') == self.channel:
+                        yield documento['datos']
+            # El cursor muere si la colección está vacía o si se quedó atrás
+            await asyncio.sleep(1)
+
+
+def es_distribuido() -> bool:
+    """Si los emits se reparten entre workers (y la ocupación de rooms es compartida)"""
+    return SOCKETIO_GESTOR in ('redis', 'mongo')
+
+def crear_gestor():
+    """Gestor de clientes para socketio.AsyncServer según SOCKETIO_GESTOR"""
+    if SOCKETIO_GESTOR == 'redis':
+        logger.info(f"✅ Socket.IO con gestor Redis ({SOCKETIO_REDIS_URL}, canal {SOCKETIO_CANAL})")
+        return socketio.AsyncRedisManager(SOCKETIO_REDIS_URL, channel=SOCKETIO_CANAL)
+    if SOCKETIO_GESTOR == 'mongo':
+        logger.info(f"✅ Socket.IO con gestor Mongo (colección {COLECCION_MENSAJES}, canal {SOCKETIO_CANAL})")
+        return AsyncMongoManager(os.environ['MONGO_URL'], os.environ['DB_NAME'])
+    if SOCKETIO_GESTOR != 'memoria':
+        logger.error(f"❌ SOCKETIO_GESTOR desconocido '{SOCKETIO_GESTOR}', usando memoria")
+    return socketio.AsyncManager()
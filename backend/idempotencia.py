@@ -0,0 +1,180 @@
+"""
+Claves de idempotencia (header Idempotency-Key)
+
+La primera petición con una clave registra un documento "en_proceso" en la colección
+'idempotencia'; al terminar con éxito se guarda la respuesta y los reintentos con la
+misma clave la reciben de vuelta con una sola búsqueda por _id, sin volver a ejecutar
+la operación. Los documentos vencen por un índice TTL sobre 'expira_en'.
+
+Las claves se aíslan por operación y usuario. Una clave reutilizada con otro cuerpo
+responde 422; un reintento mientras la primera petición sigue en curso responde 409.
+Si la operación falla, la clave se descarta para que el reintento se ejecute de nuevo.
+Mientras la operación corre (incluida la espera en la cola de compras) la marca
+"en_proceso" se renueva, así no vence aunque la admisión demore más que DURACION_EN_PROCESO.
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+import hashlib
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+db = None
+
+HEADER_IDEMPOTENCIA = 'Idempotency-Key'
+HEADER_REPETIDA = 'Idempotent-Replayed'
+INDICE_EXPIRACION = 'idempotencia_ttl'
+LONGITUD_MAXIMA_CLAVE = 255
+
+# Tiempo durante el que se repite la respuesta guardada
+VENTANA_IDEMPOTENCIA = timedelta(hours=int(os.environ.get('IDEMPOTENCIA_VENTANA_HORAS', '24')))
+# Si el proceso muere a mitad de la operación, la clave se puede reutilizar pasado este tiempo
+DURACION_EN_PROCESO = timedelta(minutes=2)
+# Cada cuánto se extiende la marca de una operación que sigue en curso
+RENOVACION_EN_PROCESO = DURACION_EN_PROCESO / 4
+
+def init_idempotencia(database):
+    global db
+    db = database
+
+async def asegurar_indices():
+    """Crear el índice TTL que elimina las claves vencidas"""
+    await db.idempotencia.create_index(
+        'expira_en',
+        name=INDICE_EXPIRACION,
+        expireAfterSeconds=0
+    )
+    logger.info("Índice de claves de idempotencia asegurado")
+
+def calcular_huella(payload) -> str:
+    """Hash estable del cuerpo de la petición"""
+    serializado = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serializado.encode()).hexdigest()
+
+async def _reclamar_clave(clave_id: str, huella: str) -> Optional[dict]:
+    """
+    Registrar la clave como en proceso.
+    Retorna None si la operación debe ejecutarse, o el documento guardado si es un reintento.
+    """
+    for _ in range(2):
+        ahora = datetime.now(timezone.utc)
+        try:
+            await db.idempotencia.insert_one({
+                '_id': clave_id,
+                'huella': huella,
+                'estado': 'en_proceso',
+                'creado_en': ahora,
+                'expira_en': ahora + DURACION_EN_PROCESO
+            })
+            return None
+        except DuplicateKeyError:
+            existente = await db.idempotencia.find_one({'_id': clave_id})
+
+        if not existente:
+            # Venció entre el insert y la búsqueda
+            continue
+
+        if existente['huella'] != huella:
+            raise HTTPException(
+                status_code=422,
+                detail="La clave de idempotencia ya se usó con una petición diferente"
+            )
+
+        if existente['estado'] == 'completado':
+            return existente
+
+        expira_en = existente['expira_en']
+        if expira_en.tzinfo is None:
+            expira_en = expira_en.replace(tzinfo=timezone.utc)
+        if expira_en > ahora:
+            raise HTTPException(
+                status_code=409,
+                detail="Esta operación todavía se está procesando. Intenta nuevamente en unos segundos"
+            )
+
+        # Quedó abandonada en proceso: se libera y se vuelve a reclamar
+        await db.idempotencia.delete_one({'_id': clave_id, 'estado': 'en_proceso'})
+
+    raise HTTPException(status_code=409, detail="No se pudo registrar la clave de idempotencia. Intenta nuevamente")
+
+async def _renovar_en_proceso(clave_id: str):
+    """Extender la marca en_proceso mientras la operación siga corriendo"""
+    while True:
+        await asyncio.sleep(RENOVACION_EN_PROCESO.total_seconds())
+        try:
+            await db.idempotencia.update_one(
+                {'_id': clave_id, 'estado': 'en_proceso'},
+                {'$set': {'expira_en': datetime.now(timezone.utc) + DURACION_EN_PROCESO}}
+            )
+        except Exception as e:
+            logger.error(f"Error renovando clave de idempotencia: {e}")
+
+async def ejecutar_idempotente(
+    request: Request,
+    operacion: str,
+    usuario_id: str,
+    payload,
+    ejecutar: Callable[[], Awaitable]
+):
+    """
+    Ejecutar 'ejecutar' respetando el header Idempotency-Key.
+    Sin header la operación se ejecuta normalmente.
+    """
+    clave = request.headers.get(HEADER_IDEMPOTENCIA)
+    if not clave:
+        return await ejecutar()
+
+    if len(clave) > LONGITUD_MAXIMA_CLAVE:
+        raise HTTPException(status_code=400, detail="La clave de idempotencia es demasiado larga")
+
+    clave_id = f"{operacion}:{usuario_id}:{clave}"
+    guardado = await _reclamar_clave(clave_id, calcular_huella(payload))
+    if guardado:
+        logger.info(f"Respuesta repetida para clave de idempotencia en {operacion}")
+        return JSONResponse(
+            status_code=guardado['status_code'],
+            content=guardado['respuesta'],
+            headers={HEADER_REPETIDA: 'true'}
+        )
+
+    renovacion = asyncio.create_task(_renovar_en_proceso(clave_id))
+    try:
+        resultado = await ejecutar()
+    except BaseException:
+        await db.idempotencia.delete_one({'_id': clave_id})
+        raise
+    finally:
+        renovacion.cancel()
+
+    if isinstance(resultado, JSONResponse):
+        status_code = resultado.status_code
+        respuesta = json.loads(resultado.body)
+    else:
+        status_code = 200
+        respuesta = jsonable_encoder(resultado)
+
+    if status_code >= 400:
+        # Solo se guardan resultados exitosos; un rechazo puede cambiar al reintentar
+        await db.idempotencia.delete_one({'_id': clave_id})
+        return resultado
+
+    ahora = datetime.now(timezone.utc)
+    await db.idempotencia.update_one(
+        {'_id': clave_id},
+        {'$set': {
+            'estado': 'completado',
+            'status_code': status_code,
+            'respuesta': respuesta,
+            'completado_en': ahora,
+            'expira_en': ahora + VENTANA_IDEMPOTENCIA
+        }}
+    )
+    return resultado
@@ -0,0 +1,430 @@
+"""
+Índice de inventario de boletos por sorteo (bitmap en memoria)
+
+Cada número del sorteo ocupa un bit en dos mapas:
+- vendidos: boletos con pago confirmado
+- reservados: boletos pendientes de aprobación
+
+Un número es LIBRE cuando no está en ninguno de los dos mapas.
+El índice se construye desde la colección boletos la primera vez que se necesita
+y luego se mantiene sincronizado por compras, aprobaciones, rechazos y expiraciones.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+db = None
+
+# Cada cuánto se reconstruye el índice desde Mongo (corrige cambios hechos por otros workers).
+# Es un recorrido completo de los boletos del sorteo, así que se hace con poca frecuencia:
+# la reserva en Mongo (índice único) sigue siendo la que decide si un número está libre.
+INVENTARIO_REFRESCO_SEGUNDOS = int(os.environ.get('INVENTARIO_REFRESCO_SEGUNDOS', '900'))
+
+# Cuánto dura la retención tentativa de los números elegidos por quick-pick
+QUICK_PICK_RETENCION_SEGUNDOS = int(os.environ.get('QUICK_PICK_RETENCION_SEGUNDOS', '300'))
+
+# Estados posibles de un número
+LIBRE = 0
+RESERVADO = 1
+VENDIDO = 2
+
+# Posiciones de los bits encendidos para cada valor de byte (0-255)
+_BITS_POR_BYTE = [tuple(bit for bit in range(8) if valor >> bit & 1) for valor in range(256)]
+
+def init_inventario(database):
+    global db
+    db = database
+
+
+class InventarioSorteo:
+    """Bitmap de disponibilidad de un sorteo (números 1..total)"""
+
+    def __init__(self, sorteo_id: str, total: int):
+        self.sorteo_id = sorteo_id
+        self.total = total
+        tamano = (total + 7) // 8
+        self.vendidos = bytearray(tamano)
+        self.reservados = bytearray(tamano)
+        self.cantidad_vendidos = 0
+        self.cantidad_reservados = 0
+        # Retenciones tentativas de quick-pick: numero -> (usuario_id, expira en monotonic)
+        self.retenciones: Dict[int, Tuple[str, float]] = {}
+        self.construido_en = time.monotonic()
+
+    def _posicion(self, numero: int):
+        indice = numero - 1
+        return indice >> 3, 1 << (indice & 7)
+
+    def en_rango(self, numero: int) -> bool:
+        return 1 <= numero <= self.total
+
+    def estado(self, numero: int) -> int:
+        if not self.en_rango(numero):
+            return LIBRE
+        byte, mascara = self._posicion(numero)
+        if self.vendidos[byte] & mascara:
+            return VENDIDO
+        if self.reservados[byte] & mascara:
+            return RESERVADO
+        return LIBRE
+
+    def marcar_vendido(self, numero: int):
+        if not self.en_rango(numero):
+            return
+        self.retenciones.pop(numero, None)
+        byte, mascara = self._posicion(numero)
+        if self.reservados[byte] & mascara:
+            self.reservados[byte] &= ~mascara
+            self.cantidad_reservados -= 1
+        if not self.vendidos[byte] & mascara:
+            self.vendidos[byte] |= mascara
+            self.cantidad_vendidos += 1
+
+    def marcar_reservado(self, numero: int):
+        if not self.en_rango(numero):
+            return
+        # Si estaba retenido por quick-pick, ahora lo reserva un boleto real
+        self.retenciones.pop(numero, None)
+        byte, mascara = self._posicion(numero)
+        # Un número vendido nunca vuelve a reservado
+        if self.vendidos[byte] & mascara:
+            return
+        if not self.reservados[byte] & mascara:
+            self.reservados[byte] |= mascara
+            self.cantidad_reservados += 1
+
+    def liberar(self, numero: int):
+        if not self.en_rango(numero):
+            return
+        self.retenciones.pop(numero, None)
+        byte, mascara = self._posicion(numero)
+        if self.vendidos[byte] & mascara:
+            self.vendidos[byte] &= ~mascara
+            self.cantidad_vendidos -= 1
+        if self.reservados[byte] & mascara:
+            self.reservados[byte] &= ~mascara
+            self.cantidad_reservados -= 1
+
+    # ============ RETENCIONES (QUICK-PICK) ============
+    def retener(self, numero: int, usuario_id: str, expira: float):
+        """Retener tentativamente un número libre para un usuario"""
+        if self.estado(numero) != LIBRE:
+            return
+        self.marcar_reservado(numero)
+        self.retenciones[numero] = (usuario_id, expira)
+
+    def _soltar_retencion(self, numero: int):
+        if self.retenciones.pop(numero, None) is None:
+            return
+        byte, mascara = self._posicion(numero)
+        if self.reservados[byte] & mascara:
+            self.reservados[byte] &= ~mascara
+            self.cantidad_reservados -= 1
+
+    def vencer_retenciones(self):
+        """Liberar las retenciones cuyo tiempo ya pasó"""
+        if not self.retenciones:
+            return
+        ahora = time.monotonic()
+        for numero, (_, expira) in list(self.retenciones.items()):
+            if expira <= ahora:
+                self._soltar_retencion(numero)
+
+    def liberar_retenciones_usuario(self, usuario_id: str):
+        for numero, (dueno, _) in list(self.retenciones.items()):
+            if dueno == usuario_id:
+                self._soltar_retencion(numero)
+
+    def retenidos_por_otros(self, numeros: Iterable[int], usuario_id: str) -> Set[int]:
+        """Números retenidos por quick-pick de otro usuario"""
+        self.vencer_retenciones()
+        return {
+            n for n in numeros
+            if n in self.retenciones and self.retenciones[n][0] != usuario_id
+        }
+
+    def seleccionar_aleatorios(self, cantidad: int) -> List[int]:
+        """
+        Elegir 'cantidad' números libres de forma uniforme.
+        Se sortean posiciones dentro de los libres (sin rechazo) y luego se ubican
+        recorriendo el bitmap una sola vez, así que el costo no crece aunque
+        el sorteo esté casi vendido.
+        """
+        self.vencer_retenciones()
+        cantidad = min(cantidad, self.cantidad_libres)
+        if cantidad <= 0:
+            return []
+
+        posiciones = sorted(random.sample(range(self.cantidad_libres), cantidad))
+        elegidos = []
+        acumulado = 0
+        j = 0
+        ultimo = len(self.vendidos) - 1
+        for i, (vendido, reservado) in enumerate(zip(self.vendidos, self.reservados)):
+            libres = ~(vendido | reservado) & 0xFF
+            if i == ultimo:
+                libres &= self._mascara_ultimo_byte()
+            if not libres:
+                continue
+            bits = _BITS_POR_BYTE[libres]
+            while j < cantidad and posiciones[j] < acumulado + len(bits):
+                elegidos.append(i * 8 + bits[posiciones[j] - acumulado] + 1)
+                j += 1
+            if j == cantidad:
+                break
+            acumulado += len(bits)
+        return elegidos
+
+    @property
+    def cantidad_libres(self) -> int:
+        return self.total - self.cantidad_vendidos - self.cantidad_reservados
+
+    def _mascara_ultimo_byte(self) -> int:
+        sobrantes = len(self.vendidos) * 8 - self.total
+        return 0xFF >> sobrantes
+
+    def numeros_disponibles(self) -> List[int]:
+        """Listar todos los números libres en orden ascendente"""
+        disponibles = []
+        ultimo = len(self.vendidos) - 1
+        for i, (vendido, reservado) in enumerate(zip(self.vendidos, self.reservados)):
+            libres = ~(vendido | reservado) & 0xFF
+            if i == ultimo:
+                libres &= self._mascara_ultimo_byte()
+            if libres:
+                base = i * 8 + 1
+                disponibles.extend(base + bit for bit in _BITS_POR_BYTE[libres])
+        return disponibles
+
+    def _contar_bits(self, mapa: bytearray, desde: int, hasta: int) -> int:
+        """Contar bits encendidos de un mapa para los números desde..hasta (inclusive)"""
+        inicio = desde - 1
+        fin = hasta
+        if fin <= inicio:
+            return 0
+        bits = int.from_bytes(mapa[inicio >> 3:(fin + 7) >> 3], 'little') >> (inicio & 7)
+        return (bits & ((1 << (fin - inicio)) - 1)).bit_count()
+
+    def contar(self, desde: int, hasta: int) -> Dict[str, int]:
+        """Contar libres, reservados y vendidos en una ventana de números"""
+        desde = max(1, desde)
+        hasta = min(self.total, hasta)
+        if hasta < desde:
+            return {'libres': 0, 'reservados': 0, 'vendidos': 0}
+        vendidos = self._contar_bits(self.vendidos, desde, hasta)
+        reservados = self._contar_bits(self.reservados, desde, hasta)
+        return {
+            'libres': hasta - desde + 1 - vendidos - reservados,
+            'reservados': reservados,
+            'vendidos': vendidos
+        }
+
+    def rangos(self, desde: int, hasta: int) -> List[List[int]]:
+        """
+        Codificar una ventana como rangos [inicio, fin, ocupado] (run-length)
+        ocupado = 0 si el rango está libre, 1 si está vendido o reservado
+        """
+        desde = max(1, desde)
+        hasta = min(self.total, hasta)
+        rangos = []
+        inicio_rango = desde
+        estado_rango = None
+        for numero in range(desde, hasta + 1):
+            byte, mascara = self._posicion(numero)
+            ocupado = 1 if (self.vendidos[byte] | self.reservados[byte]) & mascara else 0
+            if ocupado != estado_rango:
+                if estado_rango is not None:
+                    rangos.append([inicio_rango, numero - 1, estado_rango])
+                inicio_rango = numero
+                estado_rango = ocupado
+        if estado_rango is not None:
+            rangos.append([inicio_rango, hasta, estado_rango])
+        return rangos
+
+    def conteos_bloques(self, tamano_bloque: int) -> List[Dict[str, int]]:
+        """Conteos por bloques de tamaño fijo sobre todo el sorteo (vista general de la grilla)"""
+        bloques = []
+        for inicio in range(1, self.total + 1, tamano_bloque):
+            fin = min(self.total, inicio + tamano_bloque - 1)
+            conteo = self.contar(inicio, fin)
+            bloques.append({
+                'inicio': inicio,
+                'fin': fin,
+                'libres': conteo['libres'],
+                'ocupados': conteo['reservados'] + conteo['vendidos']
+            })
+        return bloques
+
+    def numeros_ocupados(self) -> List[int]:
+        """Listar todos los números vendidos o reservados en orden ascendente"""
+        ocupados = []
+        for i, (vendido, reservado) in enumerate(zip(self.vendidos, self.reservados)):
+            ocupado = vendido | reservado
+            if ocupado:
+                base = i * 8 + 1
+                ocupados.extend(base + bit for bit in _BITS_POR_BYTE[ocupado])
+        return ocupados
+
+
+# Índices cargados en este proceso
+_inventarios: Dict[str, InventarioSorteo] = {}
+_locks: Dict[str, asyncio.Lock] = {}
+# Cambios registrados mientras se reconstruye un índice: (método, números) en orden de llegada
+_cambios_en_reconstruccion: Dict[str, List[Tuple[str, List[int]]]] = {}
+
+async def _construir_desde_boletos(sorteo_id: str, total: int) -> InventarioSorteo:
+    """Construir el bitmap leyendo solo número y estado de pago de cada boleto"""
+    inventario = InventarioSorteo(sorteo_id, total)
+    cursor = db.boletos.find(
+        {'sorteo_id': sorteo_id},
+        {"_id": 0, "numero_boleto": 1, "pago_confirmado": 1}
+    )
+    async for boleto in cursor:
+        numero = boleto.get('numero_boleto')
+        if numero is None:
+            continue
+        if boleto.get('pago_confirmado', False):
+            inventario.marcar_vendido(numero)
+        else:
+            inventario.marcar_reservado(numero)
+    return inventario
+
+def _guardar(inventario: InventarioSorteo):
+    """Publicar un índice recién construido conservando las retenciones vigentes del anterior"""
+    anterior = _inventarios.get(inventario.sorteo_id)
+    if anterior and anterior.retenciones:
+        anterior.vencer_retenciones()
+        for numero, (usuario_id, expira) in anterior.retenciones.items():
+            inventario.retener(numero, usuario_id, expira)
+    _inventarios[inventario.sorteo_id] = inventario
+
+async def _reconstruir(sorteo_id: str, total: int) -> InventarioSorteo:
+    """
+    Construir el índice desde Mongo y publicarlo. Las ventas, reservas y liberaciones
+    registradas mientras el cursor recorría los boletos se vuelven a aplicar sobre el
+    índice nuevo antes de publicarlo, porque el recorrido pudo no verlas.
+    Se llama con el lock del sorteo tomado.
+    """
+    cambios = _cambios_en_reconstruccion[sorteo_id] = []
+    try:
+        inventario = await _construir_desde_boletos(sorteo_id, total)
+        for metodo, numeros in cambios:
+            for numero in numeros:
+                getattr(inventario, metodo)(numero)
+        _guardar(inventario)
+    finally:
+        _cambios_en_reconstruccion.pop(sorteo_id, None)
+    return inventario
+
+async def obtener_inventario(sorteo_id: str, total: int) -> InventarioSorteo:
+    """
+    Obtener el índice de un sorteo, construyéndolo si no existe,
+    si cambió la cantidad total de boletos o si superó el tiempo de refresco
+    """
+    inventario = _inventarios.get(sorteo_id)
+    if inventario and inventario.total == total and \
+            time.monotonic() - inventario.construido_en < INVENTARIO_REFRESCO_SEGUNDOS:
+        return inventario
+
+    lock = _locks.setdefault(sorteo_id, asyncio.Lock())
+    async with lock:
+        # Otra petición pudo haberlo construido mientras esperábamos
+        inventario = _inventarios.get(sorteo_id)
+        if inventario and inventario.total == total and \
+                time.monotonic() - inventario.construido_en < INVENTARIO_REFRESCO_SEGUNDOS:
+            return inventario
+
+        return await _reconstruir(sorteo_id, total)
+
+async def reconstruir_inventario(sorteo_id: str) -> Optional[InventarioSorteo]:
+    """Regenerar el índice de un sorteo desde la colección boletos"""
+    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id}, {"_id": 0, "cantidad_total_boletos": 1})
+    if not sorteo_doc:
+        descartar_inventario(sorteo_id)
+        return None
+
+    lock = _locks.setdefault(sorteo_id, asyncio.Lock())
+    async with lock:
+        inventario = await _reconstruir(sorteo_id, sorteo_doc['cantidad_total_boletos'])
+
+    logger.info(
+        f"Inventario reconstruido para sorteo {sorteo_id}: "
+        f"{inventario.cantidad_vendidos} vendidos, {inventario.cantidad_reservados} reservados"
+    )
+    return inventario
+
+async def reconstruir_todos() -> int:
+    """Regenerar el índice de todos los sorteos que no están completados"""
+    sorteos = await db.sorteos.find(
+        {'estado': {'$nin': ['completed', 'completado']}},
+        {"_id": 0, "id": 1}
+    ).to_list(1000)
+
+    for sorteo in sorteos:
+        await reconstruir_inventario(sorteo['id'])
+
+    return len(sorteos)
+
+def descartar_inventario(sorteo_id: str):
+    """Eliminar el índice de un sorteo de la memoria (por ejemplo al eliminar el sorteo)"""
+    _inventarios.pop(sorteo_id, None)
+    _locks.pop(sorteo_id, None)
+
+# ============ SINCRONIZACIÓN ============
+# Si el índice no está cargado en este proceso no hay nada que actualizar:
+# se construirá completo desde Mongo en la próxima lectura.
+# Si se está reconstruyendo, el cambio también se anota para aplicarlo al índice nuevo.
+
+def _registrar(sorteo_id: str, metodo: str, numeros: Iterable[int]):
+    numeros = list(numeros)
+    cambios = _cambios_en_reconstruccion.get(sorteo_id)
+    if cambios is not None:
+        cambios.append((metodo, numeros))
+    inventario = _inventarios.get(sorteo_id)
+    if inventario:
+        for numero in numeros:
+            getattr(inventario, metodo)(numero)
+
+def registrar_reserva(sorteo_id: str, numeros: Iterable[int]):
+    """Boletos creados pendientes de aprobación"""
+    _registrar(sorteo_id, 'marcar_reservado', numeros)
+
+def registrar_venta(sorteo_id: str, numeros: Iterable[int]):
+    """Boletos con pago confirmado (Payphone o aprobación del admin)"""
+    _registrar(sorteo_id, 'marcar_vendido', numeros)
+
+def registrar_liberacion(sorteo_id: str, numeros: Iterable[int]):
+    """Boletos rechazados o expirados"""
+    _registrar(sorteo_id, 'liberar', numeros)
+
+async def quick_pick(sorteo_id: str, total: int, usuario_id: str, cantidad: int) -> Tuple[List[int], float]:
+    """
+    Elegir y retener tentativamente 'cantidad' números libres al azar para un usuario.
+    Las retenciones anteriores del mismo usuario en este sorteo se liberan primero.
+    Retorna (números, segundos de retención).
+    """
+    inventario = await obtener_inventario(sorteo_id, total)
+    inventario.liberar_retenciones_usuario(usuario_id)
+
+    numeros = inventario.seleccionar_aleatorios(cantidad)
+    if len(numeros) < cantidad:
+        # No alcanzan los números libres: no se retiene nada
+        return sorted(numeros), 0
+
+    expira = time.monotonic() + QUICK_PICK_RETENCION_SEGUNDOS
+    for numero in numeros:
+        inventario.retener(numero, usuario_id, expira)
+
+    return sorted(numeros), QUICK_PICK_RETENCION_SEGUNDOS
+
+def retenidos_por_otros(sorteo_id: str, numeros: Iterable[int], usuario_id: str) -> Set[int]:
+    """Números de la lista retenidos por quick-pick de otro usuario en este proceso"""
+    inventario = _inventarios.get(sorteo_id)
+    if not inventario:
+        return set()
+    return inventario.retenidos_por_otros(numeros, usuario_id)
@@ -0,0 +1,248 @@
+"""
+Lease de líder en Mongo para los servicios en background
+
+Con varios workers de uvicorn, solo el titular del lease ejecuta los servicios
+singleton (countdowns, programador de transiciones, expiración de reservas,
+reconciliador de contadores, supervisión de animaciones LIVE).
+
+El lease es un documento de la colección 'leases':
+- titular: id del worker que lo tiene
+- expira_en: vence si el titular deja de renovarlo (heartbeat)
+- token: fencing token, aumenta cada vez que el lease cambia de titular
+
+Si el líder muere, otro worker toma el lease al vencer (LEASE_DURACION_SEGUNDOS)
+y arranca los servicios. Al perderlo, los servicios se cancelan.
+
+Un líder pausado (GC, red) puede seguir corriendo después de que su lease venció.
+Por eso cada ciclo de un servicio singleton confirma el token en Mongo
+(token_vigente) y sus escrituras sobre sorteos llevan el token: filtro_token
+rechaza el documento si ya lo escribió un líder con token mayor.
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable, List, Optional, Set
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+db = None
+
+LIDERAZGO_HABILITADO = os.environ.get('LIDERAZGO_HABILITADO', 'true').lower() == 'true'
+LEASE_NOMBRE = 'servicios_background'
+LEASE_DURACION_SEGUNDOS = int(os.environ.get('LEASE_DURACION_SEGUNDOS', '15'))
+LEASE_HEARTBEAT_SEGUNDOS = int(os.environ.get('LEASE_HEARTBEAT_SEGUNDOS', '5'))
+# Leases sin renovar se borran después de este tiempo (limpieza de nombres abandonados)
+INDICE_LIMPIEZA = 'leases_limpieza_ttl'
+LIMPIEZA_SEGUNDOS = 24 * 60 * 60
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class ServicioSingleton:
+    """Servicio que solo corre en el líder"""
+
+    def __init__(self, nombre: str, iniciar: Callable, detener: Optional[Callable] = None):
+        self.nombre = nombre
+        self.iniciar = iniciar   # retorna la(s) tarea(s) creadas
+        self.detener = detener   # limpieza opcional al perder el lease
+        self.tareas: List[asyncio.Task] = []
+
+
+_servicios: List[ServicioSingleton] = []
+_token: Optional[int] = None
+# Hasta cuándo (reloj monotónico) se considera válido el lease sin renovar
+_valido_hasta = 0.0
+_tarea_heartbeat: Optional[asyncio.Task] = None
+
+def init_liderazgo(database):
+    global db
+    db = database
+
+async def asegurar_indices():
+    await db.leases.create_index(
+        'renovado_en',
+        name=INDICE_LIMPIEZA,
+        expireAfterSeconds=LIMPIEZA_SEGUNDOS
+    )
+
+def registrar_servicio(nombre: str, iniciar: Callable, detener: Optional[Callable] = None):
+    """Registrar un servicio singleton. 'iniciar' crea y retorna su tarea (o lista de tareas)."""
+    _servicios.append(ServicioSingleton(nombre, iniciar, detener))
+
+def es_lider() -> bool:
+    """Si este worker tiene el lease vigente (siempre True si el liderazgo está deshabilitado)"""
+    if not LIDERAZGO_HABILITADO:
+        return True
+    return _token is not None and time.monotonic() < _valido_hasta
+
+def token_actual() -> Optional[int]:
+    """Fencing token del lease vigente, o None si este worker no es líder"""
+    return _token if es_lider() else None
+
+async def intentar_adquirir(nombre: str = LEASE_NOMBRE) -> Optional[int]:
+    """
+    Adquirir o renovar el lease. Retorna el fencing token si este worker es el titular,
+    o None si otro worker lo tiene vigente.
+    """
+    ahora = datetime.now(timezone.utc)
+    try:
+        lease = await db.leases.find_one_and_update(
+            {
+                '_id': nombre,
+                '$or': [{'titular': WORKER_ID}, {'expira_en': {'$lte': ahora}}]
+            },
+            [{'$set': {
+                # El token solo aumenta cuando cambia el titular
+                'token': {'$cond': [
+                    {'$eq': ['$titular', WORKER_ID]},
+                    '$token',
+                    {'$add': [{'$ifNull': ['$token', 0]}, 1]}
+                ]},
+                'titular': WORKER_ID,
+                'expira_en': ahora + timedelta(seconds=LEASE_DURACION_SEGUNDOS),
+                'renovado_en': ahora
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Otro worker tiene el lease vigente (el upsert chocó con su documento)
+        return None
+    return lease['token'] if lease else None
+
+async def validar_token(token: int, nombre: str = LEASE_NOMBRE) -> bool:
+    """Confirmar en Mongo que el token sigue siendo el del titular vigente (fencing)"""
+    lease = await db.leases.find_one({
+        '_id': nombre,
+        'titular': WORKER_ID,
+        'token': token,
+        'expira_en': {'$gt': datetime.now(timezone.utc)}
+    }, {'_id': 1})
+    return lease is not None
+
+async def leases_vigentes(nombres: List[str]) -> Set[str]:
+    """Cuáles de estos leases tienen titular vigente (en cualquier worker)"""
+    if not nombres:
+        return set()
+    leases = await db.leases.find({
+        '_id': {'$in': nombres},
+        'expira_en': {'$gt': datetime.now(timezone.utc)}
+    }, {'_id': 1}).to_list(None)
+    return {lease['_id'] for lease in leases}
+
+async def token_vigente() -> Optional[int]:
+    """
+    Token confirmado en Mongo para un ciclo de un servicio singleton, o None si este
+    worker ya no es líder (el ciclo no debe escribir). Sin liderazgo retorna 0.
+    """
+    if not LIDERAZGO_HABILITADO:
+        return 0
+    token = token_actual()
+    if token is None or not await validar_token(token):
+        return None
+    return token
+
+def filtro_token(token: Optional[int]) -> dict:
+    """Condición de fencing: el documento no lo escribió un líder con token mayor"""
+    if not token:
+        return {}
+    return {'token_lider': {'$not': {'$gt': token}}}
+
+def set_token(token: Optional[int]) -> dict:
+    """Campos a agregar al $set de una escritura protegida con filtro_token"""
+    if not token:
+        return {}
+    return {'token_lider': token}
+
+async def liberar(nombre: str = LEASE_NOMBRE):
+    """Soltar el lease para que otro worker lo tome sin esperar a que venza"""
+    await db.leases.update_one(
+        {'_id': nombre, 'titular': WORKER_ID},
+        {'$set': {'expira_en': datetime.now(timezone.utc)}}
+    )
+
+def _arrancar_servicios():
+    for servicio in _servicios:
+        try:
+            tareas = servicio.iniciar()
+            if isinstance(tareas, asyncio.Task):
+                tareas = [tareas]
+            servicio.tareas = list(tareas or [])
+        except Exception as e:
+            logger.error(f"❌ Error iniciando servicio {servicio.nombre}: {e}")
+
+async def _detener_servicios():
+    for servicio in _servicios:
+        for tarea in servicio.tareas:
+            tarea.cancel()
+        servicio.tareas = []
+        if servicio.detener:
+            try:
+                resultado = servicio.detener()
+                if asyncio.iscoroutine(resultado):
+                    await resultado
+            except Exception as e:
+                logger.error(f"❌ Error deteniendo servicio {servicio.nombre}: {e}")
+
+async def _heartbeat():
+    """Renovar (o intentar tomar) el lease cada LEASE_HEARTBEAT_SEGUNDOS"""
+    global _token, _valido_hasta
+    while True:
+        inicio = time.monotonic()
+        try:
+            token = await intentar_adquirir()
+        except Exception as e:
+            logger.error(f"❌ Error renovando lease de líder: {e}")
+            token = None
+
+        if token is not None:
+            # El margen se cuenta desde antes de la escritura para no sobreestimar
+            _valido_hasta = inicio + LEASE_DURACION_SEGUNDOS
+            if _token is None:
+                _token = token
+                logger.info(f"👑 Worker {WORKER_ID} es líder (token {token}), iniciando servicios")
+                _arrancar_servicios()
+            elif _token != token:
+                # Otro worker tuvo el lease mientras tanto: las tareas del token anterior
+                # se detienen antes de arrancar las nuevas para no duplicar servicios
+                logger.warning(f"⚠️  Worker {WORKER_ID} recuperó el lease con token {token}, reiniciando servicios")
+                _token = None
+                await _detener_servicios()
+                _token = token
+                _arrancar_servicios()
+        elif _token is not None and not es_lider():
+            logger.warning(f"⚠️  Worker {WORKER_ID} perdió el lease de líder, deteniendo servicios")
+            _token = None
+            await _detener_servicios()
+
+        await asyncio.sleep(LEASE_HEARTBEAT_SEGUNDOS)
+
+def iniciar():
+    """Arrancar los servicios registrados (directo o por lease según LIDERAZGO_HABILITADO)"""
+    global _tarea_heartbeat
+    if not LIDERAZGO_HABILITADO:
+        _arrancar_servicios()
+        logger.info("✅ Servicios en background iniciados (liderazgo deshabilitado)")
+        return
+    _tarea_heartbeat = asyncio.create_task(_heartbeat())
+    logger.info(f"✅ Elección de líder iniciada para worker {WORKER_ID}")
+
+async def detener():
+    """Detener servicios y soltar el lease (al apagar el worker)"""
+    global _token
+    if _tarea_heartbeat:
+        _tarea_heartbeat.cancel()
+    await _detener_servicios()
+    if LIDERAZGO_HABILITADO and _token is not None:
+        _token = None
+        try:
+            await liberar()
+        except Exception as e:
+            logger.error(f"❌ Error liberando lease de líder: {e}")
@@ -1,11 +1,24 @@
 """
 Servicio para manejar animaciones LIVE en tiempo real
 2 minutos (120 segundos) por premio - OBLIGATORIO
+
+Un solo ticker atiende todas las animaciones LIVE de este worker. Cada animación
+guarda el equivalente monotonic de fecha_live (persistida al pasar a LIVE) y el
+próximo segundo a emitir; el premio actual y el tiempo restante se calculan desde
+ese inicio, así que el ritmo no acumula la latencia de los emits y una animación
+reanudada (reinicio o cambio de worker) sigue donde iba. En cada pasada el ticker
+emite juntos los eventos vencidos de todas las animaciones.
 """
 import asyncio
-from datetime import datetime, timezone
+from datetime import timezone, timedelta
 import logging
-from typing import Dict
+from typing import Dict, Optional, Set
+
+import cache_sorteos
+import liderazgo
+import particion_sorteos
+import reloj
+import timeline_transiciones
 
 logger = logging.getLogger(__name__)
 
@@ -15,8 +28,42 @@ Sorteo = None
 SorteoEstado = None
 SorteoTipo = None
 
-# Diccionario para rastrear animaciones activas
-active_animations: Dict[str, asyncio.Task] = {}
+DURACION_POR_PREMIO = 120  # 120 segundos = 2 minutos (REQUERIMIENTO OBLIGATORIO)
+# Desfase máximo aceptado de un tick respecto de su segundo programado
+TOLERANCIA_TICK_MS = 100
+
+# Cada cuánto el líder busca sorteos LIVE sin animación (p.ej. pasaron a LIVE en otro worker)
+SUPERVISION_SEGUNDOS = 5
+
+
+class AnimacionLive:
+    """Animación en curso dentro del ticker compartido"""
+
+    def __init__(self, sorteo, inicio: float, transcurrido: float = 0.0):
+        self.sorteo = sorteo
+        self.ganadores = sorteo.ganadores if sorteo.ganadores else []
+        self.inicio = inicio        # reloj.monotonic() equivalente a fecha_live
+        # Próximo segundo (desde fecha_live) a emitir
+        self.segundo = min(int(transcurrido), self.duracion)
+        self.premio_emitido = -1    # último premio cuyo live_prize_drawing se emitió
+
+    @property
+    def duracion(self) -> int:
+        return DURACION_POR_PREMIO * len(self.ganadores)
+
+    def vencimiento(self) -> float:
+        return self.inicio + self.segundo
+
+
+# Animaciones activas de este worker (las que atiende el ticker)
+active_animations: Dict[str, AnimacionLive] = {}
+# Animaciones cargando participantes antes de entrar al ticker
+_preparando: Set[str] = set()
+# Animaciones terminadas cuyo cierre (finalizar_animacion) aún no se escribió
+_finalizando: Set[str] = set()
+_despertar: Optional[asyncio.Event] = None
+
+_metricas = {'ticks': 0, 'fuera_de_tolerancia': 0, 'desfase_max_ms': 0.0}
 
 def init_live_service(database, sorteo_model, estado_enum, tipo_enum):
     global db, Sorteo, SorteoEstado, SorteoTipo
@@ -30,56 +77,88 @@ async def iniciar_animacion_live(sorteo_id: str):
     Iniciar animación LIVE para un sorteo
     2 minutos por premio - OBLIGATORIO
     """
-    # Evitar iniciar si ya hay una animación activa
-    if sorteo_id in active_animations:
-        logger.warning(f"Animación ya activa para sorteo {sorteo_id}")
+    # Solo anima el dueño del sorteo (el líder sin reparto); si la transición ocurrió
+    # en otro worker la toma la supervisión del dueño
+    if not particion_sorteos.es_propietario(sorteo_id):
+        logger.info(f"Animación de sorteo {sorteo_id} delegada a su worker dueño")
         return
     
-    # Crear tarea asíncrona
-    task = asyncio.create_task(ejecutar_animacion_live(sorteo_id))
-    active_animations[sorteo_id] = task
-    
-    logger.info(f"✅ Animación LIVE programada para sorteo {sorteo_id}")
+    # Evitar iniciar si ya hay una animación activa (o terminando)
+    if sorteo_id in active_animations or sorteo_id in _preparando or sorteo_id in _finalizando:
+        logger.warning(f"Animación ya activa para sorteo {sorteo_id}")
+        return
     
+    _preparando.add(sorteo_id)
     try:
-        await task
+        animacion = await preparar_animacion(sorteo_id)
     finally:
-        if sorteo_id in active_animations:
-            del active_animations[sorteo_id]
-            logger.info(f"✅ Animación LIVE finalizada y eliminada para sorteo {sorteo_id}")
+        _preparando.discard(sorteo_id)
+    if not animacion:
+        return
+    
+    active_animations[sorteo_id] = animacion
+    if _despertar:
+        _despertar.set()
+    logger.info(f"✅ Animación LIVE programada para sorteo {sorteo_id}")
 
 async def verificar_y_reiniciar_animaciones():
     """
     Verificar sorteos LIVE sin animación activa y reiniciarlos
     """
-    sorteos_live = await db.sorteos.find({'estado': 'live'}).to_list(100)
+    sorteos_live = await db.sorteos.find({'estado': 'live'}, {"_id": 0, "id": 1}).to_list(100)
+    
+    # Soltar las animaciones de sorteos que pasaron a otro worker (cambió el reparto)
+    for sorteo_id in list(active_animations):
+        if not particion_sorteos.es_propietario(sorteo_id):
+            logger.info(f"Sorteo {sorteo_id} ahora pertenece a otro worker, deteniendo su animación")
+            active_animations.pop(sorteo_id, None)
     
     for sorteo_doc in sorteos_live:
         sorteo_id = sorteo_doc['id']
+        if not particion_sorteos.es_propietario(sorteo_id):
+            continue
         
-        # Si el sorteo está LIVE pero NO tiene animación activa
-        if sorteo_id not in active_animations:
-            logger.warning(f"⚠️  Sorteo LIVE sin animación: {sorteo_id} - Reiniciando...")
+        # Si el sorteo está LIVE pero NO tiene animación activa (ni está cerrándose)
+        if sorteo_id not in active_animations and sorteo_id not in _preparando and sorteo_id not in _finalizando:
+            logger.warning(f"⚠️  Sorteo LIVE sin animación: {sorteo_id} - Reanudando...")
             asyncio.create_task(iniciar_animacion_live(sorteo_id))
 
-async def ejecutar_animacion_live(sorteo_id: str):
+async def supervisar_animaciones():
+    """Reiniciar periódicamente animaciones de sorteos LIVE que no tienen tarea activa"""
+    while True:
+        try:
+            # Confirmar el lease (sin reparto) antes de cada ciclo
+            if await particion_sorteos.token_ciclo() is not None:
+                await verificar_y_reiniciar_animaciones()
+        except Exception as e:
+            logger.error(f"Error supervisando animaciones LIVE: {e}")
+        await reloj.dormir(SUPERVISION_SEGUNDOS)
+
+def iniciar_supervision_animaciones():
+    """Iniciar en background el ticker de animaciones y su supervisión"""
+    global _despertar
+    _despertar = asyncio.Event()
+    tareas = [
+        asyncio.create_task(ejecutar_ticker_animaciones()),
+        asyncio.create_task(supervisar_animaciones())
+    ]
+    logger.info("✅ Ticker y supervisión de animaciones LIVE iniciados")
+    return tareas
+
+def detener_animaciones():
+    """Soltar las animaciones de este worker (al perder el liderazgo o al apagarse)"""
+    active_animations.clear()
+
+async def preparar_animacion(sorteo_id: str) -> Optional[AnimacionLive]:
     """
-    Ejecutar la animación LIVE
+    Cargar participantes, emitir el inicio y ubicar la animación en su segundo actual
+    según fecha_live
     """
-    from websocket_manager import (
-        emit_live_animation_start,
-        emit_live_prize_drawing,
-        emit_live_time_update,
-        emit_live_winner_announced,
-        emit_live_animation_complete,
-        emit_sorteo_state_changed
-    )
-    
-    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id})
-    if not sorteo_doc:
-        return
+    from websocket_manager import emit_live_animation_start
     
-    sorteo = Sorteo(**sorteo_doc)
+    sorteo = await cache_sorteos.obtener(sorteo_id, verificar=True)
+    if not sorteo or sorteo.estado != SorteoEstado.LIVE:
+        return None
     
     logger.info(f"Iniciando animación LIVE para sorteo {sorteo_id}")
     
@@ -104,61 +183,204 @@ async def ejecutar_animacion_live(sorteo_id: str):
         'sorteo_id': sorteo_id,
         'participantes': participantes_data,
         'num_premios': len(sorteo.ganadores) if sorteo.ganadores else 1,
-        'timestamp': datetime.now(timezone.utc).isoformat()
+        'timestamp': reloj.ahora().isoformat()
     })
     
-    # Procesar cada premio (2 minutos cada uno - OBLIGATORIO)
-    ganadores = sorteo.ganadores if sorteo.ganadores else []
-    duracion_por_premio = 120  # 120 segundos = 2 minutos (REQUERIMIENTO OBLIGATORIO)
+    # Ubicar la animación respecto de fecha_live (persistida al pasar a LIVE)
+    fecha_live = sorteo.fecha_live or reloj.ahora()
+    if fecha_live.tzinfo is None:
+        fecha_live = fecha_live.replace(tzinfo=timezone.utc)
+    transcurrido = max(0.0, (reloj.ahora() - fecha_live).total_seconds())
+    animacion = AnimacionLive(sorteo, reloj.monotonic() - transcurrido, transcurrido)
+    if animacion.segundo:
+        logger.info(f"Animación de sorteo {sorteo_id} reanudada en el segundo {animacion.segundo}")
+    return animacion
+
+async def ejecutar_ticker_animaciones():
+    """Dormir hasta el próximo segundo vencido de cualquier animación y emitir todo lo vencido"""
+    while True:
+        try:
+            _despertar.clear()
+            if not active_animations:
+                await reloj.esperar_evento(_despertar, None)
+                continue
+            
+            proximo = min(animacion.vencimiento() for animacion in active_animations.values())
+            espera = proximo - reloj.monotonic()
+            if espera > 0 and await reloj.esperar_evento(_despertar, espera):
+                continue  # Llegó una animación nueva: recalcular el próximo vencimiento
+            
+            await procesar_vencidos()
+        
+        except Exception as e:
+            logger.error(f"❌ Error en ticker de animaciones LIVE: {e}")
+            await reloj.dormir(1)
+
+async def procesar_vencidos():
+    """Emitir en una pasada los eventos vencidos de todas las animaciones"""
+    ahora = reloj.monotonic()
+    vencidas = [
+        (sorteo_id, animacion)
+        for sorteo_id, animacion in list(active_animations.items())
+        if animacion.vencimiento() <= ahora
+    ]
+    for _, animacion in vencidas:
+        _registrar_desfase((ahora - animacion.vencimiento()) * 1000)
+    
+    resultados = await asyncio.gather(
+        *(emitir_vencidos(sorteo_id, animacion, ahora - animacion.inicio) for sorteo_id, animacion in vencidas),
+        return_exceptions=True
+    )
     
-    for idx, ganador in enumerate(ganadores):
-        premio_nombre = ganador.get('premio', f'Premio {idx + 1}')
+    for (sorteo_id, animacion), resultado in zip(vencidas, resultados):
+        if isinstance(resultado, Exception):
+            logger.error(f"❌ Error emitiendo animación de sorteo {sorteo_id}: {resultado}")
+            # No reintentar el mismo segundo en bucle
+            animacion.segundo = min(max(animacion.segundo, int(ahora - animacion.inicio) + 1), animacion.duracion)
+        elif resultado and active_animations.get(sorteo_id) is animacion:
+            # Sigue LIVE en Mongo hasta que finalizar_animacion escriba el cierre:
+            # la supervisión no debe reanudarla mientras tanto
+            _finalizando.add(sorteo_id)
+            del active_animations[sorteo_id]
+            asyncio.create_task(_cerrar_animacion(sorteo_id, animacion))
+
+async def _cerrar_animacion(sorteo_id: str, animacion: AnimacionLive):
+    try:
+        await finalizar_animacion(sorteo_id, animacion)
+    except Exception as e:
+        logger.error(f"❌ Error finalizando animación de sorteo {sorteo_id}: {e}")
+    finally:
+        _finalizando.discard(sorteo_id)
+
+def _registrar_desfase(desfase_ms: float):
+    _metricas['ticks'] += 1
+    _metricas['desfase_max_ms'] = max(_metricas['desfase_max_ms'], desfase_ms)
+    if desfase_ms > TOLERANCIA_TICK_MS:
+        _metricas['fuera_de_tolerancia'] += 1
+
+async def emitir_vencidos(sorteo_id: str, animacion: AnimacionLive, transcurrido: float) -> bool:
+    """
+    Emitir en orden los eventos de la animación hasta el segundo transcurrido.
+    Si el ticker se atrasó, los live_time_update intermedios se omiten (solo sale el
+    último), pero premios y ganadores siempre se emiten. Retorna True al completarse.
+    """
+    from websocket_manager import (
+        emit_live_prize_drawing,
+        emit_live_time_update,
+        emit_live_winner_announced,
+        emit_live_animation_complete,
+        room_ocupada
+    )
+    
+    ganadores = animacion.ganadores
+    actual = min(int(transcurrido), animacion.duracion)
+    while animacion.segundo <= actual:
+        segundo = animacion.segundo
+        idx, avance = divmod(segundo, DURACION_POR_PREMIO)
         
-        logger.info(f"Sorteando premio {idx + 1}/{len(ganadores)}: {premio_nombre}")
+        # Anunciar el ganador del premio que terminó en este segundo
+        if segundo > 0 and avance == 0:
+            ganador = ganadores[idx - 1]
+            await emit_live_winner_announced(sorteo_id, {
+                'premio_index': idx - 1,
+                'premio_nombre': ganador.get('premio', f'Premio {idx}'),
+                'ganador': ganador,
+                'timestamp': reloj.ahora().isoformat()
+            })
+            logger.info(f"Ganador anunciado: {ganador.get('nombre', ganador.get('email'))} - Boleto #{ganador.get('numero_boleto')}")
         
-        # Emitir inicio de sorteo de este premio
-        inicio_premio = datetime.now(timezone.utc)
-        await emit_live_prize_drawing(sorteo_id, {
-            'premio_index': idx,
-            'premio_nombre': premio_nombre,
-            'duracion_segundos': duracion_por_premio,
-            'total_premios': len(ganadores),
-            'timestamp': inicio_premio.isoformat(),
-            'tiempo_restante': duracion_por_premio
-        })
+        if segundo == animacion.duracion:
+            # Animación completada
+            logger.info(f"Animación LIVE completada para sorteo {sorteo_id}")
+            await emit_live_animation_complete(sorteo_id, {
+                'sorteo_id': sorteo_id,
+                'ganadores': ganadores,
+                'timestamp': reloj.ahora().isoformat()
+            })
+            return True
         
-        # Esperar 2 minutos (120 segundos) enviando actualizaciones cada segundo
-        for segundo in range(duracion_por_premio, 0, -1):
-            # Emitir actualización de tiempo cada segundo
-            await emit_live_time_update(sorteo_id, {
+        premio_nombre = ganadores[idx].get('premio', f'Premio {idx + 1}')
+        if idx > animacion.premio_emitido:
+            # Emitir inicio de sorteo de este premio (también al reanudar a mitad de premio)
+            logger.info(f"Sorteando premio {idx + 1}/{len(ganadores)}: {premio_nombre}")
+            await emit_live_prize_drawing(sorteo_id, {
                 'premio_index': idx,
                 'premio_nombre': premio_nombre,
-                'tiempo_restante': segundo,
+                'duracion_segundos': DURACION_POR_PREMIO,
                 'total_premios': len(ganadores),
-                'timestamp': datetime.now(timezone.utc).isoformat()
+                'timestamp': reloj.ahora().isoformat(),
+                'tiempo_restante': DURACION_POR_PREMIO - avance
             })
-            await asyncio.sleep(1)
-        
-        # Anunciar ganador
-        await emit_live_winner_announced(sorteo_id, {
-            'premio_index': idx,
-            'premio_nombre': premio_nombre,
-            'ganador': ganador,
-            'timestamp': datetime.now(timezone.utc).isoformat()
-        })
+            animacion.premio_emitido = idx
         
-        logger.info(f"Ganador anunciado: {ganador.get('nombre', ganador.get('email'))} - Boleto #{ganador.get('numero_boleto')}")
+        # El tick de cada segundo solo se arma si alguien mira (al unirse recibe el estado)
+        if segundo == actual and room_ocupada(sorteo_id):
+            await emit_live_time_update(sorteo_id, _datos_tiempo(ganadores, idx, avance))
+        animacion.segundo += 1
+    return False
+
+def _datos_tiempo(ganadores: list, idx: int, avance: int) -> dict:
+    return {
+        'premio_index': idx,
+        'premio_nombre': ganadores[idx].get('premio', f'Premio {idx + 1}'),
+        'tiempo_restante': DURACION_POR_PREMIO - avance,
+        'total_premios': len(ganadores),
+        'timestamp': reloj.ahora().isoformat()
+    }
+
+async def enviar_estado_animacion(sorteo_id: str, sid: str):
+    """Enviar el premio en curso y su tiempo restante a un cliente que se acaba de unir"""
+    from websocket_manager import emit_live_prize_drawing, emit_live_time_update
     
-    # Animación completada
-    logger.info(f"Animación LIVE completada para sorteo {sorteo_id}")
+    animacion = active_animations.get(sorteo_id)
+    if animacion:
+        ganadores = animacion.ganadores
+        transcurrido = reloj.monotonic() - animacion.inicio
+    else:
+        # La animación puede correr en otro worker: se ubica igual desde fecha_live
+        if cache_sorteos.db is None:
+            return
+        sorteo = await cache_sorteos.obtener(sorteo_id)
+        if not sorteo or sorteo.estado != SorteoEstado.LIVE or not sorteo.fecha_live:
+            return
+        fecha_live = sorteo.fecha_live
+        if fecha_live.tzinfo is None:
+            fecha_live = fecha_live.replace(tzinfo=timezone.utc)
+        ganadores = sorteo.ganadores or []
+        transcurrido = (reloj.ahora() - fecha_live).total_seconds()
     
-    await emit_live_animation_complete(sorteo_id, {
-        'sorteo_id': sorteo_id,
-        'ganadores': ganadores,
-        'timestamp': datetime.now(timezone.utc).isoformat()
-    })
+    if transcurrido < 0 or transcurrido >= DURACION_POR_PREMIO * len(ganadores):
+        return
+    idx, avance = divmod(int(transcurrido), DURACION_POR_PREMIO)
+    datos = _datos_tiempo(ganadores, idx, avance)
+    await emit_live_prize_drawing(sorteo_id, {**datos, 'duracion_segundos': DURACION_POR_PREMIO}, room=sid)
+    await emit_live_time_update(sorteo_id, datos, room=sid)
+
+def obtener_metricas() -> dict:
+    """Precisión del ticker en este worker"""
+    return {
+        'animaciones_activas': len(active_animations),
+        'ticks': _metricas['ticks'],
+        'desfase_max_ms': round(_metricas['desfase_max_ms'], 1),
+        'fuera_de_tolerancia': _metricas['fuera_de_tolerancia'],
+        'tolerancia_ms': TOLERANCIA_TICK_MS
+    }
+
+async def finalizar_animacion(sorteo_id: str, animacion: AnimacionLive):
+    """Aplicar el cierre de la animación: COMPLETED o siguiente etapa"""
+    from websocket_manager import emit_sorteo_state_changed
+    
+    sorteo = animacion.sorteo
+    ganadores = animacion.ganadores
     
     # Determinar siguiente estado
+    medicion = timeline_transiciones.MedicionTransicion(sorteo_id, 'animacion')
+    token = await medicion.db(particion_sorteos.token_ciclo())
+    if token is None:
+        logger.warning(f"⚠️  Cierre de animación de sorteo {sorteo_id} omitido: sin lease de líder vigente")
+        return
+    # Compare-and-set: solo avanza si el sorteo sigue LIVE (un admin pudo completarlo)
+    filtro_live = {'id': sorteo_id, 'estado': SorteoEstado.LIVE, **liderazgo.filtro_token(token)}
     if sorteo.tipo == SorteoTipo.ETAPAS:
         # Para sorteos por etapas
         etapa_actual_num = sorteo.etapa_actual
@@ -167,42 +389,57 @@ async def ejecutar_animacion_live(sorteo_id: str):
         if es_ultima_etapa:
             # Última etapa → COMPLETED
             nuevo_estado = SorteoEstado.COMPLETED
-            await db.sorteos.update_one(
-                {'id': sorteo_id},
-                {'$set': {
-                    'estado': nuevo_estado,
-                    'fecha_completed': datetime.now(timezone.utc)
-                }}
-            )
-            logger.info(f"Sorteo {sorteo_id} completado (última etapa)")
+            update_data = {
+                'estado': nuevo_estado,
+                'fecha_completed': reloj.ahora()
+            }
         else:
             # Etapa intermedia → volver a PUBLISHED para siguiente etapa
             nuevo_estado = SorteoEstado.PUBLISHED
-            await db.sorteos.update_one(
-                {'id': sorteo_id},
-                {'$set': {
-                    'estado': nuevo_estado,
-                    'etapa_actual': etapa_actual_num + 1,
-                    'fecha_live': None,
-                    'fecha_waiting': None
-                }}
-            )
-            logger.info(f"Sorteo {sorteo_id} vuelve a PUBLISHED para etapa {etapa_actual_num + 1}")
-        
-        await emit_sorteo_state_changed(sorteo_id, nuevo_estado)
-    
+            update_data = {
+                'estado': nuevo_estado,
+                'etapa_actual': etapa_actual_num + 1,
+                'fecha_live': None,
+                'fecha_waiting': None
+            }
     else:
         # Sorteo único → COMPLETED
         nuevo_estado = SorteoEstado.COMPLETED
-        await db.sorteos.update_one(
-            {'id': sorteo_id},
-            {'$set': {
-                'estado': nuevo_estado,
-                'fecha_completed': datetime.now(timezone.utc)
-            }}
-        )
+        update_data = {
+            'estado': nuevo_estado,
+            'fecha_completed': reloj.ahora()
+        }
+    
+    result = await medicion.db(db.sorteos.update_one(
+        filtro_live,
+        {'$set': {**update_data, **liderazgo.set_token(token)}, '$inc': {'version': 1}}
+    ))
+    cache_sorteos.invalidar(sorteo_id)
+    if result.modified_count == 0:
+        logger.info(f"Sorteo {sorteo_id} ya no está LIVE, no se aplica el cierre de la animación")
+        return
+    
+    if nuevo_estado == SorteoEstado.PUBLISHED:
+        logger.info(f"Sorteo {sorteo_id} vuelve a PUBLISHED para etapa {sorteo.etapa_actual + 1}")
+    else:
         logger.info(f"Sorteo {sorteo_id} completado")
-        await emit_sorteo_state_changed(sorteo_id, nuevo_estado)
+    await emit_sorteo_state_changed(sorteo_id, nuevo_estado)
+    
+    # El actor del sorteo (si está en este worker) recarga su estado
+    from actores_sorteo import notificar_cambio
+    notificar_cambio(sorteo_id)
+    
+    # La siguiente etapa puede tener vencimiento propio
+    from state_checker_service import reprogramar_sorteo
+    await medicion.db(reprogramar_sorteo(sorteo_id))
+    
+    # La animación debía terminar a los 2 minutos por premio desde fecha_live
+    fin_programado = None
+    if sorteo.fecha_live:
+        fin_programado = sorteo.fecha_live + timedelta(seconds=DURACION_POR_PREMIO * len(ganadores))
+        if fin_programado.tzinfo is None:
+            fin_programado = fin_programado.replace(tzinfo=timezone.utc)
+    await timeline_transiciones.registrar(medicion, SorteoEstado.LIVE, nuevo_estado, vencimiento=fin_programado)
     
     # Guardar ganadores en colección separada
     await guardar_ganadores_db(sorteo_id, ganadores, sorteo.titulo)
@@ -218,7 +455,7 @@ async def guardar_ganadores_db(sorteo_id: str, ganadores: list, sorteo_titulo: s
             'usuario_id': ganador['usuario_id'],
             'premio': ganador['premio'],
             'numero_boleto': ganador['numero_boleto'],
-            'fecha_sorteo': datetime.now(timezone.utc).isoformat(),
+            'fecha_sorteo': reloj.ahora().isoformat(),
             'notificado': False
         }
         
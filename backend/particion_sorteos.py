@@ -0,0 +1,156 @@
+"""
+Reparto de los sorteos activos entre los workers (PARTICION_HABILITADA=true)
+
+Cada worker se registra en la colección 'workers' y renueva su registro cada
+LEASE_HEARTBEAT_SEGUNDOS; un registro sin renovar durante LEASE_DURACION_SEGUNDOS
+se considera muerto. El dueño de un sorteo se elige con rendezvous hashing sobre los
+workers vivos: todos calculan el mismo dueño sin coordinarse, y cuando un worker
+entra o muere solo se mueven los sorteos que le tocaban.
+
+El programador de transiciones, los countdowns de WAITING y las animaciones LIVE
+corren en todos los workers, cada uno solo para sus sorteos (es_propietario).
+Durante un cambio de miembros dos workers pueden creer por unos segundos que son
+dueños del mismo sorteo; las transiciones son compare-and-set, así que no se duplican.
+
+Deshabilitado, es_propietario equivale a liderazgo.es_lider(): el líder atiende todo.
+"""
+import asyncio
+from datetime import timedelta
+import hashlib
+import logging
+import os
+from typing import Callable, List, Optional
+
+import liderazgo
+import reloj
+
+logger = logging.getLogger(__name__)
+
+db = None
+
+PARTICION_HABILITADA = os.environ.get('PARTICION_HABILITADA', 'false').lower() == 'true'
+INDICE_LIMPIEZA = 'workers_limpieza_ttl'
+
+_miembros: List[str] = []
+# Aumenta cada vez que cambia el conjunto de workers vivos (para reconstruir lo propio)
+_generacion = 0
+_servicios: List[liderazgo.ServicioSingleton] = []
+_tarea_heartbeat: Optional[asyncio.Task] = None
+
+def init_particion(database):
+    global db
+    db = database
+
+async def asegurar_indices():
+    await db.workers.create_index(
+        'renovado_en',
+        name=INDICE_LIMPIEZA,
+        expireAfterSeconds=liderazgo.LIMPIEZA_SEGUNDOS
+    )
+
+def _peso(worker_id: str, sorteo_id: str) -> int:
+    """Peso estable entre procesos (no se usa hash() porque cambia por proceso)"""
+    digest = hashlib.blake2b(f"{worker_id}:{sorteo_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+def propietario(sorteo_id: str) -> Optional[str]:
+    """Worker dueño del sorteo según los miembros vivos conocidos"""
+    if not _miembros:
+        return None
+    return max(_miembros, key=lambda worker_id: _peso(worker_id, sorteo_id))
+
+def es_propietario(sorteo_id: str) -> bool:
+    """Si este worker debe ejecutar el trabajo en background de este sorteo"""
+    if not PARTICION_HABILITADA:
+        return liderazgo.es_lider()
+    return propietario(sorteo_id) == liderazgo.WORKER_ID
+
+async def token_ciclo() -> Optional[int]:
+    """
+    Token de fencing para un ciclo de un servicio por sorteo. Con el reparto activo
+    es 0 (no hay líder: cada dueño escribe con compare-and-set); si no, el token del
+    lease de líder confirmado en Mongo, o None si se perdió.
+    """
+    if PARTICION_HABILITADA:
+        return 0
+    return await liderazgo.token_vigente()
+
+def generacion() -> int:
+    return _generacion
+
+def registrar_servicio(nombre: str, iniciar: Callable, detener: Optional[Callable] = None):
+    """Servicio que corre en todos los workers, filtrando sus sorteos con es_propietario"""
+    _servicios.append(liderazgo.ServicioSingleton(nombre, iniciar, detener))
+
+async def _actualizar_miembros():
+    global _miembros, _generacion
+    ahora = reloj.ahora()
+    await db.workers.update_one(
+        {'_id': liderazgo.WORKER_ID},
+        {'$set': {
+            'renovado_en': ahora,
+            'expira_en': ahora + timedelta(seconds=liderazgo.LEASE_DURACION_SEGUNDOS)
+        }},
+        upsert=True
+    )
+    vivos = await db.workers.find(
+        {'expira_en': {'$gt': ahora}},
+        {'_id': 1}
+    ).to_list(None)
+    miembros = sorted(w['_id'] for w in vivos)
+    if miembros != _miembros:
+        _miembros = miembros
+        _generacion += 1
+        logger.info(f"🔀 Reparto de sorteos: {len(miembros)} worker(s) vivos (generación {_generacion})")
+
+async def _heartbeat():
+    while True:
+        try:
+            await _actualizar_miembros()
+        except Exception as e:
+            logger.error(f"❌ Error renovando registro de worker: {e}")
+        await reloj.dormir(liderazgo.LEASE_HEARTBEAT_SEGUNDOS)
+
+async def iniciar():
+    """Registrar este worker y arrancar los servicios repartidos"""
+    global _tarea_heartbeat
+    await _actualizar_miembros()
+    _tarea_heartbeat = asyncio.create_task(_heartbeat())
+    for servicio in _servicios:
+        try:
+            tareas = servicio.iniciar()
+            if isinstance(tareas, asyncio.Task):
+                tareas = [tareas]
+            servicio.tareas = list(tareas or [])
+        except Exception as e:
+            logger.error(f"❌ Error iniciando servicio {servicio.nombre}: {e}")
+    logger.info(f"✅ Reparto de sorteos iniciado para worker {liderazgo.WORKER_ID}")
+
+async def detener():
+    """Detener los servicios y dar de baja el worker para que otros tomen sus sorteos"""
+    if _tarea_heartbeat:
+        _tarea_heartbeat.cancel()
+    for servicio in _servicios:
+        for tarea in servicio.tareas:
+            tarea.cancel()
+        servicio.tareas = []
+        if servicio.detener:
+            try:
+                resultado = servicio.detener()
+                if asyncio.iscoroutine(resultado):
+                    await resultado
+            except Exception as e:
+                logger.error(f"❌ Error deteniendo servicio {servicio.nombre}: {e}")
+    if PARTICION_HABILITADA and db is not None:
+        try:
+            await db.workers.delete_one({'_id': liderazgo.WORKER_ID})
+        except Exception as e:
+            logger.error(f"❌ Error dando de baja el worker: {e}")
+
+def obtener_metricas() -> dict:
+    return {
+        'habilitada': PARTICION_HABILITADA,
+        'worker_id': liderazgo.WORKER_ID,
+        'miembros': list(_miembros),
+        'generacion': _generacion
+    }
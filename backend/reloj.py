@@ -0,0 +1,52 @@
+"""
+Reloj inyectable de los servicios de sorteos
+
+state_machine, state_checker_service, live_animation_service y
+waiting_countdown_service piden la hora y duermen a través de este módulo.
+En producción usa el reloj real; la simulación (simulacion_sorteos.py) instala
+un reloj virtual con usar() para recorrer horas de sorteos en segundos.
+"""
+import asyncio
+from datetime import datetime, timezone
+import time
+from typing import Optional
+
+
+class RelojReal:
+    def ahora(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    async def dormir(self, segundos: float):
+        await asyncio.sleep(segundos)
+
+    async def esperar_evento(self, evento: asyncio.Event, timeout: Optional[float]) -> bool:
+        """Esperar el evento hasta 'timeout' segundos. Retorna True si se activó."""
+        try:
+            await asyncio.wait_for(evento.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+_reloj = RelojReal()
+
+def usar(reloj):
+    """Reemplazar el reloj (simulaciones)"""
+    global _reloj
+    _reloj = reloj
+
+def ahora() -> datetime:
+    """Hora actual UTC-aware"""
+    return _reloj.ahora()
+
+def monotonic() -> float:
+    return _reloj.monotonic()
+
+async def dormir(segundos: float):
+    await _reloj.dormir(segundos)
+
+async def esperar_evento(evento: asyncio.Event, timeout: Optional[float]) -> bool:
+    return await _reloj.esperar_evento(evento, timeout)
@@ -0,0 +1,292 @@
+"""
+Motor de reservas de números de boleto
+
+Los números de una compra se reclaman de forma atómica insertando los boletos contra
+un índice único (sorteo_id, numero_boleto) que cubre solo las reservas activas.
+Si algún número ya fue tomado por otra compra, se deshacen los boletos insertados
+(todo o nada) y se devuelve la lista de números perdidos.
+
+Las reservas pendientes vencen con 'expira_en' (fecha BSON). El monitor de expiración
+es el que manda: las libera a tiempo y ejecuta los hooks que actualizan contadores y
+disponibilidad. El índice TTL es solo un respaldo por si el monitor no corre, y borra
+sin ejecutar los hooks; por eso actúa TTL_GRACIA_SEGUNDOS después del vencimiento,
+bastante más que la espera máxima del monitor, para no adelantársele.
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+import logging
+import os
+from typing import Callable, Dict, List
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+import liderazgo
+
+logger = logging.getLogger(__name__)
+
+db = None
+
+INDICE_RESERVA_UNICA = 'reserva_unica_sorteo_numero'
+INDICE_EXPIRACION = 'expiracion_reservas_ttl'
+CODIGO_CLAVE_DUPLICADA = 11000
+CODIGO_CONFLICTO_OPCIONES_INDICE = 85
+# Actualizaciones por bulk_write al migrar reservas antiguas
+LOTE_MIGRACION = 1000
+# Boletos vencidos leídos y borrados por vuelta al liberar reservas
+LOTE_EXPIRACION = 1000
+
+# Tiempo que un boleto pendiente mantiene su número
+DURACION_RESERVA = timedelta(hours=24)
+
+# Espera máxima del monitor entre revisiones (por si otro worker creó reservas)
+MONITOR_ESPERA_MAXIMA_SEGUNDOS = 60
+
+# El índice TTL borra las reservas vencidas hace más de este tiempo (respaldo del monitor)
+TTL_GRACIA_SEGUNDOS = max(
+    int(os.environ.get('RESERVAS_TTL_GRACIA_SEGUNDOS', '3600')),
+    2 * MONITOR_ESPERA_MAXIMA_SEGUNDOS
+)
+
+# Funciones async (sorteo_id, numeros) llamadas cuando vencen reservas de un sorteo
+_hooks_expiracion: List[Callable] = []
+
+
+class BoletosNoDisponibles(Exception):
+    """No se pudieron registrar algunos números por un error distinto de un choque con otra compra"""
+
+    def __init__(self, numeros: List[int]):
+        super().__init__(f"No se pudieron registrar los números: {', '.join(map(str, numeros))}")
+        self.numeros = numeros
+
+
+def init_reservas(database):
+    global db
+    db = database
+
+def registrar_hook_expiracion(hook: Callable):
+    """Registrar una función async (sorteo_id, numeros) para cuando vencen reservas"""
+    _hooks_expiracion.append(hook)
+
+async def asegurar_indices():
+    """
+    Crear el índice único de reservas activas y el índice TTL de expiración.
+    Los boletos antiguos no tienen 'reserva_activa' y quedan fuera del índice único,
+    así que duplicados históricos no impiden crearlo.
+    """
+    await db.boletos.create_index(
+        [('sorteo_id', 1), ('numero_boleto', 1)],
+        name=INDICE_RESERVA_UNICA,
+        unique=True,
+        partialFilterExpression={'reserva_activa': True}
+    )
+    try:
+        await db.boletos.create_index(
+            'expira_en',
+            name=INDICE_EXPIRACION,
+            expireAfterSeconds=TTL_GRACIA_SEGUNDOS
+        )
+    except OperationFailure as e:
+        if e.code != CODIGO_CONFLICTO_OPCIONES_INDICE:
+            raise
+        # El índice existe con otra gracia (p.ej. 0 de versiones anteriores): ajustarla
+        await db.command('collMod', 'boletos', index={
+            'name': INDICE_EXPIRACION,
+            'expireAfterSeconds': TTL_GRACIA_SEGUNDOS
+        })
+    await migrar_reservas_sin_expiracion()
+    logger.info("Índices de reservas de boletos asegurados")
+
+async def migrar_reservas_sin_expiracion():
+    """
+    Asignar 'expira_en' a boletos pendientes antiguos que solo tienen fecha_compra (ISO),
+    en lotes de bulk_write de LOTE_MIGRACION actualizaciones
+    """
+    cursor = db.boletos.find(
+        {'pago_confirmado': False, 'expira_en': {'$exists': False}},
+        {"_id": 0, "id": 1, "fecha_compra": 1}
+    )
+
+    ahora = datetime.now(timezone.utc)
+    lote = []
+    migrados = 0
+    async for boleto in cursor:
+        fecha_compra = boleto.get('fecha_compra')
+        if isinstance(fecha_compra, str):
+            fecha_compra = datetime.fromisoformat(fecha_compra.replace('Z', '+00:00'))
+        if fecha_compra and fecha_compra.tzinfo is None:
+            fecha_compra = fecha_compra.replace(tzinfo=timezone.utc)
+        # Sin fecha de compra la reserva se considera vencida
+        expira_en = fecha_compra + DURACION_RESERVA if fecha_compra else ahora
+
+        lote.append(UpdateOne({'id': boleto['id']}, {'$set': {'expira_en': expira_en}}))
+        if len(lote) >= LOTE_MIGRACION:
+            migrados += (await db.boletos.bulk_write(lote, ordered=False)).modified_count
+            lote = []
+    if lote:
+        migrados += (await db.boletos.bulk_write(lote, ordered=False)).modified_count
+
+    if migrados:
+        logger.info(f"Asignada expiración a {migrados} boletos pendientes antiguos")
+
+def calcular_expiracion(desde: datetime = None) -> datetime:
+    """Fecha en que vence una reserva creada ahora"""
+    return (desde or datetime.now(timezone.utc)) + DURACION_RESERVA
+
+def filtro_reserva_activa(ahora: datetime = None) -> dict:
+    """Filtro de boletos que ocupan su número: aprobados o pendientes sin vencer"""
+    return {'$or': [
+        {'pago_confirmado': True},
+        {'expira_en': {'$gt': ahora or datetime.now(timezone.utc)}}
+    ]}
+
+async def insertar_en_lote(coleccion, docs: List[dict]) -> Dict[int, int]:
+    """
+    Insertar documentos con un solo insert_many no ordenado.
+    Retorna {índice del documento: código de error} de los que fallaron (vacío si todo se insertó).
+    """
+    if not docs:
+        return {}
+    try:
+        await coleccion.insert_many(docs, ordered=False)
+        return {}
+    except BulkWriteError as e:
+        return {err['index']: err.get('code') for err in e.details.get('writeErrors', [])}
+
+async def liberar_reservas_expiradas(filtro_adicional: dict = None) -> int:
+    """
+    Eliminar boletos pendientes cuya reserva venció y ejecutar los hooks por sorteo,
+    en lotes de LOTE_EXPIRACION. Usa el índice de 'expira_en', no recorre toda la colección.
+    """
+    query = {
+        'pago_confirmado': False,
+        'expira_en': {'$lte': datetime.now(timezone.utc)}
+    }
+    if filtro_adicional:
+        query.update(filtro_adicional)
+
+    total = 0
+    while True:
+        vencidos = await db.boletos.find(
+            query,
+            {"_id": 0, "id": 1, "sorteo_id": 1, "numero_boleto": 1}
+        ).to_list(LOTE_EXPIRACION)
+        if not vencidos:
+            break
+
+        ids = [b['id'] for b in vencidos]
+        # Repetir la condición evita borrar un boleto aprobado mientras tanto
+        result = await db.boletos.delete_many({'id': {'$in': ids}, 'pago_confirmado': False})
+        total += result.deleted_count
+
+        if result.deleted_count < len(vencidos):
+            # Los que siguen existiendo se aprobaron entre la lectura y el borrado:
+            # su número está vendido y los hooks no deben liberarlo
+            siguen = await db.boletos.find({'id': {'$in': ids}}, {"_id": 0, "id": 1}).to_list(None)
+            aprobados = {b['id'] for b in siguen}
+            vencidos = [b for b in vencidos if b['id'] not in aprobados]
+
+        await _ejecutar_hooks_expiracion(vencidos)
+
+        if len(ids) < LOTE_EXPIRACION:
+            break
+
+    if total:
+        logger.info(f"Liberadas {total} reservas expiradas")
+    return total
+
+async def _ejecutar_hooks_expiracion(borrados: List[dict]):
+    numeros_por_sorteo: Dict[str, List[int]] = {}
+    for boleto in borrados:
+        numeros_por_sorteo.setdefault(boleto['sorteo_id'], []).append(boleto['numero_boleto'])
+
+    for sorteo_id, numeros in numeros_por_sorteo.items():
+        for hook in _hooks_expiracion:
+            try:
+                await hook(sorteo_id, numeros)
+            except Exception as e:
+                logger.error(f"Error en hook de expiración para sorteo {sorteo_id}: {e}")
+
+async def _liberar_reservas_vencidas(sorteo_id: str, numeros: List[int]) -> int:
+    """Eliminar boletos pendientes vencidos que todavía ocupan alguno de los números"""
+    return await liberar_reservas_expiradas({
+        'sorteo_id': sorteo_id,
+        'numero_boleto': {'$in': numeros}
+    })
+
+async def reservar_boletos(boletos_docs: List[dict]) -> List[int]:
+    """
+    Insertar los boletos de una compra reclamando sus números (todo o nada).
+    Retorna la lista de números perdidos; vacía si la reserva fue exitosa.
+    Lanza BoletosNoDisponibles si la inserción falló por otro motivo (la compra se deshace igual).
+    Todos los boletos deben pertenecer al mismo sorteo.
+    """
+    if not boletos_docs:
+        return []
+
+    sorteo_id = boletos_docs[0]['sorteo_id']
+
+    # Los números vencidos se liberan antes de reclamar para no chocar con el índice
+    await _liberar_reservas_vencidas(sorteo_id, [b['numero_boleto'] for b in boletos_docs])
+
+    fallidos = await insertar_en_lote(db.boletos, boletos_docs)
+    if not fallidos:
+        return []
+
+    # Deshacer los boletos que sí se insertaron: la compra es todo o nada
+    insertados = [b['id'] for i, b in enumerate(boletos_docs) if i not in fallidos]
+    if insertados:
+        await db.boletos.delete_many({'id': {'$in': insertados}})
+
+    numeros_con_error = sorted(
+        boletos_docs[i]['numero_boleto'] for i, codigo in fallidos.items()
+        if codigo != CODIGO_CLAVE_DUPLICADA
+    )
+    if numeros_con_error:
+        logger.error(f"Error inesperado reservando boletos del sorteo {sorteo_id}: números {numeros_con_error}")
+        raise BoletosNoDisponibles(numeros_con_error)
+
+    perdidos = sorted(boletos_docs[i]['numero_boleto'] for i in fallidos)
+    logger.info(f"Sorteo {sorteo_id}: reserva rechazada, números perdidos {perdidos}")
+    return perdidos
+
+# ============ MONITOR DE EXPIRACIÓN ============
+async def monitorear_expiraciones():
+    """
+    Dormir hasta la próxima expiración de reserva y liberarla en ese momento.
+    El índice TTL borra igual las reservas vencidas si este monitor no corre.
+    """
+    while True:
+        try:
+            # Confirmar el lease antes de cada ciclo: un líder que lo perdió no libera
+            if await liderazgo.token_vigente() is None:
+                await asyncio.sleep(MONITOR_ESPERA_MAXIMA_SEGUNDOS)
+                continue
+
+            await liberar_reservas_expiradas()
+
+            proxima = await db.boletos.find_one(
+                {'pago_confirmado': False, 'expira_en': {'$exists': True}},
+                {"_id": 0, "expira_en": 1},
+                sort=[('expira_en', 1)]
+            )
+
+            espera = MONITOR_ESPERA_MAXIMA_SEGUNDOS
+            if proxima:
+                expira_en = proxima['expira_en']
+                if expira_en.tzinfo is None:
+                    expira_en = expira_en.replace(tzinfo=timezone.utc)
+                segundos = (expira_en - datetime.now(timezone.utc)).total_seconds()
+                espera = min(max(segundos, 0.5), MONITOR_ESPERA_MAXIMA_SEGUNDOS)
+
+            await asyncio.sleep(espera)
+
+        except Exception as e:
+            logger.error(f"Error en monitor de expiración de reservas: {e}")
+            await asyncio.sleep(MONITOR_ESPERA_MAXIMA_SEGUNDOS)
+
+def iniciar_expiracion_reservas():
+    """Iniciar tarea en background"""
+    tarea = asyncio.create_task(monitorear_expiraciones())
+    logger.info("✅ Monitor de expiración de reservas iniciado")
+    return tarea
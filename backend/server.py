@@ -15,6 +15,7 @@ import jwt
 import random
 import httpx
 from enum import Enum
+from collections import Counter
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -43,12 +44,26 @@ FROM_EMAIL = os.environ.get('FROM_EMAIL', SMTP_USER)
 FROM_NAME = os.environ.get('FROM_NAME', 'WishWay Sorteos')
 
 # Import WebSocket manager
+import websocket_manager
 from websocket_manager import sio, emit_sorteo_state_changed, emit_sorteo_updated, broadcast_sorteos_update, emit_live_animation_start, emit_live_prize_drawing, emit_live_winner_announced, emit_live_animation_complete, emit_ventas_pausadas
 
 # Import state machine and live service
 import state_machine
 import live_animation_service
 import vendedor_endpoints
+import inventario_boletos
+import reservas_boletos
+import contadores_sorteo
+import cola_compras
+import idempotencia
+import state_checker_service
+import liderazgo
+import actores_sorteo
+import timeline_transiciones
+import cache_sorteos
+import particion_sorteos
+import waiting_countdown_service
+import gestores_socketio
 
 # Create the main app
 app = FastAPI()
@@ -232,6 +247,9 @@ class ComisionEstado(str, Enum):
 # ============ MODELS ============
 class ValidarNumeroRequest(BaseModel):
     numero: int
+
+class ValidarNumerosRequest(BaseModel):
+    numeros: List[int]
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore", populate_by_name=True)
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -310,6 +328,8 @@ class Sorteo(BaseModel):
     ganadores: List[dict] = []  # Lista de ganadores seleccionados
     ventas_pausadas: bool = False  # Para pausar/despausar ventas en estado PUBLISHED
     etapa_actual: int = 0  # Etapa actual para sorteos por etapas (0 = no iniciado)
+    umbrales_etapas: List[int] = []  # Boletos aprobados que dispara cada etapa (se calcula al publicar/editar)
+    version: int = 0  # Aumenta en cada cambio de estado (compare-and-set de transiciones)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class Boleto(BaseModel):
@@ -329,6 +349,8 @@ class Boleto(BaseModel):
     pago_confirmado: bool = False
     comprobante_url: Optional[str] = None
     numero_comprobante: Optional[str] = None
+    reserva_activa: bool = True  # Cubierto por el índice único (sorteo_id, numero_boleto)
+    expira_en: Optional[datetime] = None  # Vencimiento de la reserva pendiente (índice TTL)
 
 class Ganador(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -937,25 +959,20 @@ async def cambiar_password(request: Request, password_actual: str, password_nuev
 
 # ============ BACKGROUND JOBS ============
 async def liberar_boletos_expirados():
-    """Liberar boletos pendientes que tienen más de 24 horas"""
+    """Liberar boletos pendientes cuya reserva de 24 horas venció (expira_en)"""
     try:
-        # Calcular fecha límite (24 horas atrás)
-        fecha_limite = datetime.now(timezone.utc) - timedelta(hours=24)
-        
-        # Buscar boletos pendientes antiguos
-        result = await db.boletos.delete_many({
-            'pago_confirmado': False,
-            'fecha_compra': {'$lt': fecha_limite}
-        })
-        
-        if result.deleted_count > 0:
-            logging.info(f"Liberados {result.deleted_count} boletos expirados")
-        
-        return result.deleted_count
+        return await reservas_boletos.liberar_reservas_expiradas()
     except Exception as e:
         logging.error(f"Error al liberar boletos: {str(e)}")
         return 0
 
+async def al_expirar_reservas(sorteo_id: str, numeros: List[int]):
+    """
+    Hook de expiración: liberar números en el inventario.
+    Solo vencen boletos pendientes, que no cuentan en cantidad_vendida.
+    """
+    inventario_boletos.registrar_liberacion(sorteo_id, numeros)
+
 async def limpiar_sorteos_completados_antiguos():
     """Eliminar sorteos completados y sus datos después de 30 días"""
     try:
@@ -985,6 +1002,8 @@ async def limpiar_sorteos_completados_antiguos():
             
             # Eliminar el sorteo
             await db.sorteos.delete_one({'id': sorteo_id})
+            cache_sorteos.invalidar(sorteo_id)
+            inventario_boletos.descartar_inventario(sorteo_id)
             sorteos_eliminados += 1
         
         if sorteos_eliminados > 0:
@@ -1000,30 +1019,21 @@ async def limpiar_sorteos_completados_antiguos():
         return {'sorteos': 0, 'boletos': 0, 'ganadores': 0}
 
 # ============ HELPER FUNCTIONS ============
-async def actualizar_progreso_sorteo(sorteo_id: str):
-    """Actualizar cantidad vendida y progreso basado en boletos aprobados"""
-    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id})
-    if not sorteo_doc:
-        return
-    
-    # Contar solo boletos aprobados (pago_confirmado=True)
-    boletos_aprobados = await db.boletos.count_documents({
-        'sorteo_id': sorteo_id,
-        'pago_confirmado': True
-    })
-    
-    cantidad_total = sorteo_doc['cantidad_total_boletos']
-    progreso = (boletos_aprobados / cantidad_total) * 100 if cantidad_total > 0 else 0
+async def obtener_numeros_ocupados(sorteo_id: str, numeros: List[int]) -> set:
+    """Devolver cuáles de los números están vendidos o reservados (una sola consulta con $in)"""
+    if not numeros:
+        return set()
     
-    await db.sorteos.update_one(
-        {'id': sorteo_id},
-        {'$set': {
-            'cantidad_vendida': boletos_aprobados,
-            'progreso_porcentaje': progreso
-        }}
-    )
+    boletos = await db.boletos.find(
+        {
+            'sorteo_id': sorteo_id,
+            'numero_boleto': {'$in': list(set(numeros))},
+            **reservas_boletos.filtro_reserva_activa()
+        },
+        {"_id": 0, "numero_boleto": 1}
+    ).to_list(None)
     
-    return boletos_aprobados, progreso
+    return {b['numero_boleto'] for b in boletos}
 
 async def verificar_transicion_estado(sorteo_id: str):
     """Verificar y ejecutar transiciones automáticas de estado - LÓGICA COMPLETA"""
@@ -1096,8 +1106,9 @@ async def verificar_transicion_estado(sorteo_id: str):
         
         await db.sorteos.update_one(
             {'id': sorteo_id},
-            {'$set': update_data}
+            {'$set': update_data, '$inc': {'version': 1}}
         )
+        cache_sorteos.invalidar(sorteo_id)
         logging.info(f"Sorteo {sorteo_id} cambió de estado: {estado_actual} → {nuevo_estado}")
         
         return nuevo_estado
@@ -1233,6 +1244,7 @@ async def create_sorteo(data: SorteoCreate, request: Request):
     sorteo_dict['created_at'] = sorteo_dict['created_at'].isoformat()
     
     await db.sorteos.insert_one(sorteo_dict)
+    await state_checker_service.reprogramar_sorteo(sorteo.id)
     return sorteo
 
 @api_router.get("/sorteos", response_model=List[Sorteo])
@@ -1334,28 +1346,11 @@ async def get_participantes_sorteo(sorteo_id: str):
 
 @api_router.get("/sorteos/{sorteo_id}", response_model=Sorteo)
 async def get_sorteo(sorteo_id: str):
-    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id}, {"_id": 0})
-    if not sorteo_doc:
+    # Caché en proceso (convierte fechas y mantiene compatibilidad con sorteos antiguos)
+    sorteo = await cache_sorteos.obtener(sorteo_id)
+    if not sorteo:
         raise HTTPException(status_code=404, detail="Sorteo no encontrado")
-    
-    # Convertir fechas (compatibilidad con sorteos antiguos)
-    if sorteo_doc.get('fecha_cierre') and isinstance(sorteo_doc['fecha_cierre'], str):
-        sorteo_doc['fecha_cierre'] = datetime.fromisoformat(sorteo_doc['fecha_cierre'])
-    if sorteo_doc.get('created_at') and isinstance(sorteo_doc['created_at'], str):
-        sorteo_doc['created_at'] = datetime.fromisoformat(sorteo_doc['created_at'])
-    
-    # Compatibilidad: si existe fecha_inicio pero no fecha_cierre, usar fecha_inicio
-    if sorteo_doc.get('fecha_inicio') and not sorteo_doc.get('fecha_cierre'):
-        if isinstance(sorteo_doc['fecha_inicio'], str):
-            sorteo_doc['fecha_cierre'] = datetime.fromisoformat(sorteo_doc['fecha_inicio'])
-        else:
-            sorteo_doc['fecha_cierre'] = sorteo_doc['fecha_inicio']
-    
-    for etapa in sorteo_doc.get('etapas', []):
-        if etapa.get('fecha_sorteo') and isinstance(etapa['fecha_sorteo'], str):
-            etapa['fecha_sorteo'] = datetime.fromisoformat(etapa['fecha_sorteo'])
-    
-    return Sorteo(**sorteo_doc)
+    return sorteo
 
 @api_router.put("/admin/sorteo/{sorteo_id}")
 async def update_sorteo(sorteo_id: str, data: SorteoCreate, request: Request):
@@ -1378,11 +1373,14 @@ async def update_sorteo(sorteo_id: str, data: SorteoCreate, request: Request):
     # Update sorteo
     update_data = data.model_dump()
     update_data['fecha_cierre'] = update_data['fecha_cierre'].isoformat()
+    update_data['umbrales_etapas'] = state_machine.calcular_umbrales_etapas(update_data)
     
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': update_data}
+        {'$set': update_data, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
+    await state_checker_service.reprogramar_sorteo(sorteo_id)
     
     return {"message": "Sorteo actualizado exitosamente"}
 
@@ -1426,11 +1424,14 @@ async def eliminar_sorteo(sorteo_id: str, request: Request):
     
     # Delete sorteo
     await db.sorteos.delete_one({'id': sorteo_id})
+    cache_sorteos.invalidar(sorteo_id)
     
     # Also delete related boletos and comisiones if no tickets (safety check)
     await db.boletos.delete_many({'sorteo_id': sorteo_id})
     await db.comisiones.delete_many({'sorteo_id': sorteo_id})
     await db.ganadores.delete_many({'sorteo_id': sorteo_id})
+    inventario_boletos.descartar_inventario(sorteo_id)
+    state_checker_service.descartar_sorteo(sorteo_id)
     
     return {"message": "Sorteo eliminado exitosamente"}
 
@@ -1448,10 +1449,20 @@ async def publicar_sorteo(sorteo_id: str, request: Request):
     if sorteo_doc['estado'] != 'draft':
         raise HTTPException(status_code=400, detail="Solo se pueden publicar sorteos en borrador")
     
-    await db.sorteos.update_one(
-        {'id': sorteo_id},
-        {'$set': {'estado': 'published'}}
+    result = await db.sorteos.update_one(
+        {'id': sorteo_id, 'estado': 'draft'},
+        {
+            '$set': {
+                'estado': 'published',
+                'umbrales_etapas': state_machine.calcular_umbrales_etapas(sorteo_doc)
+            },
+            '$inc': {'version': 1}
+        }
     )
+    cache_sorteos.invalidar(sorteo_id)
+    if result.modified_count == 0:
+        raise HTTPException(status_code=409, detail="El sorteo cambió de estado mientras se publicaba")
+    await state_checker_service.reprogramar_sorteo(sorteo_id)
     
     return {"message": "Sorteo publicado exitosamente"}
 
@@ -1471,8 +1482,11 @@ async def pausar_despausar_ventas(sorteo_id: str, pausar: bool, request: Request
     
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': {'ventas_pausadas': pausar}}
+        {'$set': {'ventas_pausadas': pausar}, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
+    await state_checker_service.reprogramar_sorteo(sorteo_id)
+    actores_sorteo.notificar_cambio(sorteo_id)
     
     # Emitir evento WebSocket
     await emit_ventas_pausadas(sorteo_id, pausar)
@@ -1502,8 +1516,9 @@ async def ajustar_minimo_boletos(sorteo_id: str, minimo: int, request: Request):
         {'$set': {
             'minimo_boletos': minimo,
             'cantidad_minima_boletos': minimo  # Actualizar ambos campos para compatibilidad
-        }}
+        }, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
     
     logger.info(f"Admin {admin.email} ajustó mínimo de boletos del sorteo {sorteo_id} a {minimo}")
     
@@ -1545,8 +1560,9 @@ async def actualizar_imagen_promo(sorteo_id: str, data: ActualizarImagenPromoReq
     
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': {'imagenes': imagenes}}
+        {'$set': {'imagenes': imagenes}, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
     
     logger.info(f"Admin {admin.email} actualizó imagen promocional {data.index} del sorteo {sorteo_id}")
     await broadcast_sorteos_update()
@@ -1572,8 +1588,9 @@ async def actualizar_imagenes_promo(sorteo_id: str, data: ActualizarImagenesProm
     
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': {'imagenes': data.imagenes}}
+        {'$set': {'imagenes': data.imagenes}, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
     
     logger.info(f"Admin {admin.email} actualizó imágenes promocionales del sorteo {sorteo_id}: {len(data.imagenes)} imágenes")
     await broadcast_sorteos_update()
@@ -1604,8 +1621,9 @@ async def actualizar_premio_imagen(sorteo_id: str, data: ActualizarPremioImagenR
     
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': {'premios': premios}}
+        {'$set': {'premios': premios}, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
     
     logger.info(f"Admin {admin.email} actualizó imagen de premio {data.premio_index} del sorteo {sorteo_id}")
     await broadcast_sorteos_update()
@@ -1636,8 +1654,9 @@ async def actualizar_premio_video(sorteo_id: str, data: ActualizarPremioVideoReq
     
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': {'premios': premios}}
+        {'$set': {'premios': premios}, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
     
     logger.info(f"Admin {admin.email} actualizó video de premio {data.premio_index} del sorteo {sorteo_id}")
     await broadcast_sorteos_update()
@@ -1682,8 +1701,9 @@ async def actualizar_etapa_premio_imagen(sorteo_id: str, data: ActualizarEtapaPr
     
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': {'etapas': etapas}}
+        {'$set': {'etapas': etapas}, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
     
     logger.info(f"Admin {admin.email} actualizó imagen de premio {data.premio_index} en etapa {data.etapa_index} del sorteo {sorteo_id}")
     await broadcast_sorteos_update()
@@ -1718,8 +1738,9 @@ async def actualizar_etapa_premio_video(sorteo_id: str, data: ActualizarEtapaPre
     
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': {'etapas': etapas}}
+        {'$set': {'etapas': etapas}, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
     
     logger.info(f"Admin {admin.email} actualizó video de premio {data.premio_index} en etapa {data.etapa_index} del sorteo {sorteo_id}")
     await broadcast_sorteos_update()
@@ -1730,22 +1751,9 @@ async def actualizar_etapa_premio_video(sorteo_id: str, data: ActualizarEtapaPre
 async def actualizar_estados_automatico():
     """Verificar y actualizar estados de todos los sorteos activos (para llamar periódicamente)"""
     try:
-        # Obtener sorteos en PUBLISHED, WAITING y LIVE
-        sorteos_activos = await db.sorteos.find({
-            'estado': {'$in': ['published', 'waiting', 'live']}
-        }).to_list(1000)
-        
-        actualizaciones = 0
-        for sorteo_doc in sorteos_activos:
-            # Usar la nueva máquina de estados
-            resultado = await state_machine.verificar_transicion_estado_nuevo(sorteo_doc['id'])
-            if resultado:
-                actualizaciones += 1
-                
-                # Si cambió a LIVE, iniciar animación
-                if resultado == 'live':
-                    asyncio.create_task(live_animation_service.iniciar_animacion_live(sorteo_doc['id']))
-                    logger.info(f"Iniciando animación LIVE para sorteo {sorteo_doc['id']}")
+        # Evaluación en lote: una consulta de sorteos + una agregación de aprobados
+        transiciones = await state_checker_service.evaluar_en_lote(disparador='admin')
+        actualizaciones = len(transiciones)
         
         # Emitir actualización global
         if actualizaciones > 0:
@@ -1756,9 +1764,21 @@ async def actualizar_estados_automatico():
         logging.error(f"Error al actualizar estados: {str(e)}")
         return {"error": str(e)}
 
+@api_router.get("/admin/metricas/verificador-estados")
+async def get_metricas_verificador_estados(request: Request):
+    """Duración de los barridos de estados vs sorteos activos y vencimientos programados"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    return {
+        **state_checker_service.obtener_metricas(),
+        "programacion": state_checker_service.obtener_programacion()
+    }
+
 @api_router.post("/admin/liberar-boletos-expirados")
 async def ejecutar_liberacion_boletos(request: Request):
-    """Liberar boletos pendientes con más de 24 horas (job manual)"""
+    """Liberar boletos pendientes con la reserva vencida (el monitor de expiración ya lo hace solo)"""
     admin = await get_current_user(request)
     if admin.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Solo admins")
@@ -1766,6 +1786,101 @@ async def ejecutar_liberacion_boletos(request: Request):
     count = await liberar_boletos_expirados()
     return {"message": f"Se liberaron {count} boletos expirados"}
 
+@api_router.post("/admin/sorteo/{sorteo_id}/reconstruir-inventario")
+async def reconstruir_inventario_sorteo(sorteo_id: str, request: Request):
+    """Regenerar el índice de disponibilidad de un sorteo desde la colección boletos"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    inventario = await inventario_boletos.reconstruir_inventario(sorteo_id)
+    if not inventario:
+        raise HTTPException(status_code=404, detail="Sorteo no encontrado")
+    
+    return {
+        "message": "Inventario reconstruido",
+        "vendidos": inventario.cantidad_vendidos,
+        "reservados": inventario.cantidad_reservados,
+        "libres": inventario.cantidad_libres
+    }
+
+@api_router.post("/admin/reconstruir-inventarios")
+async def reconstruir_inventarios(request: Request):
+    """Regenerar el índice de disponibilidad de todos los sorteos activos"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    cantidad = await inventario_boletos.reconstruir_todos()
+    return {"message": f"Se reconstruyó el inventario de {cantidad} sorteos"}
+
+@api_router.post("/admin/reconciliar-contadores")
+async def ejecutar_reconciliacion_contadores(request: Request):
+    """Recalcular cantidad_vendida de los sorteos activos y reportar las diferencias corregidas"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    diferencias = await contadores_sorteo.reconciliar_contadores()
+    return {
+        "message": f"Se corrigieron {len(diferencias)} contador(es)",
+        "diferencias": diferencias
+    }
+
+@api_router.get("/admin/metricas/transiciones")
+async def get_metricas_transiciones(request: Request):
+    """Histogramas de retraso, duración y tiempo de Mongo de las transiciones por disparador"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    return timeline_transiciones.obtener_metricas()
+
+@api_router.get("/admin/sorteo/{sorteo_id}/timeline")
+async def get_timeline_sorteo(sorteo_id: str, request: Request, limite: int = 100):
+    """Transiciones registradas de un sorteo (más recientes primero)"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    return await timeline_transiciones.obtener_timeline(sorteo_id, min(limite, 1000))
+
+@api_router.get("/admin/metricas/cache-sorteos")
+async def get_metricas_cache_sorteos(request: Request):
+    """Aciertos, fallos, invalidaciones y desalojos de la caché de sorteos de este worker"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    return cache_sorteos.obtener_metricas()
+
+@api_router.get("/admin/metricas/particion")
+async def get_metricas_particion(request: Request):
+    """Workers vivos que se reparten los sorteos activos y generación del reparto"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    return particion_sorteos.obtener_metricas()
+
+@api_router.get("/admin/metricas/actores")
+async def get_metricas_actores(request: Request):
+    """Actores de sorteo activos en este worker: buzón y vendidos sin persistir"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    return actores_sorteo.obtener_metricas()
+
+@api_router.get("/admin/metricas/cola-compras")
+async def get_metricas_cola_compras(request: Request):
+    """Profundidad de la cola de compras por sorteo, esperas y rechazos"""
+    admin = await get_current_user(request)
+    if admin.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Solo admins")
+    
+    return cola_compras.obtener_metricas()
+
 @api_router.post("/admin/limpiar-sorteos-antiguos")
 async def ejecutar_limpieza_sorteos():
     """Limpiar sorteos completados con más de 30 días (automático)"""
@@ -1808,8 +1923,11 @@ async def guardar_ganadores_sorteo(sorteo_id: str, ganadores: List[dict], reques
     # Marcar sorteo como completado
     await db.sorteos.update_one(
         {'id': sorteo_id},
-        {'$set': {'estado': 'completed'}}
+        {'$set': {'estado': 'completed'}, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
+    await state_checker_service.reprogramar_sorteo(sorteo_id)
+    actores_sorteo.notificar_cambio(sorteo_id)
     
     return {"message": f"{len(ganadores)} ganador(es) guardado(s) exitosamente", "sorteo_completado": True}
 
@@ -1824,14 +1942,22 @@ async def completar_sorteo(sorteo_id: str):
     if sorteo_doc['estado'] != 'live':
         raise HTTPException(status_code=400, detail="Solo se pueden completar sorteos en estado LIVE")
     
-    # Actualizar estado a COMPLETED
-    await db.sorteos.update_one(
-        {'id': sorteo_id},
-        {'$set': {
-            'estado': 'completed',
-            'fecha_completed': datetime.now(timezone.utc)
-        }}
+    # Actualizar estado a COMPLETED (solo si sigue LIVE: la animación puede completarlo a la vez)
+    result = await db.sorteos.update_one(
+        {'id': sorteo_id, 'estado': 'live'},
+        {
+            '$set': {
+                'estado': 'completed',
+                'fecha_completed': datetime.now(timezone.utc)
+            },
+            '$inc': {'version': 1}
+        }
     )
+    cache_sorteos.invalidar(sorteo_id)
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Solo se pueden completar sorteos en estado LIVE")
+    await state_checker_service.reprogramar_sorteo(sorteo_id)
+    actores_sorteo.notificar_cambio(sorteo_id)
     
     # Guardar ganadores en colección separada si hay
     ganadores = sorteo_doc.get('ganadores', [])
@@ -1876,13 +2002,22 @@ async def iniciar_sorteo_live(sorteo_id: str, request: Request):
     if sorteo_doc['estado'] != 'waiting':
         raise HTTPException(status_code=400, detail="Solo se pueden iniciar sorteos en estado WAITING")
     
-    await db.sorteos.update_one(
-        {'id': sorteo_id},
-        {'$set': {
-            'estado': 'live',
-            'fecha_live': datetime.now(timezone.utc)
-        }}
+    result = await db.sorteos.update_one(
+        {'id': sorteo_id, 'estado': 'waiting'},
+        {
+            '$set': {
+                'estado': 'live',
+                'fecha_live': datetime.now(timezone.utc)
+            },
+            '$inc': {'version': 1}
+        }
     )
+    cache_sorteos.invalidar(sorteo_id)
+    if result.modified_count == 0:
+        raise HTTPException(status_code=409, detail="El sorteo cambió de estado mientras se iniciaba")
+    waiting_countdown_service.quitar_waiting(sorteo_id)
+    await state_checker_service.reprogramar_sorteo(sorteo_id)
+    actores_sorteo.notificar_cambio(sorteo_id)
     
     return {"message": "Sorteo iniciado en modo LIVE"}
 
@@ -1911,95 +2046,196 @@ async def cambiar_estado_sorteo(sorteo_id: str, nuevo_estado: str, request: Requ
     if estado_actual == 'completed':
         raise HTTPException(status_code=400, detail="No se puede cambiar estado de un sorteo completado")
     
-    await db.sorteos.update_one(
-        {'id': sorteo_id},
-        {'$set': {'estado': nuevo_estado}}
+    update_estado = {'estado': nuevo_estado}
+    if estado_actual == 'draft':
+        update_estado['umbrales_etapas'] = state_machine.calcular_umbrales_etapas(sorteo_doc)
+    
+    result = await db.sorteos.update_one(
+        {'id': sorteo_id, 'estado': estado_actual},
+        {'$set': update_estado, '$inc': {'version': 1}}
     )
+    cache_sorteos.invalidar(sorteo_id)
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail="El sorteo cambió de estado, vuelve a intentarlo")
+    if estado_actual == 'waiting':
+        waiting_countdown_service.quitar_waiting(sorteo_id)
+    await state_checker_service.reprogramar_sorteo(sorteo_id)
+    actores_sorteo.notificar_cambio(sorteo_id)
     
     return {"message": f"Estado cambiado a {nuevo_estado} exitosamente"}
 
 @api_router.get("/sorteos/slug/{slug}", response_model=Sorteo)
 async def get_sorteo_by_slug(slug: str):
-    sorteo_doc = await db.sorteos.find_one({'landing_slug': slug}, {"_id": 0})
-    if not sorteo_doc:
+    sorteo = await cache_sorteos.obtener_por_slug(slug)
+    if not sorteo:
         raise HTTPException(status_code=404, detail="Sorteo no encontrado")
-    
-    # Convertir fecha_cierre (única fecha del sorteo)
-    if sorteo_doc.get('fecha_cierre') and isinstance(sorteo_doc['fecha_cierre'], str):
-        sorteo_doc['fecha_cierre'] = datetime.fromisoformat(sorteo_doc['fecha_cierre'])
-    
-    if sorteo_doc.get('created_at') and isinstance(sorteo_doc['created_at'], str):
-        sorteo_doc['created_at'] = datetime.fromisoformat(sorteo_doc['created_at'])
-    
-    # Compatibilidad con sorteos antiguos que tienen fecha_inicio
-    if sorteo_doc.get('fecha_inicio'):
-        if isinstance(sorteo_doc['fecha_inicio'], str):
-            fecha_inicio = datetime.fromisoformat(sorteo_doc['fecha_inicio'])
-        else:
-            fecha_inicio = sorteo_doc['fecha_inicio']
-        
-        # Si no tiene fecha_cierre, usar fecha_inicio
-        if not sorteo_doc.get('fecha_cierre'):
-            sorteo_doc['fecha_cierre'] = fecha_inicio
-    
-    # Convertir fechas de etapas
-    for etapa in sorteo_doc.get('etapas', []):
-        if etapa.get('fecha_sorteo') and isinstance(etapa['fecha_sorteo'], str):
-            etapa['fecha_sorteo'] = datetime.fromisoformat(etapa['fecha_sorteo'])
-    
-    return Sorteo(**sorteo_doc)
+    return sorteo
 
 @api_router.post("/sorteos/{sorteo_id}/validar-numero")
 async def validar_numero_boleto(sorteo_id: str, request: ValidarNumeroRequest):
     """Validar si un número de boleto está disponible (pendiente o comprado)"""
     numero = request.numero
     
-    # Buscar boletos con este número
-    boleto = await db.boletos.find_one({
-        'sorteo_id': sorteo_id,
-        'numero_boleto': numero
-    })
+    # Aprobados o pendientes de menos de 24 horas no están disponibles
+    ocupados = await obtener_numeros_ocupados(sorteo_id, [numero])
+    if numero in ocupados:
+        return {"disponible": False, "mensaje": f"Error: el número {numero} ya está reservado o vendido"}
+    
+    return {"disponible": True, "mensaje": "Número disponible"}
+
+# Máximo de números por validación masiva
+VALIDACION_MAX_NUMEROS = 1000
+
+@api_router.post("/sorteos/{sorteo_id}/validar-numeros")
+async def validar_numeros_boletos(sorteo_id: str, request: ValidarNumerosRequest):
+    """Validar varios números de boleto en una sola petición (una sola consulta a Mongo)"""
+    numeros = list(dict.fromkeys(request.numeros))
     
-    if not boleto:
-        return {"disponible": True, "mensaje": "Número disponible"}
+    if len(numeros) > VALIDACION_MAX_NUMEROS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Se pueden validar máximo {VALIDACION_MAX_NUMEROS} números por petición"
+        )
     
-    # Si el boleto está aprobado/comprado, no está disponible
-    if boleto.get('pago_confirmado', False):
-        return {"disponible": False, "mensaje": f"Error: el número {numero} ya está reservado o vendido"}
+    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id}, {"_id": 0, "cantidad_total_boletos": 1})
+    if not sorteo_doc:
+        raise HTTPException(status_code=404, detail="Sorteo no encontrado")
     
-    # Si está pendiente, verificar las 24 horas
-    fecha_compra = boleto.get('fecha_compra')
-    if fecha_compra:
-        if isinstance(fecha_compra, str):
-            fecha_compra = datetime.fromisoformat(fecha_compra.replace('Z', '+00:00'))
-        
-        horas_pasadas = (datetime.now(timezone.utc) - fecha_compra).total_seconds() / 3600
-        
-        if horas_pasadas < 24:
-            return {"disponible": False, "mensaje": f"Error: el número {numero} ya está reservado o vendido"}
+    total = sorteo_doc['cantidad_total_boletos']
+    fuera_de_rango = [n for n in numeros if n < 1 or n > total]
+    en_rango = [n for n in numeros if 1 <= n <= total]
     
-    # Si pasaron más de 24 horas y está pendiente, está disponible
-    return {"disponible": True, "mensaje": "Número disponible"}
+    ocupados = await obtener_numeros_ocupados(sorteo_id, en_rango)
+    
+    return {
+        "disponibles": [n for n in en_rango if n not in ocupados],
+        "no_disponibles": [n for n in en_rango if n in ocupados],
+        "fuera_de_rango": fuera_de_rango,
+        "todos_disponibles": not ocupados and not fuera_de_rango
+    }
 
 @api_router.get("/sorteos/{sorteo_id}/numeros-disponibles")
 async def get_numeros_disponibles(sorteo_id: str):
-    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id})
+    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id}, {"_id": 0, "cantidad_total_boletos": 1})
     if not sorteo_doc:
         raise HTTPException(status_code=404, detail="Sorteo no encontrado")
     
-    # Get all taken numbers
-    boletos = await db.boletos.find({'sorteo_id': sorteo_id}, {"numero_boleto": 1}).to_list(10000)
-    numeros_ocupados = {b['numero_boleto'] for b in boletos}
-    
-    # Generate available numbers
-    numeros_disponibles = [n for n in range(1, sorteo_doc['cantidad_total_boletos'] + 1) if n not in numeros_ocupados]
+    # Leer disponibilidad desde el bitmap del sorteo (sin recorrer boletos)
+    inventario = await inventario_boletos.obtener_inventario(sorteo_id, sorteo_doc['cantidad_total_boletos'])
     
     return {
-        "disponibles": numeros_disponibles,
-        "ocupados": list(numeros_ocupados),
+        "disponibles": inventario.numeros_disponibles(),
+        "ocupados": inventario.numeros_ocupados(),
         "total": sorteo_doc['cantidad_total_boletos']
     }
 
+# Límites de la API de disponibilidad por ventanas
+DISPONIBILIDAD_MAX_VENTANA = 10000
+DISPONIBILIDAD_MAX_BLOQUES = 1000
+
+@api_router.get("/sorteos/{sorteo_id}/disponibilidad")
+async def get_disponibilidad_ventana(
+    sorteo_id: str,
+    desde: Optional[int] = None,
+    hasta: Optional[int] = None,
+    pagina: Optional[int] = None,
+    tamano_pagina: int = 500,
+    tamano_bloque: Optional[int] = None,
+    incluir_bloques: bool = True
+):
+    """
+    Disponibilidad de una ventana de la grilla de números, codificada por rangos.
+    - desde/hasta: ventana explícita de números (inclusive)
+    - pagina/tamano_pagina: alternativa paginada (pagina empieza en 1)
+    - rangos: [inicio, fin, ocupado] con ocupado = 0 (libre) o 1 (vendido/reservado)
+    - bloques: conteos por bloque de todo el sorteo para dibujar la vista general
+    """
+    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id}, {"_id": 0, "cantidad_total_boletos": 1})
+    if not sorteo_doc:
+        raise HTTPException(status_code=404, detail="Sorteo no encontrado")
+    
+    total = sorteo_doc['cantidad_total_boletos']
+    
+    if pagina is not None:
+        if pagina < 1 or tamano_pagina < 1:
+            raise HTTPException(status_code=400, detail="La página y su tamaño deben ser mayores a 0")
+        desde = (pagina - 1) * tamano_pagina + 1
+        hasta = pagina * tamano_pagina
+    
+    desde = max(1, desde or 1)
+    hasta = min(total, hasta if hasta is not None else desde + tamano_pagina - 1)
+    
+    if hasta - desde + 1 > DISPONIBILIDAD_MAX_VENTANA:
+        raise HTTPException(
+            status_code=400,
+            detail=f"La ventana solicitada supera el máximo de {DISPONIBILIDAD_MAX_VENTANA} números"
+        )
+    
+    inventario = await inventario_boletos.obtener_inventario(sorteo_id, total)
+    
+    respuesta = {
+        "sorteo_id": sorteo_id,
+        "total": total,
+        "desde": desde,
+        "hasta": hasta,
+        "ventana": inventario.contar(desde, hasta),
+        "rangos": inventario.rangos(desde, hasta) if hasta >= desde else [],
+        "totales": {
+            "libres": inventario.cantidad_libres,
+            "reservados": inventario.cantidad_reservados,
+            "vendidos": inventario.cantidad_vendidos
+        }
+    }
+    
+    if incluir_bloques:
+        # El tamaño del bloque se ajusta para no superar el máximo de bloques
+        tamano_minimo = -(-total // DISPONIBILIDAD_MAX_BLOQUES)
+        tamano = max(tamano_bloque or tamano_pagina, tamano_minimo, 1)
+        respuesta["tamano_bloque"] = tamano
+        respuesta["bloques"] = inventario.conteos_bloques(tamano)
+    
+    return respuesta
+
+# Máximo de números por quick-pick
+QUICK_PICK_MAX_NUMEROS = 500
+
+@api_router.post("/sorteos/{sorteo_id}/quick-pick")
+async def quick_pick_numeros(sorteo_id: str, cantidad: int, request: Request):
+    """Elegir al azar 'cantidad' números libres y retenerlos tentativamente para el usuario"""
+    user = await get_current_user(request)
+    
+    if cantidad < 1 or cantidad > QUICK_PICK_MAX_NUMEROS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"La cantidad debe estar entre 1 y {QUICK_PICK_MAX_NUMEROS}"
+        )
+    
+    sorteo_doc = await db.sorteos.find_one(
+        {'id': sorteo_id},
+        {"_id": 0, "cantidad_total_boletos": 1, "estado": 1}
+    )
+    if not sorteo_doc:
+        raise HTTPException(status_code=404, detail="Sorteo no encontrado")
+    
+    if sorteo_doc['estado'] not in [SorteoEstado.PUBLISHED, SorteoEstado.ACTIVO, SorteoEstado.WAITING]:
+        raise HTTPException(status_code=400, detail="Sorteo no disponible para compra")
+    
+    numeros, segundos_retencion = await inventario_boletos.quick_pick(
+        sorteo_id, sorteo_doc['cantidad_total_boletos'], user.id, cantidad
+    )
+    
+    if len(numeros) < cantidad:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Solo hay {len(numeros)} número(s) disponible(s)"
+        )
+    
+    return {
+        "numeros": numeros,
+        "cantidad": len(numeros),
+        "retenidos_hasta": (datetime.now(timezone.utc) + timedelta(seconds=segundos_retencion)).isoformat()
+    }
+
 # ============ BOLETOS ENDPOINTS ============
 @api_router.post("/boletos/comprar")
 async def comprar_boletos(data: BoletoCompra, request: Request):
@@ -2013,13 +2249,32 @@ async def comprar_boletos(data: BoletoCompra, request: Request):
     if not user.datos_completos or not user.cedula or not user.celular:
         raise HTTPException(status_code=400, detail="Debes completar tus datos (cédula y celular) antes de comprar")
     
+    # Los reintentos con la misma Idempotency-Key reciben la respuesta ya guardada
+    return await idempotencia.ejecutar_idempotente(
+        request, 'comprar_boletos', user.id, data,
+        lambda: admitir_y_procesar_compra(data, user)
+    )
+
+async def admitir_y_procesar_compra(data: BoletoCompra, user: User):
+    # Admisión por sorteo: limita compras simultáneas y hace esperar a las que piden números en proceso
+    async with cola_compras.admitir_compra(data.sorteo_id, data.numeros_boletos) as numeros_en_conflicto:
+        if numeros_en_conflicto:
+            return JSONResponse(
+                status_code=409,
+                content={
+                    "detail": f"Los siguientes números están siendo comprados por otra persona: {', '.join(map(str, numeros_en_conflicto))}",
+                    "numeros_perdidos": numeros_en_conflicto
+                }
+            )
+        return await procesar_compra(data, user)
+
+async def procesar_compra(data: BoletoCompra, user: User):
+    """Validar y registrar una compra ya admitida por la cola del sorteo"""
     # Get sorteo
-    sorteo_doc = await db.sorteos.find_one({'id': data.sorteo_id})
-    if not sorteo_doc:
+    sorteo = await cache_sorteos.obtener(data.sorteo_id, verificar=True)
+    if not sorteo:
         raise HTTPException(status_code=404, detail="Sorteo no encontrado")
     
-    sorteo = Sorteo(**sorteo_doc)
-    
     # ============ VALIDACIÓN DE DISPONIBILIDAD ============
     # 1. Validar estado del sorteo
     # PUBLISHED o ACTIVO: siempre se puede comprar
@@ -2028,10 +2283,7 @@ async def comprar_boletos(data: BoletoCompra, request: Request):
         raise HTTPException(status_code=400, detail="Sorteo no disponible para compra")
     
     # 2. Validar que haya boletos disponibles (contando solo aprobados)
-    boletos_aprobados = await db.boletos.count_documents({
-        'sorteo_id': sorteo.id,
-        'pago_confirmado': True
-    })
+    boletos_aprobados = sorteo.cantidad_vendida
     
     boletos_disponibles = sorteo.cantidad_total_boletos - boletos_aprobados
     if boletos_disponibles <= 0:
@@ -2050,28 +2302,19 @@ async def comprar_boletos(data: BoletoCompra, request: Request):
             detail=f"La compra mínima es de {sorteo.compra_minima} boleto(s). Seleccionaste {len(data.numeros_boletos)}"
         )
     
-    # Validate all numbers
-    numeros_invalidos = []
-    numeros_ocupados = []
+    # Un mismo número no puede pedirse dos veces en la misma compra
+    numeros_repetidos = sorted(n for n, veces in Counter(data.numeros_boletos).items() if veces > 1)
+    if numeros_repetidos:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Los siguientes números están repetidos en la compra: {', '.join(map(str, numeros_repetidos))}"
+        )
     
-    for numero in data.numeros_boletos:
-        # Validate range
-        if numero < 1 or numero > sorteo.cantidad_total_boletos:
-            numeros_invalidos.append(numero)
-            continue
-        
-        # Check if already taken (including pending ones from last 24 hours)
-        hace_24h = datetime.now(timezone.utc) - timedelta(hours=24)
-        existing = await db.boletos.find_one({
-            'sorteo_id': sorteo.id,
-            'numero_boleto': numero,
-            '$or': [
-                {'pago_confirmado': True},
-                {'fecha_compra': {'$gte': hace_24h}}
-            ]
-        })
-        if existing:
-            numeros_ocupados.append(numero)
+    # Validate range
+    numeros_invalidos = [
+        n for n in data.numeros_boletos
+        if n < 1 or n > sorteo.cantidad_total_boletos
+    ]
     
     if numeros_invalidos:
         raise HTTPException(
@@ -2079,6 +2322,12 @@ async def comprar_boletos(data: BoletoCompra, request: Request):
             detail=f"Los siguientes números no están en el rango válido (1-{sorteo.cantidad_total_boletos}): {', '.join(map(str, numeros_invalidos))}"
         )
     
+    # Check if already taken (including pending ones from last 24 hours) - una sola consulta
+    ocupados = await obtener_numeros_ocupados(sorteo.id, data.numeros_boletos)
+    # Números retenidos por quick-pick de otro usuario tampoco se pueden comprar
+    ocupados |= inventario_boletos.retenidos_por_otros(sorteo.id, data.numeros_boletos, user.id)
+    numeros_ocupados = [n for n in data.numeros_boletos if n in ocupados]
+    
     if numeros_ocupados:
         raise HTTPException(
             status_code=400,
@@ -2111,7 +2360,10 @@ async def comprar_boletos(data: BoletoCompra, request: Request):
     
     # Create boletos
     boletos_creados = []
+    boletos_docs = []
     pago_confirmado = data.metodo_pago == MetodoPago.PAYPHONE
+    # Los boletos pendientes reservan su número hasta expira_en (fecha BSON para el índice TTL)
+    expira_en = None if pago_confirmado else reservas_boletos.calcular_expiracion()
     
     for numero in data.numeros_boletos:
         boleto = Boleto(
@@ -2124,16 +2376,39 @@ async def comprar_boletos(data: BoletoCompra, request: Request):
             etapas_participantes=etapas_participantes,
             estado=BoletoEstado.ACTIVO,
             pago_confirmado=pago_confirmado,
-            comprobante_url=data.comprobante_url
+            comprobante_url=data.comprobante_url,
+            expira_en=expira_en
         )
         
         boleto_dict = boleto.model_dump()
         boleto_dict['fecha_compra'] = boleto_dict['fecha_compra'].isoformat()
-        await db.boletos.insert_one(boleto_dict)
+        boletos_docs.append(boleto_dict)
         boletos_creados.append(boleto)
-        
-        # Create comision if vendedor
-        if vendedor_id:
+    
+    # Reclamar todos los números de forma atómica (todo o nada)
+    try:
+        numeros_perdidos = await reservas_boletos.reservar_boletos(boletos_docs)
+    except reservas_boletos.BoletosNoDisponibles as e:
+        return JSONResponse(
+            status_code=409,
+            content={
+                "detail": f"{e}. Intenta nuevamente",
+                "numeros_perdidos": e.numeros
+            }
+        )
+    if numeros_perdidos:
+        return JSONResponse(
+            status_code=409,
+            content={
+                "detail": f"Los siguientes números fueron tomados por otra compra: {', '.join(map(str, numeros_perdidos))}",
+                "numeros_perdidos": numeros_perdidos
+            }
+        )
+    
+    # Create comisiones if vendedor (una por boleto, en un solo insert_many)
+    if vendedor_id:
+        comisiones_docs = []
+        for boleto in boletos_creados:
             comision = Comision(
                 vendedor_id=vendedor_id,
                 sorteo_id=sorteo.id,
@@ -2142,15 +2417,32 @@ async def comprar_boletos(data: BoletoCompra, request: Request):
             )
             comision_dict = comision.model_dump()
             comision_dict['fecha'] = comision_dict['fecha'].isoformat()
-            await db.comisiones.insert_one(comision_dict)
+            comisiones_docs.append(comision_dict)
+        
+        comisiones_fallidas = await reservas_boletos.insertar_en_lote(db.comisiones, comisiones_docs)
+        if comisiones_fallidas:
+            # Sin comisión la venta queda incompleta: deshacer toda la compra
+            numeros_fallidos = sorted(boletos_creados[i].numero_boleto for i in comisiones_fallidas)
+            boleto_ids = [b.id for b in boletos_creados]
+            await db.comisiones.delete_many({'boleto_id': {'$in': boleto_ids}})
+            await db.boletos.delete_many({'id': {'$in': boleto_ids}})
+            logger.error(f"Sorteo {sorteo.id}: fallaron las comisiones de los números {numeros_fallidos}, compra revertida")
+            raise HTTPException(
+                status_code=500,
+                detail=f"No se pudieron registrar las comisiones de los números: {', '.join(map(str, numeros_fallidos))}. Intenta nuevamente"
+            )
+    
+    # Sincronizar inventario de números
+    if pago_confirmado:
+        inventario_boletos.registrar_venta(sorteo.id, data.numeros_boletos)
+    else:
+        inventario_boletos.registrar_reserva(sorteo.id, data.numeros_boletos)
     
     # Actualizar progreso del sorteo basado en boletos aprobados
     # Si el pago es por Payphone, está aprobado automáticamente
+    # Solo se evalúa la transición si la venta cruzó el umbral activo
     if pago_confirmado:
-        await actualizar_progreso_sorteo(sorteo.id)
-        resultado = await state_machine.verificar_transicion_estado_nuevo(sorteo.id)
-        if resultado == 'live':
-            asyncio.create_task(live_animation_service.iniciar_animacion_live(sorteo.id))
+        await actores_sorteo.registrar_venta(sorteo.id, len(boletos_creados), disparador='compra')
     
     cantidad_boletos = len(data.numeros_boletos)
     total = sorteo.precio_boleto * cantidad_boletos
@@ -2173,12 +2465,12 @@ async def get_mis_boletos(request: Request):
             boleto['fecha_compra'] = datetime.fromisoformat(boleto['fecha_compra'])
         
         # Get sorteo info
-        sorteo_doc = await db.sorteos.find_one({'id': boleto['sorteo_id']}, {"_id": 0})
-        if sorteo_doc:
+        sorteo = await cache_sorteos.obtener(boleto['sorteo_id'])
+        if sorteo:
             boleto['sorteo'] = {
-                'titulo': sorteo_doc.get('titulo', ''),
-                'id': sorteo_doc.get('id', ''),
-                'landing_slug': sorteo_doc.get('landing_slug', '')
+                'titulo': sorteo.titulo,
+                'id': sorteo.id,
+                'landing_slug': sorteo.landing_slug
             }
     
     return boletos
@@ -2399,8 +2691,9 @@ async def ejecutar_sorteo(data: EjecutarSorteoRequest, request: Request):
         
         await db.sorteos.update_one(
             {'id': sorteo.id},
-            {'$set': {'etapas': etapas_dict}}
+            {'$set': {'etapas': etapas_dict}, '$inc': {'version': 1}}
         )
+        cache_sorteos.invalidar(sorteo.id)
     else:
         # Final draw - mark boleto as ganador
         await db.boletos.update_one(
@@ -2411,8 +2704,10 @@ async def ejecutar_sorteo(data: EjecutarSorteoRequest, request: Request):
         # Mark sorteo as completado
         await db.sorteos.update_one(
             {'id': sorteo.id},
-            {'$set': {'estado': SorteoEstado.COMPLETADO}}
+            {'$set': {'estado': SorteoEstado.COMPLETADO}, '$inc': {'version': 1}}
         )
+        cache_sorteos.invalidar(sorteo.id)
+        actores_sorteo.notificar_cambio(sorteo.id)
     
     return {
         "message": "Sorteo ejecutado exitosamente",
@@ -2552,8 +2847,8 @@ async def get_boletos_pendientes(request: Request, sorteo_id: Optional[str] = No
         user_doc = await db.users.find_one({'id': boleto['usuario_id']}, {"_id": 0, "password_hash": 0})
         boleto['usuario'] = user_doc
         
-        sorteo_doc = await db.sorteos.find_one({'id': boleto['sorteo_id']}, {"_id": 0})
-        boleto['sorteo'] = {'titulo': sorteo_doc.get('titulo', ''), 'id': sorteo_doc.get('id', ''), 'landing_slug': sorteo_doc.get('landing_slug', '')}
+        sorteo = await cache_sorteos.obtener(boleto['sorteo_id'])
+        boleto['sorteo'] = {'titulo': sorteo.titulo, 'id': sorteo.id, 'landing_slug': sorteo.landing_slug}
     
     return boletos
 
@@ -2579,12 +2874,12 @@ async def get_boletos_aprobados(request: Request, sorteo_id: Optional[str] = Non
         user_doc = await db.users.find_one({'id': boleto['usuario_id']}, {"_id": 0, "password_hash": 0})
         boleto['usuario'] = user_doc
         
-        sorteo_doc = await db.sorteos.find_one({'id': boleto['sorteo_id']}, {"_id": 0})
-        if sorteo_doc:
+        sorteo = await cache_sorteos.obtener(boleto['sorteo_id'])
+        if sorteo:
             boleto['sorteo'] = {
-                'titulo': sorteo_doc.get('titulo', ''),
-                'id': sorteo_doc.get('id', ''),
-                'landing_slug': sorteo_doc.get('landing_slug', '')
+                'titulo': sorteo.titulo,
+                'id': sorteo.id,
+                'landing_slug': sorteo.landing_slug
             }
     
     return boletos
@@ -2598,6 +2893,14 @@ async def aprobar_boleto(boleto_id: str, numero_comprobante: str, request: Reque
     if not numero_comprobante or numero_comprobante.strip() == "":
         raise HTTPException(status_code=400, detail="El número de comprobante es obligatorio")
     
+    return await idempotencia.ejecutar_idempotente(
+        request, 'aprobar_boleto', admin.id,
+        {'boleto_id': boleto_id, 'numero_comprobante': numero_comprobante},
+        lambda: procesar_aprobacion(boleto_id, numero_comprobante)
+    )
+
+async def procesar_aprobacion(boleto_id: str, numero_comprobante: str):
+    """Aprobar el pago de un boleto pendiente y acreditar la comisión"""
     # Get boleto info first
     boleto_doc = await db.boletos.find_one({'id': boleto_id})
     if not boleto_doc:
@@ -2628,13 +2931,23 @@ async def aprobar_boleto(boleto_id: str, numero_comprobante: str, request: Reque
             detail=f"El boleto #{numero_boleto} ya no está disponible. Fue adquirido por otro usuario."
         )
     
+    # Al aprobar se quita expira_en para que el índice TTL no borre el boleto
     result = await db.boletos.update_one(
-        {'id': boleto_id},
-        {'$set': {
-            'pago_confirmado': True,
-            'numero_comprobante': numero_comprobante.strip()
-        }}
+        {'id': boleto_id, 'pago_confirmado': False},
+        {
+            '$set': {
+                'pago_confirmado': True,
+                'numero_comprobante': numero_comprobante.strip()
+            },
+            '$unset': {'expira_en': ''}
+        }
     )
+    if result.matched_count == 0:
+        raise HTTPException(
+            status_code=409,
+            detail="El boleto ya no está pendiente (fue aprobado o su reserva expiró)"
+        )
+    inventario_boletos.registrar_venta(sorteo_id, [numero_boleto])
     
     # ACREDITAR COMISIÓN AL VENDEDOR si existe
     if boleto_doc.get('vendedor_id'):
@@ -2659,7 +2972,7 @@ async def aprobar_boleto(boleto_id: str, numero_comprobante: str, request: Reque
             
             # Registrar movimiento de ingreso
             from movimientos_vendedor import registrar_movimiento_ingreso
-            sorteo_doc = await db.sorteos.find_one({'id': boleto_doc['sorteo_id']}, {"_id": 0})
+            sorteo = await cache_sorteos.obtener(boleto_doc['sorteo_id'])
             comprador_doc = await db.users.find_one({'id': boleto_doc['usuario_id']}, {"_id": 0})
             
             await registrar_movimiento_ingreso(
@@ -2667,7 +2980,7 @@ async def aprobar_boleto(boleto_id: str, numero_comprobante: str, request: Reque
                 vendedor_id=boleto_doc['vendedor_id'],
                 monto=comision['monto'],
                 sorteo_id=boleto_doc['sorteo_id'],
-                sorteo_titulo=sorteo_doc.get('titulo', 'Sorteo') if sorteo_doc else 'Sorteo',
+                sorteo_titulo=sorteo.titulo if sorteo else 'Sorteo',
                 boleto_id=boleto_id,
                 numero_boleto=boleto_doc.get('numero_boleto', 0),
                 comprador_id=boleto_doc['usuario_id'],
@@ -2678,10 +2991,7 @@ async def aprobar_boleto(boleto_id: str, numero_comprobante: str, request: Reque
     
     # Actualizar progreso del sorteo y verificar transiciones
     sorteo_id = boleto_doc['sorteo_id']
-    await actualizar_progreso_sorteo(sorteo_id)
-    resultado = await state_machine.verificar_transicion_estado_nuevo(sorteo_id)
-    if resultado == 'live':
-        asyncio.create_task(live_animation_service.iniciar_animacion_live(sorteo_id))
+    await actores_sorteo.registrar_venta(sorteo_id, 1, disparador='aprobacion')
     
     return {"message": "Boleto aprobado exitosamente"}
 
@@ -2697,20 +3007,12 @@ async def rechazar_boleto(boleto_id: str, request: Request):
         raise HTTPException(status_code=404, detail="Boleto no encontrado")
     
     # Delete boleto
-    await db.boletos.delete_one({'id': boleto_id})
+    result = await db.boletos.delete_one({'id': boleto_id})
+    inventario_boletos.registrar_liberacion(boleto_doc['sorteo_id'], [boleto_doc['numero_boleto']])
     
-    # Update sorteo count
-    sorteo_doc = await db.sorteos.find_one({'id': boleto_doc['sorteo_id']})
-    if sorteo_doc:
-        nueva_cantidad = max(0, sorteo_doc['cantidad_vendida'] - 1)
-        nuevo_progreso = (nueva_cantidad / sorteo_doc['cantidad_total_boletos']) * 100
-        await db.sorteos.update_one(
-            {'id': sorteo_doc['id']},
-            {'$set': {
-                'cantidad_vendida': nueva_cantidad,
-                'progreso_porcentaje': nuevo_progreso
-            }}
-        )
+    # Update sorteo count (solo los boletos aprobados cuentan como vendidos)
+    if result.deleted_count and boleto_doc.get('pago_confirmado'):
+        await actores_sorteo.registrar_venta(boleto_doc['sorteo_id'], -1)
     
     return {"message": "Boleto rechazado y eliminado"}
 
@@ -2809,40 +3111,15 @@ async def get_mis_ventas(request: Request):
 
 @api_router.post("/admin/limpiar-boletos-expirados")
 async def limpiar_boletos_expirados(request: Request):
-    """Elimina boletos pendientes con más de 24 horas"""
+    """
+    Elimina boletos pendientes cuya reserva venció.
+    Ya no es necesario llamarlo: el monitor de expiración y el índice TTL lo hacen solos.
+    """
     admin = await get_current_user(request)
     if admin.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Solo admins pueden ejecutar limpieza")
     
-    hace_24h = datetime.now(timezone.utc) - timedelta(hours=24)
-    
-    # Find expired tickets
-    boletos_expirados = await db.boletos.find({
-        'pago_confirmado': False,
-        'fecha_compra': {'$lt': hace_24h}
-    }).to_list(10000)
-    
-    cantidad_eliminados = 0
-    sorteos_actualizados = set()
-    
-    for boleto in boletos_expirados:
-        await db.boletos.delete_one({'id': boleto['id']})
-        cantidad_eliminados += 1
-        sorteos_actualizados.add(boleto['sorteo_id'])
-    
-    # Update sorteo counts
-    for sorteo_id in sorteos_actualizados:
-        boletos_count = await db.boletos.count_documents({'sorteo_id': sorteo_id})
-        sorteo_doc = await db.sorteos.find_one({'id': sorteo_id})
-        if sorteo_doc:
-            nuevo_progreso = (boletos_count / sorteo_doc['cantidad_total_boletos']) * 100
-            await db.sorteos.update_one(
-                {'id': sorteo_id},
-                {'$set': {
-                    'cantidad_vendida': boletos_count,
-                    'progreso_porcentaje': nuevo_progreso
-                }}
-            )
+    cantidad_eliminados = await reservas_boletos.liberar_reservas_expiradas()
     
     return {
         "message": f"Se eliminaron {cantidad_eliminados} boleto(s) expirado(s)",
@@ -2883,26 +3160,82 @@ async def startup_event():
     state_machine.init_state_machine(db, Sorteo, SorteoEstado, SorteoTipo)
     logger.info("State machine inicializada")
     
+    # Inicializar índice de inventario de boletos
+    inventario_boletos.init_inventario(db)
+    logger.info("Inventario de boletos inicializado")
+    
+    # Inicializar motor de reservas (índice único de números por sorteo + TTL de expiración)
+    reservas_boletos.init_reservas(db)
+    await reservas_boletos.asegurar_indices()
+    reservas_boletos.registrar_hook_expiracion(al_expirar_reservas)
+    
+    # Caché en proceso de sorteos (la usan las lecturas, compras y la máquina de estados)
+    cache_sorteos.init_cache(db, Sorteo)
+    
+    # Inicializar contadores de vendidos (y actores por sorteo si están habilitados)
+    contadores_sorteo.init_contadores(db)
+    actores_sorteo.init_actores(db)
+    
+    # Inicializar claves de idempotencia (compras y aprobaciones)
+    idempotencia.init_idempotencia(db)
+    await idempotencia.asegurar_indices()
+    
     # Inicializar live_animation_service
     live_animation_service.init_live_service(db, Sorteo, SorteoEstado, SorteoTipo)
     logger.info("Live animation service inicializado")
     
     # Inicializar waiting_countdown_service
-    import waiting_countdown_service
     waiting_countdown_service.init_countdown_service(db, SorteoEstado)
-    waiting_countdown_service.iniciar_monitoreo_countdowns()
     logger.info("Waiting countdown service inicializado")
     
-    # Inicializar verificador periódico de estados
-    import state_checker_service
+    # Línea de tiempo de transiciones (colección capped + histogramas)
+    timeline_transiciones.init_timeline(db)
+    await timeline_transiciones.asegurar_indices()
+    
+    # Inicializar programador de transiciones por vencimiento (+ barrido de seguridad)
     state_checker_service.init_state_checker(db, state_machine)
-    state_checker_service.iniciar_verificador_estados()
+    await state_checker_service.asegurar_indices()
     logger.info("State checker service inicializado")
     
-    # Verificar y reiniciar animaciones LIVE faltantes
-    await live_animation_service.verificar_y_reiniciar_animaciones()
-    logger.info("Verificación de animaciones LIVE completada")
+    # Ocupación de rooms compartida entre workers (gestor de Socket.IO redis o mongo)
+    websocket_manager.init_websocket(db)
+    if gestores_socketio.es_distribuido():
+        await websocket_manager.asegurar_indices()
+    websocket_manager.iniciar_ocupacion_compartida()
+    
+    # Servicios en background: solo corren en el worker que tiene el lease de líder
+    liderazgo.init_liderazgo(db)
+    await liderazgo.asegurar_indices()
+    liderazgo.registrar_servicio('expiracion_reservas', reservas_boletos.iniciar_expiracion_reservas)
+    liderazgo.registrar_servicio('reconciliador_contadores', contadores_sorteo.iniciar_reconciliador)
+    
+    # Servicios por sorteo: en el líder, o en todos los workers con el reparto activo
+    # (cada uno atiende solo los sorteos que le tocan)
+    registrar_por_sorteo = liderazgo.registrar_servicio
+    if particion_sorteos.PARTICION_HABILITADA:
+        particion_sorteos.init_particion(db)
+        await particion_sorteos.asegurar_indices()
+        registrar_por_sorteo = particion_sorteos.registrar_servicio
+    registrar_por_sorteo('countdowns_waiting', waiting_countdown_service.iniciar_monitoreo_countdowns)
+    registrar_por_sorteo(
+        'programador_transiciones',
+        state_checker_service.iniciar_verificador_estados,
+        state_checker_service.detener_programador
+    )
+    # La supervisión reinicia al arrancar las animaciones LIVE faltantes
+    registrar_por_sorteo(
+        'animaciones_live',
+        live_animation_service.iniciar_supervision_animaciones,
+        live_animation_service.detener_animaciones
+    )
+    liderazgo.iniciar()
+    if particion_sorteos.PARTICION_HABILITADA:
+        await particion_sorteos.iniciar()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await actores_sorteo.detener_actores()
+    await particion_sorteos.detener()
+    await liderazgo.detener()
+    await websocket_manager.detener_ocupacion()
     client.close()
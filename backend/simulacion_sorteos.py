@@ -0,0 +1,799 @@
+#!/usr/bin/env python3
+"""
+Simulación de la máquina de estados con reloj virtual
+
+Lleva miles de sorteos sintéticos (ÚNICOS y POR ETAPAS) por
+PUBLISHED → WAITING → LIVE → COMPLETED con el código real de state_machine,
+state_checker_service, live_animation_service, waiting_countdown_service y
+actores_sorteo, pero sobre:
+- un reloj virtual (reloj.usar): las horas de ventas, esperas y animaciones pasan
+  en segundos, saltando de un vencimiento al siguiente
+- una base de datos en memoria que imita las operaciones de Motor que usan esos
+  servicios y cuenta cada consulta
+- un servidor Socket.IO falso que cuenta eventos y bytes emitidos
+
+Reporta el retraso de cada transición respecto del momento en que debía ocurrir,
+las consultas por transición y el volumen de eventos. Con los umbrales --max-*
+termina con código 1 si se superan, para usarlo como benchmark de regresión.
+
+No necesita Mongo. Uso:
+    python simulacion_sorteos.py [--sorteos 2000] [--semilla 1] [--json] [--proporcion-rooms-vacias P]
+        [--max-retraso-p95 S] [--max-consultas-por-transicion N] [--max-eventos N]
+"""
+import argparse
+import asyncio
+import copy
+import heapq
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+# server.py lee estas variables al importarse; la simulación no se conecta a Mongo
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'simulacion_sorteos')
+
+import actores_sorteo
+import cache_sorteos
+import contadores_sorteo
+import liderazgo
+import live_animation_service
+import reloj
+import state_checker_service
+import state_machine
+import timeline_transiciones
+import waiting_countdown_service
+import websocket_manager
+from server import Etapa, Premio, Sorteo, SorteoEstado, SorteoTipo
+
+INICIO_SIMULACION = datetime(2030, 1, 1, tzinfo=timezone.utc)
+DURACION_WAITING_ETAPAS = 5 * 60
+DURACION_POR_PREMIO = 120
+PORCENTAJES_ETAPAS = [30, 60, 100]
+
+# ==================== RELOJ VIRTUAL ====================
+
+class RelojSimulado:
+    """
+    Reloj que solo avanza cuando todas las tareas están dormidas: salta al
+    próximo despertar, lo libera y deja correr las tareas hasta que se detienen.
+    """
+
+    def __init__(self, inicio: datetime):
+        self.inicio = inicio
+        self.segundos = 0.0
+        self._dormidos = []  # (momento, secuencia, futuro)
+        self._secuencia = 0
+
+    def ahora(self) -> datetime:
+        return self.inicio + timedelta(seconds=self.segundos)
+
+    def monotonic(self) -> float:
+        return self.segundos
+
+    def _registrar(self, segundos: float) -> asyncio.Future:
+        futuro = asyncio.get_running_loop().create_future()
+        self._secuencia += 1
+        heapq.heappush(self._dormidos, (self.segundos + segundos, self._secuencia, futuro))
+        return futuro
+
+    async def dormir(self, segundos: float):
+        if segundos <= 0:
+            await asyncio.sleep(0)
+            return
+        await self._registrar(segundos)
+
+    async def esperar_evento(self, evento: asyncio.Event, timeout: Optional[float]) -> bool:
+        if evento.is_set():
+            return True
+        if timeout is None:
+            await evento.wait()
+            return True
+        if timeout <= 0:
+            await asyncio.sleep(0)
+            return evento.is_set()
+
+        temporizador = self._registrar(timeout)
+        espera = asyncio.ensure_future(evento.wait())
+        try:
+            await asyncio.wait({temporizador, espera}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            espera.cancel()
+            temporizador.cancel()
+        return evento.is_set()
+
+    async def drenar(self, actividad: Callable[[], int]):
+        """Ceder el loop hasta que las tareas dejen de consultar, emitir o dormir"""
+        anterior = None
+        estables = 0
+        while estables < 5:
+            await asyncio.sleep(0)
+            marca = actividad() + self._secuencia
+            if marca == anterior:
+                estables += 1
+            else:
+                estables = 0
+                anterior = marca
+
+    async def ejecutar(self, hasta: float, terminado: Callable[[], bool], actividad: Callable[[], int]):
+        """Avanzar el tiempo de despertar en despertar hasta 'hasta' segundos o hasta que terminado()"""
+        await self.drenar(actividad)
+        while self._dormidos and not terminado():
+            momento = self._dormidos[0][0]
+            if momento > hasta:
+                break
+            self.segundos = max(self.segundos, momento)
+            while self._dormidos and self._dormidos[0][0] <= momento:
+                _, _, futuro = heapq.heappop(self._dormidos)
+                if not futuro.done():
+                    futuro.set_result(None)
+            await self.drenar(actividad)
+
+# ==================== BASE DE DATOS EN MEMORIA ====================
+
+_FALTA = object()
+
+def _obtener(doc, ruta: str):
+    valor = doc
+    for parte in ruta.split('.'):
+        if isinstance(valor, list):
+            valor = [v.get(parte, _FALTA) for v in valor if isinstance(v, dict)]
+        elif isinstance(valor, dict):
+            valor = valor.get(parte, _FALTA)
+        else:
+            return _FALTA
+        if valor is _FALTA:
+            return _FALTA
+    return valor
+
+def _igual(valor, esperado) -> bool:
+    if valor is _FALTA:
+        return esperado is None
+    if isinstance(valor, list) and not isinstance(esperado, list):
+        return esperado in valor
+    return valor == esperado
+
+def _comparar(valor, argumento, operador) -> bool:
+    if valor is _FALTA or valor is None or argumento is None:
+        return False
+    try:
+        return operador(valor, argumento)
+    except TypeError:
+        return False
+
+_OPERADORES = {
+    '$ne': lambda v, a: not _igual(v, a),
+    '$in': lambda v, a: any(_igual(v, x) for x in a),
+    '$nin': lambda v, a: not any(_igual(v, x) for x in a),
+    '$exists': lambda v, a: (v is not _FALTA) == bool(a),
+    '$lt': lambda v, a: _comparar(v, a, lambda x, y: x < y),
+    '$lte': lambda v, a: _comparar(v, a, lambda x, y: x <= y),
+    '$gt': lambda v, a: _comparar(v, a, lambda x, y: x > y),
+    '$gte': lambda v, a: _comparar(v, a, lambda x, y: x >= y),
+}
+
+def _coincide(doc: dict, filtro: dict) -> bool:
+    for campo, condicion in filtro.items():
+        if campo == '$or':
+            if not any(_coincide(doc, f) for f in condicion):
+                return False
+        elif campo == '$and':
+            if not all(_coincide(doc, f) for f in condicion):
+                return False
+        else:
+            valor = _obtener(doc, campo)
+            if isinstance(condicion, dict) and condicion and all(k.startswith('$') for k in condicion):
+                if not all(_OPERADORES[op](valor, arg) for op, arg in condicion.items()):
+                    return False
+            elif not _igual(valor, condicion):
+                return False
+    return True
+
+def _evaluar(expr, doc):
+    """Expresiones de agregación usadas en las actualizaciones con pipeline"""
+    if isinstance(expr, str) and expr.startswith('$'):
+        valor = _obtener(doc, expr[1:])
+        return None if valor is _FALTA else valor
+    if isinstance(expr, list):
+        return [_evaluar(e, doc) for e in expr]
+    if not (isinstance(expr, dict) and len(expr) == 1 and next(iter(expr)).startswith('$')):
+        return expr
+
+    operador, args = next(iter(expr.items()))
+    if operador == '$cond':
+        condicion, si, no = args
+        return _evaluar(si if _evaluar(condicion, doc) else no, doc)
+    valores = [_evaluar(a, doc) for a in args] if isinstance(args, list) else [_evaluar(args, doc)]
+    if operador == '$ifNull':
+        return next((v for v in valores if v is not None), None)
+    if operador == '$add':
+        return sum(valores)
+    if operador == '$multiply':
+        resultado = 1
+        for v in valores:
+            resultado *= v
+        return resultado
+    if operador == '$divide':
+        return valores[0] / valores[1]
+    if operador == '$max':
+        return max(v for v in valores if v is not None)
+    if operador == '$gt':
+        return valores[0] > valores[1]
+    if operador == '$eq':
+        return valores[0] == valores[1]
+    raise NotImplementedError(f"Operador de expresión no soportado en la simulación: {operador}")
+
+def _asignar(doc: dict, ruta: str, valor):
+    partes = ruta.split('.')
+    for parte in partes[:-1]:
+        doc = doc.setdefault(parte, {})
+    doc[partes[-1]] = valor
+
+def _proyectar(doc: dict, proyeccion: Optional[dict]) -> dict:
+    if not proyeccion:
+        return copy.deepcopy(doc)
+    incluidos = [campo for campo, v in proyeccion.items() if v and campo != '_id']
+    if not incluidos:
+        resultado = copy.deepcopy(doc)
+        for campo, v in proyeccion.items():
+            if not v:
+                resultado.pop(campo, None)
+        return resultado
+
+    resultado = {}
+    if proyeccion.get('_id', 1) and '_id' in doc:
+        resultado['_id'] = doc['_id']
+    for campo in incluidos:
+        raiz, _, resto = campo.partition('.')
+        if raiz not in doc:
+            continue
+        if not resto:
+            resultado[raiz] = copy.deepcopy(doc[raiz])
+        elif isinstance(doc[raiz], list):
+            previos = resultado.setdefault(raiz, [{} for _ in doc[raiz]])
+            for destino, origen in zip(previos, doc[raiz]):
+                destino.update(_proyectar(origen, {'_id': 0, resto: 1}))
+        elif isinstance(doc[raiz], dict):
+            resultado.setdefault(raiz, {}).update(_proyectar(doc[raiz], {'_id': 0, resto: 1}))
+    return resultado
+
+
+class ResultadoEscritura:
+    def __init__(self, coincidencias: int, modificados: int, upserted_id=None):
+        self.matched_count = coincidencias
+        self.modified_count = modificados
+        self.upserted_id = upserted_id
+        self.deleted_count = modificados
+
+
+class CursorSimulado:
+    def __init__(self, documentos: List[dict]):
+        self._documentos = documentos
+
+    async def to_list(self, length: Optional[int]):
+        return self._documentos if length is None else self._documentos[:length]
+
+
+class ColeccionSimulada:
+    """Colección en memoria con un índice de igualdad sobre un campo"""
+
+    def __init__(self, base: 'BaseSimulada', nombre: str, indice: str = 'id'):
+        self._base = base
+        self.nombre = nombre
+        self.indice = indice
+        self._por_indice: Dict[object, List[dict]] = defaultdict(list)
+
+    def _contar(self, operacion: str):
+        self._base.operaciones[f"{self.nombre}.{operacion}"] += 1
+
+    def _documentos(self):
+        for documentos in self._por_indice.values():
+            yield from documentos
+
+    def _candidatos(self, filtro: dict):
+        condicion = filtro.get(self.indice, _FALTA)
+        if condicion is _FALTA or (isinstance(condicion, dict) and set(condicion) - {'$in'}):
+            return list(self._documentos())
+        valores = condicion['$in'] if isinstance(condicion, dict) else [condicion]
+        return [doc for valor in valores for doc in self._por_indice.get(valor, [])]
+
+    def _buscar(self, filtro: dict) -> List[dict]:
+        return [doc for doc in self._candidatos(filtro) if _coincide(doc, filtro)]
+
+    def insertar(self, documentos: List[dict]):
+        """Carga inicial sin contar consultas"""
+        for doc in documentos:
+            doc.setdefault('_id', uuid.uuid4().hex)
+            self._por_indice[doc.get(self.indice)].append(doc)
+
+    def todos(self) -> List[dict]:
+        return list(self._documentos())
+
+    async def create_index(self, *args, **kwargs):
+        return kwargs.get('name')
+
+    async def insert_one(self, documento: dict):
+        self._contar('insert_one')
+        self.insertar([documento])
+
+    async def insert_many(self, documentos: List[dict], ordered: bool = True):
+        self._contar('insert_many')
+        self.insertar(documentos)
+
+    async def find_one(self, filtro: dict, projection: Optional[dict] = None):
+        self._contar('find_one')
+        for doc in self._candidatos(filtro):
+            if _coincide(doc, filtro):
+                return _proyectar(doc, projection)
+        return None
+
+    def find(self, filtro: Optional[dict] = None, projection: Optional[dict] = None) -> CursorSimulado:
+        self._contar('find')
+        return CursorSimulado([_proyectar(doc, projection) for doc in self._buscar(filtro or {})])
+
+    async def count_documents(self, filtro: dict) -> int:
+        self._contar('count_documents')
+        return len(self._buscar(filtro))
+
+    def aggregate(self, pipeline: List[dict]) -> CursorSimulado:
+        self._contar('aggregate')
+        documentos = self.todos()
+        for etapa in pipeline:
+            operador, arg = next(iter(etapa.items()))
+            if operador == '$match':
+                documentos = self._buscar(arg)
+            elif operador == '$group':
+                grupos = {}
+                for doc in documentos:
+                    clave = _evaluar(arg['_id'], doc)
+                    grupo = grupos.setdefault(clave, {'_id': clave, **{c: 0 for c in arg if c != '_id'}})
+                    for campo, acumulador in arg.items():
+                        if campo != '_id':
+                            grupo[campo] += _evaluar(acumulador['$sum'], doc)
+                documentos = list(grupos.values())
+            else:
+                raise NotImplementedError(f"Etapa de agregación no soportada en la simulación: {operador}")
+        return CursorSimulado(documentos)
+
+    def _aplicar_actualizacion(self, doc: dict, actualizacion) -> bool:
+        antes = copy.deepcopy(doc)
+        if isinstance(actualizacion, list):
+            for etapa in actualizacion:
+                for campo, expr in etapa['$set'].items():
+                    _asignar(doc, campo, _evaluar(expr, doc))
+        else:
+            for campo, valor in actualizacion.get('$set', {}).items():
+                _asignar(doc, campo, valor)
+            for campo in actualizacion.get('$unset', {}):
+                doc.pop(campo, None)
+            for campo, delta in actualizacion.get('$inc', {}).items():
+                actual = _obtener(doc, campo)
+                _asignar(doc, campo, (0 if actual is _FALTA else actual) + delta)
+        if doc.get(self.indice) != antes.get(self.indice):
+            self._por_indice[antes.get(self.indice)].remove(doc)
+            self._por_indice[doc.get(self.indice)].append(doc)
+        return doc != antes
+
+    def _upsert(self, filtro: dict, actualizacion) -> dict:
+        doc = {campo: valor for campo, valor in filtro.items()
+               if not campo.startswith('$') and not isinstance(valor, dict)}
+        self.insertar([doc])
+        self._aplicar_actualizacion(doc, actualizacion)
+        return doc
+
+    async def update_one(self, filtro: dict, actualizacion, upsert: bool = False):
+        self._contar('update_one')
+        for doc in self._candidatos(filtro):
+            if _coincide(doc, filtro):
+                return ResultadoEscritura(1, int(self._aplicar_actualizacion(doc, actualizacion)))
+        if upsert:
+            return ResultadoEscritura(0, 0, self._upsert(filtro, actualizacion)['_id'])
+        return ResultadoEscritura(0, 0)
+
+    async def update_many(self, filtro: dict, actualizacion):
+        self._contar('update_many')
+        documentos = self._buscar(filtro)
+        modificados = sum(int(self._aplicar_actualizacion(doc, actualizacion)) for doc in documentos)
+        return ResultadoEscritura(len(documentos), modificados)
+
+    async def find_one_and_update(self, filtro: dict, actualizacion, projection: Optional[dict] = None,
+                                  upsert: bool = False, return_document: bool = False):
+        self._contar('find_one_and_update')
+        for doc in self._candidatos(filtro):
+            if _coincide(doc, filtro):
+                antes = _proyectar(doc, projection)
+                self._aplicar_actualizacion(doc, actualizacion)
+                return _proyectar(doc, projection) if return_document else antes
+        if upsert:
+            doc = self._upsert(filtro, actualizacion)
+            return _proyectar(doc, projection) if return_document else None
+        return None
+
+    async def delete_one(self, filtro: dict):
+        self._contar('delete_one')
+        for doc in self._candidatos(filtro):
+            if _coincide(doc, filtro):
+                self._por_indice[doc.get(self.indice)].remove(doc)
+                return ResultadoEscritura(1, 1)
+        return ResultadoEscritura(0, 0)
+
+    async def delete_many(self, filtro: dict):
+        self._contar('delete_many')
+        documentos = self._buscar(filtro)
+        for doc in documentos:
+            self._por_indice[doc.get(self.indice)].remove(doc)
+        return ResultadoEscritura(len(documentos), len(documentos))
+
+
+class BaseSimulada:
+    """Base de datos en memoria: db.<coleccion> como en Motor"""
+
+    INDICES = {'boletos': 'sorteo_id', 'leases': '_id'}
+
+    def __init__(self):
+        self.operaciones = Counter()
+        self._colecciones: Dict[str, ColeccionSimulada] = {}
+
+    def __getattr__(self, nombre: str) -> ColeccionSimulada:
+        if nombre.startswith('_'):
+            raise AttributeError(nombre)
+        if nombre not in self._colecciones:
+            self._colecciones[nombre] = ColeccionSimulada(self, nombre, self.INDICES.get(nombre, 'id'))
+        return self._colecciones[nombre]
+
+    def __getitem__(self, nombre: str) -> ColeccionSimulada:
+        return getattr(self, nombre)
+
+# ==================== SOCKET.IO FALSO ====================
+
+class SioSimulado:
+    """Reemplaza websocket_manager.sio: cuenta eventos y bytes del payload JSON"""
+
+    def __init__(self, reloj_simulado: RelojSimulado):
+        self.reloj = reloj_simulado
+        self.eventos = Counter()
+        self.bytes = Counter()
+        self.cambios_estado = []  # (segundos, sorteo_id, nuevo_estado, datos)
+
+    async def emit(self, evento: str, datos=None, room=None, **kwargs):
+        self.eventos[evento] += 1
+        self.bytes[evento] += len(json.dumps(datos, default=str))
+        if evento == 'sorteo_state_changed':
+            nuevo_estado = getattr(datos['new_state'], 'value', datos['new_state'])
+            self.cambios_estado.append((self.reloj.segundos, datos['sorteo_id'], nuevo_estado, datos))
+
+    async def enter_room(self, sid, room, **kwargs):
+        pass
+
+    async def leave_room(self, sid, room, **kwargs):
+        pass
+
+# ==================== CARGA SINTÉTICA ====================
+
+class PlanSorteo:
+    """Sorteo sintético y el cronograma de ventas que lo llevará hasta COMPLETED"""
+
+    def __init__(self, sorteo: dict, ventas: List[tuple]):
+        self.sorteo = sorteo
+        self.ventas = ventas  # [(segundos, cantidad)] ordenado
+        self.fecha_cierre = (datetime.fromisoformat(sorteo['fecha_cierre']) - INICIO_SIMULACION).total_seconds()
+        self.agotado = ventas[-1][0]
+        self.umbrales = sorteo.get('umbrales_etapas') or []
+
+    def momento_vendidos(self, cantidad: int) -> float:
+        """Primer momento en que se vendieron al menos 'cantidad' boletos"""
+        acumulado = 0
+        for momento, vendidos in self.ventas:
+            acumulado += vendidos
+            if acumulado >= cantidad:
+                return momento
+        return float('inf')
+
+
+def generar_plan(rng: random.Random, indice: int, proporcion_etapas: float) -> PlanSorteo:
+    total = rng.randint(50, 300)
+    es_etapas = rng.random() < proporcion_etapas
+    cierre = rng.randint(3600, 6 * 3600)
+    # La mitad se agota antes del cierre, el resto después (ÚNICO sigue vendiendo en WAITING)
+    agotado = rng.randint(600, cierre) if rng.random() < 0.5 else rng.randint(cierre, int(cierre * 1.3))
+
+    momentos = sorted(rng.randint(1, agotado) for _ in range(max(1, total // 3)))
+    momentos[-1] = agotado
+    cantidades = [1] * len(momentos)
+    for _ in range(total - len(momentos)):
+        cantidades[rng.randrange(len(momentos))] += 1
+    ventas = list(zip(momentos, cantidades))
+
+    datos = {
+        'titulo': f"Sorteo simulado {indice}",
+        'descripcion': 'simulación',
+        'precio_boleto': 10.0,
+        'cantidad_minima_boletos': 1,
+        'cantidad_total_boletos': total,
+        'porcentaje_comision': 10.0,
+        'fecha_cierre': INICIO_SIMULACION + timedelta(seconds=cierre),
+        'estado': SorteoEstado.PUBLISHED,
+        'landing_slug': f"simulado-{indice}",
+        'created_at': INICIO_SIMULACION
+    }
+    if es_etapas:
+        datos['tipo'] = SorteoTipo.ETAPAS
+        datos['etapa_actual'] = 1
+        datos['etapas'] = [
+            Etapa(numero=n, porcentaje=p, premio=f"Premio etapa {n}",
+                  premios=[Premio(nombre=f"Premio etapa {n}")])
+            for n, p in enumerate(PORCENTAJES_ETAPAS, start=1)
+        ]
+    else:
+        datos['tipo'] = SorteoTipo.UNICO
+        datos['premios'] = [Premio(nombre=f"Premio {n}") for n in range(1, rng.randint(1, 3) + 1)]
+
+    sorteo = Sorteo(**datos)
+    sorteo.umbrales_etapas = state_machine.calcular_umbrales_etapas(sorteo)
+    sorteo_dict = sorteo.model_dump()
+    sorteo_dict['fecha_cierre'] = sorteo_dict['fecha_cierre'].isoformat()
+    sorteo_dict['created_at'] = sorteo_dict['created_at'].isoformat()
+    return PlanSorteo(sorteo_dict, ventas)
+
+
+async def vender(db: BaseSimulada, plan: PlanSorteo, usuarios: List[str], rng: random.Random):
+    """Aprobar boletos según el cronograma, por el mismo camino que las aprobaciones"""
+    sorteo_id = plan.sorteo['id']
+    numero = 0
+    for momento, cantidad in plan.ventas:
+        await reloj.dormir(momento - reloj.monotonic())
+        boletos = []
+        for _ in range(cantidad):
+            numero += 1
+            boletos.append({
+                'id': str(uuid.uuid4()),
+                'sorteo_id': sorteo_id,
+                'usuario_id': rng.choice(usuarios),
+                'numero_boleto': numero,
+                'pago_confirmado': True
+            })
+        # El alta del boleto es parte de la compra, no de la máquina de estados: no se cuenta
+        db.boletos.insertar(boletos)
+        await actores_sorteo.registrar_venta(sorteo_id, cantidad)
+
+# ==================== MEDICIÓN ====================
+
+def _percentil(valores, percentil: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(len(ordenados) * percentil))
+    return round(ordenados[indice], 2)
+
+def calcular_retrasos(planes: Dict[str, PlanSorteo], cambios_estado: List[tuple]) -> Dict[str, List[float]]:
+    """
+    Retraso de cada transición = momento real - momento en que se cumplió su condición
+    (ventas, fecha_cierre, waiting_hasta o fin de la animación), nunca antes de
+    que el sorteo entrara al estado anterior.
+    """
+    retrasos = defaultdict(list)
+    seguimiento = {
+        sorteo_id: {'estado': 'published', 'desde': 0.0, 'etapa': 1, 'ganadores': 0}
+        for sorteo_id in planes
+    }
+
+    for momento, sorteo_id, nuevo_estado, datos in cambios_estado:
+        plan = planes.get(sorteo_id)
+        if not plan:
+            continue
+        actual = seguimiento[sorteo_id]
+        es_etapas = plan.sorteo['tipo'] == 'etapas'
+        anterior = actual['estado']
+
+        esperado = None
+        if anterior == 'published' and nuevo_estado == 'waiting':
+            if not es_etapas:
+                esperado = min(plan.fecha_cierre, plan.agotado)
+            elif actual['etapa'] < len(plan.umbrales):
+                esperado = plan.momento_vendidos(plan.umbrales[actual['etapa'] - 1])
+            else:
+                esperado = max(plan.fecha_cierre, plan.agotado)
+        elif anterior == 'waiting' and nuevo_estado == 'live':
+            if es_etapas:
+                esperado = actual['desde'] + DURACION_WAITING_ETAPAS
+            else:
+                esperado = max(plan.fecha_cierre, plan.agotado)
+        elif anterior == 'live':
+            esperado = actual['desde'] + DURACION_POR_PREMIO * actual['ganadores']
+
+        if esperado is not None:
+            retrasos[f"{anterior}→{nuevo_estado}"].append(momento - max(esperado, actual['desde']))
+
+        if nuevo_estado == 'live' and 'ganadores' in datos:
+            actual['ganadores'] = len(datos['ganadores'])
+        if anterior == 'live' and nuevo_estado == 'published':
+            actual['etapa'] += 1
+        actual['estado'] = nuevo_estado
+        actual['desde'] = momento
+
+    return retrasos
+
+def construir_reporte(planes, db, sio, segundos_virtuales: float, duracion_real: float) -> dict:
+    retrasos = calcular_retrasos(planes, sio.cambios_estado)
+    todos = [r for valores in retrasos.values() for r in valores]
+    completados = sum(1 for s in db.sorteos.todos() if s.get('estado') == 'completed')
+    consultas = sum(db.operaciones.values())
+    transiciones = len(sio.cambios_estado)
+
+    return {
+        'sorteos': len(planes),
+        'completados': completados,
+        'horas_virtuales': round(segundos_virtuales / 3600, 2),
+        'duracion_real_s': round(duracion_real, 2),
+        'transiciones': transiciones,
+        'retraso_s': {
+            'p50': _percentil(todos, 0.50),
+            'p95': _percentil(todos, 0.95),
+            'max': round(max(todos), 2) if todos else 0.0,
+            'por_transicion': {
+                clave: {
+                    'n': len(valores),
+                    'p50': _percentil(valores, 0.50),
+                    'p95': _percentil(valores, 0.95),
+                    'max': round(max(valores), 2)
+                }
+                for clave, valores in sorted(retrasos.items())
+            }
+        },
+        'consultas': {
+            'total': consultas,
+            'por_transicion': round(consultas / transiciones, 2) if transiciones else 0.0,
+            'por_operacion': dict(db.operaciones.most_common())
+        },
+        'eventos': {
+            'total': sum(sio.eventos.values()),
+            'bytes': sum(sio.bytes.values()),
+            'por_evento': {
+                evento: {'n': n, 'bytes': sio.bytes[evento]}
+                for evento, n in sio.eventos.most_common()
+            }
+        }
+    }
+
+# ==================== EJECUCIÓN ====================
+
+async def simular(args) -> dict:
+    rng = random.Random(args.semilla)
+    random.seed(args.semilla)  # elección de ganadores
+
+    reloj_simulado = RelojSimulado(INICIO_SIMULACION)
+    reloj.usar(reloj_simulado)
+    db = BaseSimulada()
+    sio = SioSimulado(reloj_simulado)
+    websocket_manager.sio = sio
+
+    liderazgo.LIDERAZGO_HABILITADO = False
+    state_machine.init_state_machine(db, Sorteo, SorteoEstado, SorteoTipo)
+    state_checker_service.init_state_checker(db, state_machine)
+    live_animation_service.init_live_service(db, Sorteo, SorteoEstado, SorteoTipo)
+    waiting_countdown_service.init_countdown_service(db, SorteoEstado)
+    contadores_sorteo.init_contadores(db)
+    actores_sorteo.init_actores(db)
+    timeline_transiciones.init_timeline(db)
+    cache_sorteos.init_cache(db, Sorteo)
+
+    usuarios = [{'id': str(uuid.uuid4()), 'name': f"Usuario {n}", 'email': f"usuario{n}@simulacion.test"}
+                for n in range(500)]
+    db.users.insertar(usuarios)
+    planes = {}
+    for indice in range(args.sorteos):
+        plan = generar_plan(rng, indice, args.proporcion_etapas)
+        planes[plan.sorteo['id']] = plan
+    db.sorteos.insertar([plan.sorteo for plan in planes.values()])
+
+    # Un espectador por room, salvo la proporción de rooms vacías (no reciben ticks)
+    rng_rooms = random.Random(args.semilla)
+    websocket_manager.sorteo_rooms.clear()
+    for sorteo_id in planes:
+        if rng_rooms.random() >= args.proporcion_rooms_vacias:
+            websocket_manager.sorteo_rooms[sorteo_id] = {f"espectador-{sorteo_id}"}
+
+    tareas = list(state_checker_service.iniciar_verificador_estados())
+    tareas += live_animation_service.iniciar_supervision_animaciones()
+    if not args.sin_countdown:
+        tareas.append(waiting_countdown_service.iniciar_monitoreo_countdowns())
+    ids_usuarios = [u['id'] for u in usuarios]
+    tareas += [asyncio.create_task(vender(db, plan, ids_usuarios, rng)) for plan in planes.values()]
+
+    def terminado() -> bool:
+        return all(s.get('estado') == 'completed' for s in db.sorteos.todos())
+
+    def actividad() -> int:
+        return sum(db.operaciones.values()) + sum(sio.eventos.values())
+
+    inicio = time.perf_counter()
+    try:
+        await reloj_simulado.ejecutar(args.horas * 3600, terminado, actividad)
+    finally:
+        for tarea in tareas:
+            tarea.cancel()
+        live_animation_service.detener_animaciones()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        reloj.usar(reloj.RelojReal())
+
+    reporte = construir_reporte(planes, db, sio, reloj_simulado.segundos, time.perf_counter() - inicio)
+    reporte['ticker_live'] = live_animation_service.obtener_metricas()
+    return reporte
+
+def imprimir_reporte(reporte: dict):
+    print(f"📊 Simulación de {reporte['sorteos']} sorteos "
+          f"({reporte['horas_virtuales']} h virtuales en {reporte['duracion_real_s']} s)")
+    print("=" * 72)
+    print(f"Completados: {reporte['completados']}/{reporte['sorteos']}   Transiciones: {reporte['transiciones']}")
+    retraso = reporte['retraso_s']
+    print(f"Retraso (s): p50 {retraso['p50']}  p95 {retraso['p95']}  max {retraso['max']}")
+    print("-" * 72)
+    print(f"{'transición':<22} | {'n':>7} | {'p50 (s)':>9} | {'p95 (s)':>9} | {'max (s)':>9}")
+    for clave, valores in retraso['por_transicion'].items():
+        print(f"{clave:<22} | {valores['n']:>7} | {valores['p50']:>9} | {valores['p95']:>9} | {valores['max']:>9}")
+    print("-" * 72)
+    consultas = reporte['consultas']
+    print(f"Consultas: {consultas['total']} ({consultas['por_transicion']} por transición)")
+    for operacion, n in consultas['por_operacion'].items():
+        print(f"  {operacion:<36} {n:>10}")
+    print("-" * 72)
+    eventos = reporte['eventos']
+    print(f"Eventos emitidos: {eventos['total']} ({eventos['bytes']} bytes de payload)")
+    for evento, valores in eventos['por_evento'].items():
+        print(f"  {evento:<36} {valores['n']:>10} {valores['bytes']:>14} B")
+    ticker = reporte['ticker_live']
+    print(f"Ticker LIVE: {ticker['ticks']} ticks, desfase máx {ticker['desfase_max_ms']} ms, "
+          f"{ticker['fuera_de_tolerancia']} fuera de ±{ticker['tolerancia_ms']} ms")
+    print("=" * 72)
+
+def verificar_umbrales(reporte: dict, args) -> List[str]:
+    """Regresiones respecto de los umbrales pedidos"""
+    fallas = []
+    if reporte['completados'] < reporte['sorteos']:
+        fallas.append(f"{reporte['sorteos'] - reporte['completados']} sorteo(s) sin completar")
+    if args.max_retraso_p95 is not None and reporte['retraso_s']['p95'] > args.max_retraso_p95:
+        fallas.append(f"retraso p95 {reporte['retraso_s']['p95']}s > {args.max_retraso_p95}s")
+    if args.max_consultas_por_transicion is not None and \
+            reporte['consultas']['por_transicion'] > args.max_consultas_por_transicion:
+        fallas.append(f"{reporte['consultas']['por_transicion']} consultas por transición > {args.max_consultas_por_transicion}")
+    if args.max_eventos is not None and reporte['eventos']['total'] > args.max_eventos:
+        fallas.append(f"{reporte['eventos']['total']} eventos > {args.max_eventos}")
+    return fallas
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulación de la máquina de estados con reloj virtual")
+    parser.add_argument('--sorteos', type=int, default=1000)
+    parser.add_argument('--proporcion-etapas', type=float, default=0.3)
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--horas', type=float, default=12, help="Límite de tiempo virtual")
+    parser.add_argument('--sin-countdown', action='store_true', help="No correr el countdown de WAITING")
+    parser.add_argument('--proporcion-rooms-vacias', type=float, default=0.0,
+                        help="Proporción de sorteos sin clientes unidos a su room")
+    parser.add_argument('--json', action='store_true', help="Imprimir el reporte en JSON")
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--max-retraso-p95', type=float)
+    parser.add_argument('--max-consultas-por-transicion', type=float)
+    parser.add_argument('--max-eventos', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, force=True)
+    reporte = asyncio.run(simular(args))
+
+    if args.json:
+        print(json.dumps(reporte, indent=2, ensure_ascii=False))
+    else:
+        imprimir_reporte(reporte)
+
+    fallas = verificar_umbrales(reporte, args)
+    for falla in fallas:
+        print(f"❌ {falla}", file=sys.stderr)
+    sys.exit(1 if fallas else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,484 @@
 """
-Servicio para verificar periódicamente los estados de los sorteos
-Verifica cada 30 segundos si algún sorteo debe cambiar de estado
+Servicio que dispara las transiciones de estado de los sorteos por tiempo
+
+Mantiene un min-heap con el próximo vencimiento de cada sorteo (fecha_cierre o
+waiting_hasta según su estado) y duerme hasta el más cercano, así las transiciones
+por fecha ocurren a tiempo y los sorteos sin vencimiento no cuestan nada.
+El heap se reconstruye desde Mongo al iniciar y se actualiza cuando un sorteo se
+crea, edita, publica, pausa o cambia de estado (reprogramar_sorteo). Un vencimiento
+cuya transición correspondía pero no se escribió se reintenta con espera creciente.
+
+Las transiciones por boletos vendidos las disparan las compras y aprobaciones.
+Un barrido de seguridad poco frecuente revisa todos los sorteos por si se perdió algún aviso.
+
+El programador corre solo en el worker líder, o en todos los workers con el reparto de
+sorteos activo (particion_sorteos), cada uno con sus sorteos. Cada vencimiento se guarda
+también en 'proximo_vencimiento' del sorteo, así los cambios hechos en otros workers
+llegan al dueño con una consulta indexada cada SINCRONIZACION_SEGUNDOS.
 """
 import asyncio
+from collections import deque
+from datetime import datetime, timedelta
+import heapq
 import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import particion_sorteos
+import reloj
 
 logger = logging.getLogger(__name__)
 
 db = None
 state_machine = None
 
+# Barrido completo de respaldo (antes era cada 30s y era el único mecanismo)
+BARRIDO_SEGURIDAD_SEGUNDOS = int(os.environ.get('BARRIDO_SEGURIDAD_SEGUNDOS', '300'))
+
+# Cada cuánto el líder recoge vencimientos programados por otros workers
+SINCRONIZACION_SEGUNDOS = int(os.environ.get('PROGRAMADOR_SINCRONIZACION_SEGUNDOS', '5'))
+INDICE_VENCIMIENTO = 'sorteos_proximo_vencimiento'
+
+# Reintento de un vencimiento cuya transición falló (se duplica en cada intento)
+REINTENTO_SEGUNDOS = float(os.environ.get('PROGRAMADOR_REINTENTO_SEGUNDOS', '5'))
+REINTENTO_MAXIMO_SEGUNDOS = float(os.environ.get('PROGRAMADOR_REINTENTO_MAXIMO_SEGUNDOS', '300'))
+
+# El barrido evalúa todos los sorteos con una sola agregación (false = uno por uno)
+VERIFICADOR_MODO_LOTE = os.environ.get('VERIFICADOR_MODO_LOTE', 'true').lower() == 'true'
+
+# Campos que necesita la evaluación en lote (sin validar el modelo Sorteo completo)
+PROYECCION_EVALUACION = {
+    "_id": 0,
+    "id": 1,
+    "titulo": 1,
+    "estado": 1,
+    "tipo": 1,
+    "fecha_cierre": 1,
+    "waiting_hasta": 1,
+    "ventas_pausadas": 1,
+    "etapa_actual": 1,
+    "etapas.porcentaje": 1,
+    "umbrales_etapas": 1,
+    "cantidad_total_boletos": 1
+}
+
+# Últimos ciclos del barrido: duración vs cantidad de sorteos activos
+_ciclos = deque(maxlen=100)
+
+# Campos necesarios para calcular el próximo vencimiento
+PROYECCION_VENCIMIENTO = {
+    "_id": 0,
+    "id": 1,
+    "estado": 1,
+    "tipo": 1,
+    "fecha_cierre": 1,
+    "waiting_hasta": 1,
+    "ventas_pausadas": 1,
+    "etapa_actual": 1,
+    "etapas": 1,
+    "proximo_vencimiento": 1
+}
+
+# Para decidir si un vencimiento sin transición se reintenta
+PROYECCION_REINTENTO = {
+    **PROYECCION_VENCIMIENTO,
+    "cantidad_total_boletos": 1,
+    "cantidad_vendida": 1,
+    "umbrales_etapas": 1,
+    "transicion_reclamada_hasta": 1
+}
+
+# (vencimiento, sorteo_id, generación). Las entradas con generación vieja se ignoran.
+_heap: List[Tuple[datetime, str, int]] = []
+_generaciones: Dict[str, int] = {}
+_vencimientos: Dict[str, datetime] = {}
+# Intentos fallidos seguidos del vencimiento de cada sorteo
+_reintentos: Dict[str, int] = {}
+_despertar: Optional[asyncio.Event] = None
+
 def init_state_checker(database, sm_module):
     global db, state_machine
     db = database
     state_machine = sm_module
 
+async def asegurar_indices():
+    await db.sorteos.create_index(
+        'proximo_vencimiento',
+        name=INDICE_VENCIMIENTO,
+        sparse=True
+    )
+
+def _a_utc(valor) -> Optional[datetime]:
+    if not valor:
+        return None
+    if isinstance(valor, str):
+        valor = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+    return state_machine.normalize_datetime_to_utc(valor)
+
+def _mismo_instante(a: Optional[datetime], b: Optional[datetime]) -> bool:
+    """Comparar fechas con la precisión de Mongo (milisegundos)"""
+    if a is None or b is None:
+        return a is b
+    return abs((a - b).total_seconds()) < 0.001
+
+def calcular_proximo_vencimiento(sorteo: dict) -> Optional[datetime]:
+    """
+    Momento en que el sorteo puede cambiar de estado solo por el paso del tiempo.
+    None si su próxima transición depende únicamente de ventas (o no tiene ninguna).
+    """
+    estado = sorteo.get('estado')
+    es_etapas = sorteo.get('tipo') == 'etapas'
+
+    if estado == 'published':
+        if sorteo.get('ventas_pausadas'):
+            return None
+        if not es_etapas:
+            # UNICO: al llegar la fecha pasa a WAITING con o sin todos los boletos
+            return _a_utc(sorteo.get('fecha_cierre'))
+        # ETAPAS: solo la etapa final depende de la fecha (además de vender todo)
+        etapa_actual = sorteo.get('etapa_actual') or 1
+        if etapa_actual >= len(sorteo.get('etapas') or []):
+            return _a_utc(sorteo.get('fecha_cierre'))
+        return None
+
+    if estado == 'waiting':
+        if es_etapas:
+            return _a_utc(sorteo.get('waiting_hasta'))
+        # UNICO: a LIVE con fecha alcanzada y todos vendidos; si falta vender lo dispara la venta
+        return _a_utc(sorteo.get('fecha_cierre'))
+
+    return None
+
+def _programar(sorteo_id: str, vencimiento: Optional[datetime]):
+    # Fuera del líder el heap no se usa: el vencimiento queda en Mongo
+    if _despertar is None:
+        return
+
+    generacion = _generaciones.get(sorteo_id, 0) + 1
+    _generaciones[sorteo_id] = generacion
+
+    # Con el reparto activo cada worker programa solo sus sorteos
+    if vencimiento is None or not particion_sorteos.es_propietario(sorteo_id):
+        _vencimientos.pop(sorteo_id, None)
+        return
+
+    _vencimientos[sorteo_id] = vencimiento
+    heapq.heappush(_heap, (vencimiento, sorteo_id, generacion))
+    if _despertar and _heap[0][1] == sorteo_id:
+        _despertar.set()
+
+async def reprogramar_sorteo(sorteo_id: str, solo_futuros: bool = False):
+    """
+    Recalcular el vencimiento de un sorteo después de crearlo, editarlo o cambiar su estado.
+    Con solo_futuros se ignoran vencimientos ya pasados (evita repetir uno que no produjo transición).
+    """
+    if db is None:
+        return
+    sorteo = await db.sorteos.find_one({'id': sorteo_id}, PROYECCION_VENCIMIENTO)
+    vencimiento = calcular_proximo_vencimiento(sorteo) if sorteo else None
+    if vencimiento and solo_futuros and vencimiento <= reloj.ahora():
+        vencimiento = None
+    if sorteo:
+        await _persistir_vencimiento(sorteo, vencimiento)
+    _programar(sorteo_id, vencimiento)
+
+async def _persistir_vencimiento(sorteo: dict, vencimiento: Optional[datetime]):
+    """Guardar el vencimiento en el sorteo solo si cambió"""
+    if _mismo_instante(_a_utc(sorteo.get('proximo_vencimiento')), vencimiento):
+        return
+    await db.sorteos.update_one(
+        {'id': sorteo['id']},
+        {'$set': {'proximo_vencimiento': vencimiento}}
+    )
+
+def descartar_sorteo(sorteo_id: str):
+    """Quitar un sorteo eliminado del programador"""
+    _programar(sorteo_id, None)
+    _generaciones.pop(sorteo_id, None)
+    _reintentos.pop(sorteo_id, None)
+
+async def reconstruir_programacion(solo_futuros: bool = False) -> int:
+    """
+    Cargar desde Mongo los vencimientos de todos los sorteos publicados o en espera.
+    Al iniciar se incluyen los vencidos mientras el proceso no corría.
+    """
+    sorteos = await db.sorteos.find(
+        {'estado': {'$in': ['published', 'waiting']}},
+        PROYECCION_VENCIMIENTO
+    ).to_list(None)
+
+    ahora = reloj.ahora()
+    # Los reintentos pendientes conservan su momento aunque el vencimiento original haya pasado
+    reintentos = {sorteo_id: _vencimientos[sorteo_id] for sorteo_id in _reintentos if sorteo_id in _vencimientos}
+    _heap.clear()
+    _vencimientos.clear()
+    for sorteo in sorteos:
+        try:
+            vencimiento = calcular_proximo_vencimiento(sorteo)
+            if vencimiento and vencimiento <= ahora and sorteo['id'] in reintentos:
+                vencimiento = reintentos[sorteo['id']]
+            elif vencimiento and solo_futuros and vencimiento <= ahora:
+                vencimiento = None
+            await _persistir_vencimiento(sorteo, vencimiento)
+            _programar(sorteo['id'], vencimiento)
+        except Exception as e:
+            logger.error(f"❌ Error calculando vencimiento del sorteo {sorteo.get('id')}: {e}")
+
+    if _despertar:
+        _despertar.set()
+    return len(_vencimientos)
+
+def obtener_programacion() -> List[dict]:
+    """Vencimientos pendientes ordenados (para diagnóstico)"""
+    return [
+        {'sorteo_id': sorteo_id, 'vencimiento': vencimiento.isoformat()}
+        for sorteo_id, vencimiento in sorted(_vencimientos.items(), key=lambda item: item[1])
+    ]
+
+async def sincronizar_vencimientos():
+    """Agregar al heap los vencimientos cercanos que programaron otros workers"""
+    limite = reloj.ahora() + timedelta(seconds=SINCRONIZACION_SEGUNDOS)
+    proximos = await db.sorteos.find(
+        {'proximo_vencimiento': {'$ne': None, '$lte': limite}},
+        {"_id": 0, "id": 1, "proximo_vencimiento": 1}
+    ).to_list(None)
+    for sorteo in proximos:
+        if not particion_sorteos.es_propietario(sorteo['id']):
+            continue
+        vencimiento = _a_utc(sorteo['proximo_vencimiento'])
+        if not _mismo_instante(_vencimientos.get(sorteo['id']), vencimiento):
+            _programar(sorteo['id'], vencimiento)
+
+async def _ejecutar_vencimiento(sorteo_id: str, token_lider: Optional[int] = None):
+    resultado = None
+    fallo = False
+    try:
+        resultado = await state_machine.verificar_transicion_estado_nuevo(
+            sorteo_id, disparador='vencimiento', token_lider=token_lider
+        )
+        if resultado:
+            logger.info(f"✅ Sorteo {sorteo_id}: transición por vencimiento → {resultado}")
+    except Exception as e:
+        fallo = True
+        logger.error(f"❌ Error verificando sorteo {sorteo_id}: {e}")
+
+    if resultado:
+        _reintentos.pop(sorteo_id, None)
+        await reprogramar_sorteo(sorteo_id)
+    else:
+        await _reprogramar_sin_transicion(sorteo_id, fallo)
+
+async def _reprogramar_sin_transicion(sorteo_id: str, fallo: bool):
+    """
+    Vencimiento que no produjo transición. Si el estado ya cambió se programa el
+    siguiente; si la transición correspondía y no se escribió (error, compare-and-set
+    perdido o reclamo de otro proceso) se reintenta con espera creciente; si lo que
+    falta depende de ventas, el vencimiento pasado se descarta.
+    """
+    sorteo = await db.sorteos.find_one({'id': sorteo_id}, PROYECCION_REINTENTO)
+    if not sorteo:
+        descartar_sorteo(sorteo_id)
+        return
+
+    ahora = reloj.ahora()
+    vencimiento = calcular_proximo_vencimiento(sorteo)
+    if vencimiento and vencimiento <= ahora:
+        reclamado_hasta = _a_utc(sorteo.get('transicion_reclamada_hasta'))
+        pendiente = fallo or state_machine.transicion_candidata(sorteo, sorteo.get('cantidad_vendida', 0), ahora)
+        if reclamado_hasta and reclamado_hasta > ahora:
+            # Otro proceso la tiene reclamada: revisar cuando venza su reclamo
+            vencimiento = reclamado_hasta + timedelta(seconds=REINTENTO_SEGUNDOS)
+        elif pendiente:
+            intentos = _reintentos.get(sorteo_id, 0)
+            _reintentos[sorteo_id] = intentos + 1
+            espera = min(REINTENTO_SEGUNDOS * 2 ** intentos, REINTENTO_MAXIMO_SEGUNDOS)
+            vencimiento = ahora + timedelta(seconds=espera)
+            logger.warning(f"⚠️  Sorteo {sorteo_id}: transición por vencimiento sin aplicar, reintento en {espera:.0f}s")
+        else:
+            # Lo que falta depende de ventas: la venta que lo complete dispara la transición
+            vencimiento = None
+            _reintentos.pop(sorteo_id, None)
+    else:
+        _reintentos.pop(sorteo_id, None)
+
+    await _persistir_vencimiento(sorteo, vencimiento)
+    _programar(sorteo_id, vencimiento)
+
+async def ejecutar_programador():
+    """Dormir hasta el próximo vencimiento (o hasta que cambie la programación) y dispararlo"""
+    global _despertar
+    _despertar = asyncio.Event()
+    await reconstruir_programacion()
+    ultima_sincronizacion = reloj.monotonic()
+    generacion_particion = particion_sorteos.generacion()
+
+    while True:
+        try:
+            if reloj.monotonic() - ultima_sincronizacion >= SINCRONIZACION_SEGUNDOS:
+                if generacion_particion != particion_sorteos.generacion():
+                    # Cambiaron los workers vivos: tomar los sorteos que ahora son propios
+                    generacion_particion = particion_sorteos.generacion()
+                    await reconstruir_programacion()
+                await sincronizar_vencimientos()
+                ultima_sincronizacion = reloj.monotonic()
+
+            # Descartar entradas reemplazadas por una programación más nueva
+            while _heap and _generaciones.get(_heap[0][1]) != _heap[0][2]:
+                heapq.heappop(_heap)
+
+            ahora = reloj.ahora()
+            if _heap and _heap[0][0] <= ahora:
+                # Confirmar en Mongo que este worker sigue a cargo antes de escribir
+                token = await particion_sorteos.token_ciclo()
+                if token is None:
+                    logger.warning("⚠️  Programador sin lease de líder vigente, vencimientos en pausa")
+                    await reloj.dormir(SINCRONIZACION_SEGUNDOS)
+                    continue
+                _, sorteo_id, _ = heapq.heappop(_heap)
+                _vencimientos.pop(sorteo_id, None)
+                await _ejecutar_vencimiento(sorteo_id, token)
+                continue
+
+            espera = SINCRONIZACION_SEGUNDOS
+            if _heap:
+                espera = min(espera, (_heap[0][0] - ahora).total_seconds())
+            _despertar.clear()
+            await reloj.esperar_evento(_despertar, espera)
+
+        except Exception as e:
+            logger.error(f"❌ Error en programador de transiciones: {e}")
+            await reloj.dormir(1)
+
+async def evaluar_en_lote(disparador: str = 'barrido', solo_propios: bool = False,
+                          token_lider: Optional[int] = None) -> List[Tuple[str, str]]:
+    """
+    Evaluar todos los sorteos publicados o en espera con 2 consultas:
+    los sorteos con proyección reducida y los aprobados de todos en un solo $group.
+    Las reglas se evalúan en memoria y solo se ejecuta (y escribe) la transición
+    de los sorteos que realmente cambian. Retorna [(sorteo_id, nuevo_estado)].
+    solo_propios limita la evaluación a los sorteos de este worker (reparto activo).
+    token_lider protege las transiciones con el fencing token del líder.
+    """
+    inicio = time.perf_counter()
+    sorteos = await db.sorteos.find(
+        {'estado': {'$in': ['published', 'waiting']}},
+        PROYECCION_EVALUACION
+    ).to_list(None)
+    if solo_propios:
+        sorteos = [s for s in sorteos if particion_sorteos.es_propietario(s['id'])]
+
+    aprobados_por_sorteo = {}
+    if sorteos:
+        conteos = await db.boletos.aggregate([
+            {'$match': {
+                'sorteo_id': {'$in': [s['id'] for s in sorteos]},
+                'pago_confirmado': True
+            }},
+            {'$group': {'_id': '$sorteo_id', 'aprobados': {'$sum': 1}}}
+        ]).to_list(None)
+        aprobados_por_sorteo = {c['_id']: c['aprobados'] for c in conteos}
+
+    ahora = reloj.ahora()
+    transiciones = []
+    for sorteo in sorteos:
+        aprobados = aprobados_por_sorteo.get(sorteo['id'], 0)
+        try:
+            if not state_machine.transicion_candidata(sorteo, aprobados, ahora):
+                continue
+            resultado = await state_machine.verificar_transicion_estado_nuevo(
+                sorteo['id'], aprobados, disparador=disparador, token_lider=token_lider
+            )
+            if resultado:
+                transiciones.append((sorteo['id'], resultado))
+                logger.info(f"✅ Sorteo {sorteo.get('titulo', sorteo['id'])}: transición ejecutada en barrido → {resultado}")
+        except Exception as e:
+            logger.error(f"❌ Error verificando sorteo {sorteo['id']}: {e}")
+
+    _registrar_ciclo('lote', inicio, len(sorteos), len(transiciones))
+    return transiciones
+
+async def evaluar_uno_por_uno(disparador: str = 'barrido', solo_propios: bool = False,
+                              token_lider: Optional[int] = None) -> List[Tuple[str, str]]:
+    """Verificar cada sorteo no completado con la máquina de estados (modo anterior)"""
+    inicio = time.perf_counter()
+    # Buscar sorteos que NO están en COMPLETED
+    sorteos = await db.sorteos.find({
+        'estado': {'$ne': 'completed'}
+    }, {"_id": 0, "id": 1, "titulo": 1, "estado": 1, "tipo": 1}).to_list(None)
+    if solo_propios:
+        sorteos = [s for s in sorteos if particion_sorteos.es_propietario(s['id'])]
+
+    transiciones = []
+    for sorteo in sorteos:
+        try:
+            resultado = await state_machine.verificar_transicion_estado_nuevo(
+                sorteo['id'], disparador=disparador, token_lider=token_lider
+            )
+            if resultado:
+                transiciones.append((sorteo['id'], resultado))
+                logger.info(f"✅ Sorteo {sorteo['titulo']}: transición ejecutada en barrido → {resultado}")
+        except Exception as e:
+            logger.error(f"❌ Error verificando sorteo {sorteo['id']}: {e}")
+
+    _registrar_ciclo('uno_por_uno', inicio, len(sorteos), len(transiciones))
+    return transiciones
+
+def _registrar_ciclo(modo: str, inicio: float, sorteos_activos: int, transiciones: int):
+    _ciclos.append({
+        'modo': modo,
+        'fecha': reloj.ahora().isoformat(),
+        'duracion_ms': round((time.perf_counter() - inicio) * 1000, 2),
+        'sorteos_activos': sorteos_activos,
+        'transiciones': transiciones
+    })
+
+def obtener_metricas() -> dict:
+    """Duración de los últimos barridos frente a la cantidad de sorteos activos"""
+    ciclos = list(_ciclos)
+    return {
+        'modo_lote': VERIFICADOR_MODO_LOTE,
+        'barrido_seguridad_segundos': BARRIDO_SEGURIDAD_SEGUNDOS,
+        'vencimientos_programados': len(_vencimientos),
+        'duracion_promedio_ms': round(sum(c['duracion_ms'] for c in ciclos) / len(ciclos), 2) if ciclos else 0.0,
+        'ciclos': ciclos
+    }
+
 async def verificar_estados_periodicamente():
     """
-    Verifica cada 30 segundos TODOS los sorteos activos
+    Barrido de seguridad: verificar TODOS los sorteos activos y reconstruir el heap.
+    Cubre avisos perdidos (p.ej. cambios hechos por otro proceso).
     """
     while True:
+        await reloj.dormir(BARRIDO_SEGURIDAD_SEGUNDOS)
         try:
-            # Buscar sorteos que NO están en COMPLETED
-            sorteos = await db.sorteos.find({
-                'estado': {'$ne': 'completed'}
-            }, {"_id": 0, "id": 1, "titulo": 1, "estado": 1, "tipo": 1}).to_list(1000)
-            
-            for sorteo in sorteos:
-                try:
-                    resultado = await state_machine.verificar_transicion_estado_nuevo(sorteo['id'])
-                    if resultado:
-                        logger.info(f"✅ Sorteo {sorteo['titulo']}: transición ejecutada → {resultado}")
-                except Exception as e:
-                    logger.error(f"❌ Error verificando sorteo {sorteo['id']}: {e}")
-            
-            # Esperar 30 segundos antes de la siguiente verificación
-            await asyncio.sleep(30)
-            
+            token = await particion_sorteos.token_ciclo()
+            if token is None:
+                continue
+            if VERIFICADOR_MODO_LOTE:
+                await evaluar_en_lote(solo_propios=True, token_lider=token)
+            else:
+                await evaluar_uno_por_uno(solo_propios=True, token_lider=token)
+
+            await reconstruir_programacion(solo_futuros=True)
+
         except Exception as e:
             logger.error(f"❌ Error en verificación periódica: {e}")
-            await asyncio.sleep(60)
 
 def iniciar_verificador_estados():
-    """Iniciar tarea en background"""
-    asyncio.create_task(verificar_estados_periodicamente())
-    logger.info("✅ Verificador periódico de estados iniciado (cada 30s)")
+    """Iniciar tareas en background"""
+    tareas = [
+        asyncio.create_task(ejecutar_programador()),
+        asyncio.create_task(verificar_estados_periodicamente())
+    ]
+    logger.info(f"✅ Programador de transiciones iniciado (barrido de seguridad cada {BARRIDO_SEGURIDAD_SEGUNDOS}s)")
+    return tareas
+
+def detener_programador():
+    """Vaciar el heap al dejar de ser líder"""
+    global _despertar
+    _despertar = None
+    _heap.clear()
+    _vencimientos.clear()
+    _generaciones.clear()
+    _reintentos.clear()
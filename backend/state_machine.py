@@ -6,11 +6,18 @@ SORTEOS POR ETAPAS: Nueva lógica con WebSockets obligatorios
 """
 from datetime import datetime, timezone, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 import logging
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 import random
 import asyncio
 
+import cache_sorteos
+import liderazgo
+import reloj
+import timeline_transiciones
+import waiting_countdown_service
+
 logger = logging.getLogger(__name__)
 
 # Esta función debe ser llamada desde server.py después de importar los modelos
@@ -19,6 +26,9 @@ Sorteo = None
 SorteoEstado = None
 SorteoTipo = None
 
+# Tiempo máximo para elegir ganadores después de reclamar la transición a LIVE
+RECLAMO_TRANSICION = timedelta(seconds=60)
+
 def init_state_machine(database, sorteo_model, estado_enum, tipo_enum):
     global db, Sorteo, SorteoEstado, SorteoTipo
     db = database
@@ -36,18 +46,152 @@ def normalize_datetime_to_utc(dt):
     # Si ya tiene timezone, convertir a UTC
     return dt.astimezone(timezone.utc)
 
-async def verificar_transicion_estado_nuevo(sorteo_id: str) -> Optional[str]:
+def _valor(objeto, campo, default=None):
+    """Leer un campo de un dict o de un modelo"""
+    if isinstance(objeto, dict):
+        return objeto.get(campo, default)
+    return getattr(objeto, campo, default)
+
+def calcular_umbrales_etapas(sorteo) -> List[int]:
+    """
+    Boletos aprobados necesarios para cerrar cada etapa (mismo redondeo que
+    check_published_to_waiting). Acepta el documento del sorteo o el modelo.
+    """
+    total = _valor(sorteo, 'cantidad_total_boletos', 0)
+    return [
+        int(total * _valor(etapa, 'porcentaje', 0) / 100)
+        for etapa in (_valor(sorteo, 'etapas') or [])
+    ]
+
+def umbral_alcanzado(sorteo: dict) -> bool:
+    """
+    Decidir en memoria si la cantidad vendida puede disparar una transición.
+    Recibe el documento devuelto por contadores_sorteo.incrementar_vendidos;
+    si es False no hace falta llamar a verificar_transicion_estado_nuevo.
+    """
+    estado = sorteo.get('estado')
+    vendidos = sorteo.get('cantidad_vendida', 0)
+    todos_vendidos = vendidos >= sorteo.get('cantidad_total_boletos', 0)
+
+    if estado == 'waiting':
+        # Solo ÚNICO depende de ventas en WAITING (ETAPAS espera waiting_hasta)
+        return sorteo.get('tipo') != 'etapas' and todos_vendidos
+
+    if estado != 'published' or sorteo.get('ventas_pausadas'):
+        return False
+
+    if sorteo.get('tipo') != 'etapas':
+        return todos_vendidos
+
+    etapas = sorteo.get('etapas') or []
+    etapa_actual = sorteo.get('etapa_actual') or 1
+    if etapa_actual > len(etapas):
+        return False
+    if etapa_actual == len(etapas):
+        # Etapa final: todos vendidos (la fecha la revisa la máquina de estados)
+        return todos_vendidos
+
+    umbrales = sorteo.get('umbrales_etapas') or []
+    if len(umbrales) != len(etapas):
+        umbrales = calcular_umbrales_etapas(sorteo)
+    return vendidos >= umbrales[etapa_actual - 1]
+
+def _fecha_utc(valor):
+    if isinstance(valor, str):
+        valor = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+    return normalize_datetime_to_utc(valor)
+
+def transicion_candidata(sorteo: dict, boletos_aprobados: int, ahora: datetime) -> Optional[str]:
+    """
+    Evaluar en memoria las reglas de check_published_to_waiting / check_waiting_to_live
+    sobre un documento con proyección reducida. No consulta la base ni elige ganadores:
+    solo indica a qué estado pasaría el sorteo (o None).
+    """
+    estado = sorteo.get('estado')
+    es_etapas = sorteo.get('tipo') == 'etapas'
+    todos_vendidos = boletos_aprobados >= sorteo.get('cantidad_total_boletos', 0)
+    fecha_cierre = _fecha_utc(sorteo.get('fecha_cierre'))
+    fecha_alcanzada = fecha_cierre is not None and fecha_cierre <= ahora
+
+    if estado == 'published':
+        if sorteo.get('ventas_pausadas'):
+            return None
+        if not es_etapas:
+            return 'waiting' if (todos_vendidos or fecha_alcanzada) else None
+
+        etapas = sorteo.get('etapas') or []
+        etapa_actual = sorteo.get('etapa_actual') or 1
+        if etapa_actual > len(etapas):
+            return None
+        if etapa_actual == len(etapas):
+            return 'waiting' if (todos_vendidos and fecha_alcanzada) else None
+        umbrales = sorteo.get('umbrales_etapas') or []
+        if len(umbrales) != len(etapas):
+            umbrales = calcular_umbrales_etapas(sorteo)
+        return 'waiting' if boletos_aprobados >= umbrales[etapa_actual - 1] else None
+
+    if estado == 'waiting':
+        if not es_etapas:
+            return 'live' if (todos_vendidos and fecha_alcanzada) else None
+        waiting_hasta = _fecha_utc(sorteo.get('waiting_hasta'))
+        return 'live' if (waiting_hasta and ahora >= waiting_hasta) else None
+
+    return None
+
+def filtro_version(sorteo) -> dict:
+    """Condición sobre la versión leída (documento o modelo; los sorteos antiguos no tienen el campo)"""
+    version = _valor(sorteo, 'version') or 0
+    if version == 0:
+        return {'version': {'$in': [0, None]}}
+    return {'version': version}
+
+async def reclamar_transicion(filtro: dict, ahora: datetime) -> Optional[int]:
+    """
+    Marcar el sorteo como en transición (aumentando su versión) si nadie la tiene reclamada.
+    Retorna la nueva versión, o None si otro proceso ganó.
+    Un reclamo abandonado (proceso caído) vence a los RECLAMO_TRANSICION segundos.
+    """
+    result = await db.sorteos.find_one_and_update(
+        {
+            **filtro,
+            '$or': [
+                {'transicion_reclamada_hasta': {'$exists': False}},
+                {'transicion_reclamada_hasta': {'$lte': ahora}}
+            ]
+        },
+        {
+            '$set': {'transicion_reclamada_hasta': ahora + RECLAMO_TRANSICION},
+            '$inc': {'version': 1}
+        },
+        projection={'_id': 0, 'version': 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return result['version'] if result else None
+
+async def verificar_transicion_estado_nuevo(sorteo_id: str, boletos_aprobados: Optional[int] = None,
+                                            disparador: str = 'desconocido',
+                                            token_lider: Optional[int] = None) -> Optional[str]:
     """
     Máquina de estados:
     - SORTEOS ÚNICOS: lógica original (NO SE TOCA)
     - SORTEOS POR ETAPAS: nueva lógica con 5 min WAITING y WebSockets
+    
+    boletos_aprobados permite pasar un conteo ya calculado (p.ej. por la evaluación en lote);
+    por defecto se usa cantidad_vendida del sorteo.
+    disparador (vencimiento, barrido, compra, aprobacion, admin) queda en la línea de tiempo.
+    token_lider (servicios en background) descarta la escritura si un líder más nuevo ya
+    escribió el sorteo.
     """
-    sorteo_doc = await db.sorteos.find_one({'id': sorteo_id})
-    if not sorteo_doc:
+    medicion = timeline_transiciones.MedicionTransicion(sorteo_id, disparador)
+    # La caché compara la versión con Mongo antes de devolverlo (decisión que escribe)
+    sorteo = await medicion.db(cache_sorteos.obtener(sorteo_id, verificar=True))
+    if not sorteo:
         return None
     
-    sorteo = Sorteo(**sorteo_doc)
-    ahora = datetime.now(timezone.utc)
+    # Vencimiento programado antes de normalizar (para la línea de tiempo)
+    from state_checker_service import calcular_proximo_vencimiento
+    vencimiento = calcular_proximo_vencimiento(sorteo.model_dump())
+    ahora = reloj.ahora()
     
     # Normalizar TODAS las fechas del sorteo a UTC-aware
     sorteo.fecha_cierre = normalize_datetime_to_utc(sorteo.fecha_cierre)
@@ -68,31 +212,77 @@ async def verificar_transicion_estado_nuevo(sorteo_id: str) -> Optional[str]:
     
     # ==================== PUBLISHED → WAITING ====================
     if estado_actual == SorteoEstado.PUBLISHED:
-        transicion = await check_published_to_waiting(sorteo, ahora, sorteo_id)
+        transicion = await check_published_to_waiting(sorteo, ahora, sorteo_id, boletos_aprobados)
         if transicion:
             nuevo_estado, update_data = transicion
     
     # ==================== WAITING → LIVE ====================
     elif estado_actual == SorteoEstado.WAITING:
-        transicion = await check_waiting_to_live(sorteo, ahora, sorteo_id)
+        transicion = await check_waiting_to_live(sorteo, ahora, sorteo_id, boletos_aprobados)
         if transicion:
             nuevo_estado, update_data = transicion
     
     # Actualizar estado si cambió
     if nuevo_estado and nuevo_estado != estado_actual:
+        # Compare-and-set: solo escribe quien leyó el estado y la versión vigentes
+        filtro = {
+            'id': sorteo_id,
+            'estado': estado_actual,
+            **filtro_version(sorteo),
+            **liderazgo.filtro_token(token_lider)
+        }
+        
+        if nuevo_estado == SorteoEstado.LIVE:
+            # Reclamar la transición antes de elegir ganadores: los demás disparadores
+            # concurrentes fallan aquí y no repiten el sorteo
+            version_reclamada = await medicion.db(reclamar_transicion(filtro, ahora))
+            if version_reclamada is None:
+                logger.info(f"Sorteo {sorteo_id}: transición a {nuevo_estado} ya tomada por otro proceso")
+                return None
+            filtro = {'id': sorteo_id, 'version': version_reclamada, **liderazgo.filtro_token(token_lider)}
+            update_data.update(await medicion.db(ganadores_para_live(sorteo, sorteo_id)))
+        
         update_data['estado'] = nuevo_estado
         
-        await db.sorteos.update_one(
-            {'id': sorteo_id},
-            {'$set': update_data}
-        )
+        result = await medicion.db(db.sorteos.update_one(
+            filtro,
+            {
+                '$set': {**update_data, **liderazgo.set_token(token_lider)},
+                '$unset': {'transicion_reclamada_hasta': ''},
+                '$inc': {'version': 1}
+            }
+        ))
+        cache_sorteos.invalidar(sorteo_id)
+        if result.modified_count == 0:
+            logger.info(f"Sorteo {sorteo_id}: transición a {nuevo_estado} descartada (el sorteo cambió)")
+            return None
         
         logger.info(f"Sorteo {sorteo_id}: {estado_actual} → {nuevo_estado}")
         
+        # El actor del sorteo (si está en este worker) recarga su estado
+        from actores_sorteo import notificar_cambio
+        notificar_cambio(sorteo_id)
+        
+        # Programar el siguiente vencimiento (p.ej. waiting_hasta)
+        from state_checker_service import reprogramar_sorteo
+        await medicion.db(reprogramar_sorteo(sorteo_id))
+        await timeline_transiciones.registrar(medicion, estado_actual, nuevo_estado, vencimiento=vencimiento)
+        
         # Emitir evento WebSocket
         from websocket_manager import emit_sorteo_state_changed
         await emit_sorteo_state_changed(sorteo_id, nuevo_estado, update_data)
         
+        # Countdown de WAITING: el vencimiento se emite una sola vez
+        if nuevo_estado == SorteoEstado.WAITING:
+            await waiting_countdown_service.publicar_waiting(
+                sorteo_id,
+                update_data.get('waiting_hasta'),
+                update_data.get('etapa_actual', sorteo.etapa_actual),
+                sorteo.tipo
+            )
+        elif estado_actual == SorteoEstado.WAITING:
+            waiting_countdown_service.quitar_waiting(sorteo_id)
+        
         # Si pasó a LIVE, iniciar animación
         if nuevo_estado == SorteoEstado.LIVE:
             from live_animation_service import iniciar_animacion_live
@@ -103,7 +293,7 @@ async def verificar_transicion_estado_nuevo(sorteo_id: str) -> Optional[str]:
     return None
 
 
-async def check_published_to_waiting(sorteo, ahora, sorteo_id):
+async def check_published_to_waiting(sorteo, ahora, sorteo_id, boletos_aprobados: Optional[int] = None):
     """
     PUBLISHED → WAITING
     
@@ -115,11 +305,9 @@ async def check_published_to_waiting(sorteo, ahora, sorteo_id):
     """
     update_data = {}
     
-    # Contar boletos aprobados
-    boletos_aprobados = await db.boletos.count_documents({
-        'sorteo_id': sorteo_id,
-        'pago_confirmado': True
-    })
+    # Boletos aprobados: contador mantenido con $inc en aprobaciones, compras y rechazos
+    if boletos_aprobados is None:
+        boletos_aprobados = sorteo.cantidad_vendida
     
     if sorteo.tipo == SorteoTipo.UNICO:
         # ============ SORTEO ÚNICO (NO SE TOCA) ============
@@ -153,9 +341,11 @@ async def check_published_to_waiting(sorteo, ahora, sorteo_id):
         if etapa_actual_num <= len(sorteo.etapas):
             etapa_actual = sorteo.etapas[etapa_actual_num - 1]
             
-            # Calcular boletos necesarios para esta etapa
-            porcentaje_requerido = etapa_actual.porcentaje / 100
-            boletos_requeridos = int(sorteo.cantidad_total_boletos * porcentaje_requerido)
+            # Boletos necesarios para esta etapa (precalculados al publicar/editar)
+            if len(sorteo.umbrales_etapas) == len(sorteo.etapas):
+                boletos_requeridos = sorteo.umbrales_etapas[etapa_actual_num - 1]
+            else:
+                boletos_requeridos = int(sorteo.cantidad_total_boletos * etapa_actual.porcentaje / 100)
             
             # Verificar si se cumplió el porcentaje de esta etapa
             porcentaje_alcanzado = boletos_aprobados >= boletos_requeridos
@@ -186,7 +376,7 @@ async def check_published_to_waiting(sorteo, ahora, sorteo_id):
     return None
 
 
-async def check_waiting_to_live(sorteo, ahora, sorteo_id):
+async def check_waiting_to_live(sorteo, ahora, sorteo_id, boletos_aprobados: Optional[int] = None):
     """
     WAITING → LIVE
     
@@ -194,10 +384,8 @@ async def check_waiting_to_live(sorteo, ahora, sorteo_id):
     """
     update_data = {}
     
-    boletos_aprobados = await db.boletos.count_documents({
-        'sorteo_id': sorteo_id,
-        'pago_confirmado': True
-    })
+    if boletos_aprobados is None:
+        boletos_aprobados = sorteo.cantidad_vendida
     
     if sorteo.tipo == SorteoTipo.UNICO:
         # ============ SORTEO ÚNICO (NO SE TOCA) ============
@@ -205,11 +393,7 @@ async def check_waiting_to_live(sorteo, ahora, sorteo_id):
         fecha_alcanzada = sorteo.fecha_cierre <= ahora
         
         if todos_vendidos and fecha_alcanzada:
-            # Seleccionar ganadores antes de pasar a LIVE
-            if not sorteo.ganadores or len(sorteo.ganadores) == 0:
-                ganadores = await seleccionar_ganadores(sorteo_id, sorteo)
-                update_data['ganadores'] = ganadores
-            
+            # Los ganadores se eligen después de reclamar la transición (ganadores_para_live)
             update_data['fecha_live'] = ahora
             return (SorteoEstado.LIVE, update_data)
     
@@ -217,28 +401,43 @@ async def check_waiting_to_live(sorteo, ahora, sorteo_id):
         # ============ SORTEO POR ETAPAS (NUEVA LÓGICA) ============
         # Verificar si ya pasaron los 5 minutos de WAITING
         if sorteo.waiting_hasta and ahora >= sorteo.waiting_hasta:
-            # Pasar a LIVE
-            # Seleccionar ganadores de TODOS los premios de la etapa actual
-            ganadores_actuales = sorteo.ganadores if sorteo.ganadores else []
-            
-            # Verificar si ya se sorteó esta etapa
-            etapa_actual_num = sorteo.etapa_actual
-            ya_sorteado = any(g.get('etapa_numero') == etapa_actual_num or g.get('etapa') == etapa_actual_num for g in ganadores_actuales)
-            
-            if not ya_sorteado:
-                # Seleccionar ganadores para TODOS los premios de esta etapa
-                ganadores_etapa = await seleccionar_ganador_etapa(sorteo_id, sorteo, etapa_actual_num)
-                if ganadores_etapa:
-                    # ganadores_etapa ahora es una LISTA de ganadores
-                    update_data['ganadores'] = ganadores_actuales + ganadores_etapa
-                    logger.info(f"Sorteo {sorteo_id}: Seleccionados {len(ganadores_etapa)} ganadores para Etapa {etapa_actual_num}")
-            
+            # Pasar a LIVE (los ganadores de la etapa se eligen al aplicar la transición)
             update_data['fecha_live'] = ahora
             return (SorteoEstado.LIVE, update_data)
     
     return None
 
 
+async def ganadores_para_live(sorteo, sorteo_id) -> dict:
+    """
+    Elegir los ganadores que faltan para pasar a LIVE. Se llama solo después de
+    reclamar la transición, así un sorteo no se sortea dos veces.
+    """
+    update_data = {}
+    
+    if sorteo.tipo == SorteoTipo.UNICO:
+        if not sorteo.ganadores or len(sorteo.ganadores) == 0:
+            update_data['ganadores'] = await seleccionar_ganadores(sorteo_id, sorteo)
+        return update_data
+    
+    # Seleccionar ganadores de TODOS los premios de la etapa actual
+    ganadores_actuales = sorteo.ganadores if sorteo.ganadores else []
+    
+    # Verificar si ya se sorteó esta etapa
+    etapa_actual_num = sorteo.etapa_actual
+    ya_sorteado = any(g.get('etapa_numero') == etapa_actual_num or g.get('etapa') == etapa_actual_num for g in ganadores_actuales)
+    
+    if not ya_sorteado:
+        # Seleccionar ganadores para TODOS los premios de esta etapa
+        ganadores_etapa = await seleccionar_ganador_etapa(sorteo_id, sorteo, etapa_actual_num)
+        if ganadores_etapa:
+            # ganadores_etapa ahora es una LISTA de ganadores
+            update_data['ganadores'] = ganadores_actuales + ganadores_etapa
+            logger.info(f"Sorteo {sorteo_id}: Seleccionados {len(ganadores_etapa)} ganadores para Etapa {etapa_actual_num}")
+    
+    return update_data
+
+
 async def seleccionar_ganadores(sorteo_id: str, sorteo):
     """
     Seleccionar ganadores para SORTEO ÚNICO (NO SE TOCA)
@@ -274,7 +473,7 @@ async def seleccionar_ganadores(sorteo_id: str, sorteo):
             'numero_boleto': boleto['numero_boleto'],
             'premio': premio_nombre,
             'etapa_numero': None,
-            'fecha_seleccion': datetime.now(timezone.utc).isoformat()
+            'fecha_seleccion': reloj.ahora().isoformat()
         }
         
         ganadores.append(ganador)
@@ -338,7 +537,7 @@ async def seleccionar_ganador_etapa(sorteo_id: str, sorteo, etapa_num: int):
                 'premio_video': premio_video,
                 'etapa': etapa_num,
                 'etapa_numero': etapa_num,
-                'fecha_sorteo': datetime.now(timezone.utc).isoformat()
+                'fecha_sorteo': reloj.ahora().isoformat()
             }
             
             ganadores.append(ganador)
@@ -364,7 +563,7 @@ async def seleccionar_ganador_etapa(sorteo_id: str, sorteo, etapa_num: int):
                 'premio_video': None,
                 'etapa': etapa_num,
                 'etapa_numero': etapa_num,
-                'fecha_sorteo': datetime.now(timezone.utc).isoformat()
+                'fecha_sorteo': reloj.ahora().isoformat()
             }
             
             ganadores.append(ganador)
@@ -0,0 +1,148 @@
+"""
+Línea de tiempo de las transiciones de estado de los sorteos
+
+Cada transición aplicada por verificar_transicion_estado_nuevo o por el cierre de
+una animación LIVE se guarda en la colección capped 'timeline_transiciones':
+- disparador: vencimiento (programador), barrido, compra, aprobacion, admin o animacion
+- vencimiento: cuándo debía ocurrir según la programación (None si dependía de ventas)
+- fecha y retraso_ms: cuándo se aplicó y cuánto después del vencimiento
+- duracion_ms: desde que se empezó a evaluar hasta que quedó escrita
+- db_ms: parte de esa duración esperando a Mongo
+
+Además se acumulan histogramas en memoria (por worker) para ajustar el programador.
+"""
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import datetime
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from pymongo.errors import CollectionInvalid
+
+import reloj
+
+logger = logging.getLogger(__name__)
+
+db = None
+
+COLECCION = 'timeline_transiciones'
+# Tamaño de la colección capped: los registros más viejos se descartan solos
+TAMANO_BYTES = int(os.environ.get('TIMELINE_TRANSICIONES_BYTES', str(50 * 1024 * 1024)))
+# Límite superior (ms) de cada bucket de los histogramas; el último bucket es +inf
+BUCKETS_MS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 300000]
+
+
+class Histograma:
+    def __init__(self):
+        self.conteos = [0] * (len(BUCKETS_MS) + 1)
+        self.total = 0
+        self.suma = 0.0
+        self.maximo = 0.0
+
+    def registrar(self, valor_ms: float):
+        self.conteos[bisect_left(BUCKETS_MS, valor_ms)] += 1
+        self.total += 1
+        self.suma += valor_ms
+        self.maximo = max(self.maximo, valor_ms)
+
+    def resumen(self) -> dict:
+        etiquetas = [f"<={limite}" for limite in BUCKETS_MS] + ['+inf']
+        return {
+            'n': self.total,
+            'promedio': round(self.suma / self.total, 1) if self.total else 0.0,
+            'max': round(self.maximo, 1),
+            'buckets': dict(zip(etiquetas, self.conteos))
+        }
+
+
+class MedicionTransicion:
+    """Tiempo total y tiempo de Mongo de una transición en curso"""
+
+    def __init__(self, sorteo_id: str, disparador: str):
+        self.sorteo_id = sorteo_id
+        self.disparador = disparador
+        self.inicio = time.perf_counter()
+        self.db_segundos = 0.0
+
+    async def db(self, operacion):
+        """Esperar una operación de Mongo sumando su duración"""
+        inicio = time.perf_counter()
+        try:
+            return await operacion
+        finally:
+            self.db_segundos += time.perf_counter() - inicio
+
+
+# transición ('published→waiting') → métrica → histograma
+_histogramas: Dict[str, Dict[str, Histograma]] = defaultdict(lambda: defaultdict(Histograma))
+_disparadores: Dict[str, Counter] = defaultdict(Counter)
+
+def init_timeline(database):
+    global db
+    db = database
+
+async def asegurar_indices():
+    try:
+        await db.create_collection(COLECCION, capped=True, size=TAMANO_BYTES)
+    except CollectionInvalid:
+        pass  # ya existe
+    await db[COLECCION].create_index('sorteo_id', name='timeline_sorteo')
+
+def _estado(valor) -> str:
+    return getattr(valor, 'value', valor)
+
+async def registrar(medicion: MedicionTransicion, estado_anterior, estado_nuevo,
+                    vencimiento: Optional[datetime] = None):
+    """Guardar la transición aplicada y sumarla a los histogramas"""
+    ahora = reloj.ahora()
+    transicion = f"{_estado(estado_anterior)}→{_estado(estado_nuevo)}"
+    duracion_ms = round((time.perf_counter() - medicion.inicio) * 1000, 1)
+    db_ms = round(medicion.db_segundos * 1000, 1)
+    # Solo hay retraso si el vencimiento ya pasó (las ventas pueden adelantar la transición)
+    retraso_ms = None
+    if vencimiento and vencimiento <= ahora:
+        retraso_ms = round((ahora - vencimiento).total_seconds() * 1000, 1)
+
+    histogramas = _histogramas[transicion]
+    histogramas['duracion_ms'].registrar(duracion_ms)
+    histogramas['db_ms'].registrar(db_ms)
+    if retraso_ms is not None:
+        histogramas['retraso_ms'].registrar(retraso_ms)
+    _disparadores[transicion][medicion.disparador] += 1
+
+    if db is None:
+        return
+    try:
+        await db[COLECCION].insert_one({
+            'sorteo_id': medicion.sorteo_id,
+            'transicion': transicion,
+            'estado_anterior': _estado(estado_anterior),
+            'estado_nuevo': _estado(estado_nuevo),
+            'disparador': medicion.disparador,
+            'vencimiento': vencimiento,
+            'fecha': ahora,
+            'retraso_ms': retraso_ms,
+            'duracion_ms': duracion_ms,
+            'db_ms': db_ms
+        })
+    except Exception as e:
+        logger.error(f"❌ Error guardando transición de sorteo {medicion.sorteo_id} en la línea de tiempo: {e}")
+
+async def obtener_timeline(sorteo_id: str, limite: int = 100) -> List[dict]:
+    """Transiciones registradas de un sorteo, de la más reciente a la más antigua"""
+    return await db[COLECCION].find(
+        {'sorteo_id': sorteo_id},
+        {"_id": 0}
+    ).sort('$natural', -1).to_list(limite)
+
+def obtener_metricas() -> dict:
+    """Histogramas de retraso, duración y tiempo de Mongo por transición (este worker)"""
+    return {
+        transicion: {
+            'disparadores': dict(_disparadores[transicion]),
+            **{metrica: histograma.resumen() for metrica, histograma in histogramas.items()}
+        }
+        for transicion, histogramas in sorted(_histogramas.items())
+    }
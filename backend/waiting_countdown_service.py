@@ -1,68 +1,157 @@
 """
-Servicio para manejar el countdown de WAITING en tiempo real via WebSocket
-Env\u00eda actualizaciones cada segundo a todos los clientes conectados
+Countdown de WAITING por fecha límite via WebSocket
+
+El servidor no descuenta segundos: envía la fecha absoluta 'waiting_hasta' junto con
+la hora del servidor ('server_time') y el cliente calcula el tiempo restante en local.
+- waiting_countdown_update se emite una vez al entrar en WAITING (publicar_waiting) y
+  al cliente que se une a la room del sorteo (enviar_countdown)
+- hora_servidor se emite cada HORA_SYNC_SEGUNDOS a las rooms con countdown activo para
+  corregir la deriva del reloj del cliente; el cliente también puede pedirla con el
+  evento sincronizar_hora
+
+Los vencimientos se guardan en un registro en memoria alimentado por las transiciones
+de este worker. Cada RECONCILIAR_SEGUNDOS se reconstruye desde Mongo (solo los campos
+necesarios) para incluir las transiciones hechas por otros workers.
 """
 import asyncio
 from datetime import datetime, timezone
 import logging
+import os
+from typing import Dict, Optional
+
+import cache_sorteos
+import particion_sorteos
+import reloj
 
 logger = logging.getLogger(__name__)
 
 db = None
 SorteoEstado = None
 
+HORA_SYNC_SEGUNDOS = float(os.environ.get('WAITING_HORA_SYNC_SEGUNDOS', '30'))
+RECONCILIAR_SEGUNDOS = float(os.environ.get('WAITING_RECONCILIAR_SEGUNDOS', '60'))
+
+PROYECCION_WAITING = {"_id": 0, "id": 1, "waiting_hasta": 1, "etapa_actual": 1, "tipo": 1}
+
+# sorteo_id → {'waiting_hasta', 'etapa_actual', 'tipo'}
+_registro: Dict[str, dict] = {}
+
 def init_countdown_service(database, estado_enum):
     global db, SorteoEstado
     db = database
     SorteoEstado = estado_enum
 
-async def monitorear_countdowns_waiting():
+def _fecha_utc(fecha) -> Optional[datetime]:
+    if isinstance(fecha, str):
+        fecha = datetime.fromisoformat(fecha.replace('Z', '+00:00'))
+    if fecha and fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return fecha
+
+def _valor(campo) -> str:
+    return getattr(campo, 'value', campo)
+
+def _payload(sorteo_id: str, entrada: dict) -> dict:
+    ahora = reloj.ahora()
+    waiting_hasta = entrada['waiting_hasta']
+    return {
+        'sorteo_id': sorteo_id,
+        'waiting_hasta': waiting_hasta.isoformat(),
+        'server_time': ahora.isoformat(),
+        # Valor de referencia al momento de emitir; el cliente descuenta en local
+        'tiempo_restante': max(0, int((waiting_hasta - ahora).total_seconds())),
+        'etapa_actual': entrada.get('etapa_actual', 0),
+        'tipo': _valor(entrada.get('tipo', 'unico'))
+    }
+
+async def publicar_waiting(sorteo_id: str, waiting_hasta, etapa_actual: int = 0, tipo='unico'):
+    """Registrar el vencimiento de un sorteo que entró en WAITING y emitirlo una vez"""
+    from websocket_manager import emit_waiting_countdown_update
+
+    waiting_hasta = _fecha_utc(waiting_hasta)
+    if not waiting_hasta:
+        return
+    entrada = {'waiting_hasta': waiting_hasta, 'etapa_actual': etapa_actual, 'tipo': tipo}
+    _registro[sorteo_id] = entrada
+    await emit_waiting_countdown_update(sorteo_id, _payload(sorteo_id, entrada))
+
+def quitar_waiting(sorteo_id: str):
+    """Olvidar el countdown de un sorteo que salió de WAITING"""
+    _registro.pop(sorteo_id, None)
+
+async def enviar_countdown(sorteo_id: str, sid: str):
+    """Enviar el countdown vigente (si lo hay) a un cliente que se acaba de unir"""
+    from websocket_manager import emit_waiting_countdown_update
+
+    entrada = _registro.get(sorteo_id)
+    if not entrada:
+        # Este worker puede no tener el registro (no es dueño del sorteo)
+        if cache_sorteos.db is None:
+            return
+        sorteo = await cache_sorteos.obtener(sorteo_id)
+        if not sorteo or sorteo.estado != SorteoEstado.WAITING or not sorteo.waiting_hasta:
+            return
+        entrada = {
+            'waiting_hasta': _fecha_utc(sorteo.waiting_hasta),
+            'etapa_actual': sorteo.etapa_actual,
+            'tipo': sorteo.tipo
+        }
+    await emit_waiting_countdown_update(sorteo_id, _payload(sorteo_id, entrada), room=sid)
+
+async def reconstruir_registro():
+    """Cargar desde Mongo los vencimientos de todos los sorteos en WAITING"""
+    sorteos_waiting = await db.sorteos.find({
+        'estado': 'waiting',
+        'waiting_hasta': {'$ne': None}
+    }, PROYECCION_WAITING).to_list(None)
+
+    _registro.clear()
+    for sorteo in sorteos_waiting:
+        _registro[sorteo['id']] = {
+            'waiting_hasta': _fecha_utc(sorteo['waiting_hasta']),
+            'etapa_actual': sorteo.get('etapa_actual', 0),
+            'tipo': sorteo.get('tipo', 'unico')
+        }
+
+async def sincronizar_countdowns_waiting():
     """
-    Monitorea TODOS los sorteos en estado WAITING y env\u00eda actualizaciones cada segundo
+    Emite la hora del servidor a las rooms de los sorteos propios con countdown activo
+    y reconstruye el registro cada RECONCILIAR_SEGUNDOS
     """
-    from websocket_manager import emit_waiting_countdown_update
-    
+    from websocket_manager import emit_hora_servidor, room_ocupada
+
+    ultima_reconstruccion = None
     while True:
         try:
-            # Buscar todos los sorteos en WAITING
-            sorteos_waiting = await db.sorteos.find({
-                'estado': 'waiting',
-                'waiting_hasta': {'$exists': True}
-            }, {"_id": 0}).to_list(100)
-            
-            ahora = datetime.now(timezone.utc)
-            
-            for sorteo in sorteos_waiting:
-                # Asegurar timezone
-                waiting_hasta = sorteo.get('waiting_hasta')
-                if not waiting_hasta:
+            if ultima_reconstruccion is None or reloj.monotonic() - ultima_reconstruccion >= RECONCILIAR_SEGUNDOS:
+                await reconstruir_registro()
+                ultima_reconstruccion = reloj.monotonic()
+
+            ahora = reloj.ahora()
+            # Sin reparto solo el líder sincroniza: confirmar el lease en cada ciclo
+            if await particion_sorteos.token_ciclo() is None:
+                await reloj.dormir(HORA_SYNC_SEGUNDOS)
+                continue
+            for sorteo_id, entrada in list(_registro.items()):
+                # Vencido: la transición a LIVE lo quitará (o la próxima reconstrucción)
+                if entrada['waiting_hasta'] <= ahora:
                     continue
-                    
-                if waiting_hasta.tzinfo is None:
-                    waiting_hasta = waiting_hasta.replace(tzinfo=timezone.utc)
-                
-                # Calcular tiempo restante en segundos
-                tiempo_restante = (waiting_hasta - ahora).total_seconds()
-                tiempo_restante = max(0, int(tiempo_restante))
-                
-                # Emitir actualizaci\u00f3n via WebSocket
-                await emit_waiting_countdown_update(sorteo['id'], {
-                    'sorteo_id': sorteo['id'],
-                    'tiempo_restante': tiempo_restante,
-                    'waiting_hasta': waiting_hasta.isoformat(),
-                    'timestamp': ahora.isoformat(),
-                    'etapa_actual': sorteo.get('etapa_actual', 0),
-                    'tipo': sorteo.get('tipo', 'unico')
+                # Cada worker sincroniza solo las rooms de sus sorteos, y solo si hay alguien
+                if not particion_sorteos.es_propietario(sorteo_id) or not room_ocupada(sorteo_id):
+                    continue
+                await emit_hora_servidor(sorteo_id, {
+                    'sorteo_id': sorteo_id,
+                    'server_time': ahora.isoformat()
                 })
-            
-            # Esperar 1 segundo antes de la siguiente actualizaci\u00f3n
-            await asyncio.sleep(1)
-            
+
+            await reloj.dormir(HORA_SYNC_SEGUNDOS)
+
         except Exception as e:
-            logger.error(f"Error en monitoreo de countdowns: {e}")
-            await asyncio.sleep(5)  # Esperar m\u00e1s tiempo en caso de error
+            logger.error(f"Error en sincronización de countdowns: {e}")
+            await reloj.dormir(5)  # Esperar más tiempo en caso de error
 
 def iniciar_monitoreo_countdowns():
-    """Iniciar tarea en background para monitorear countdowns"""
-    asyncio.create_task(monitorear_countdowns_waiting())
+    """Iniciar tarea en background para sincronizar countdowns"""
+    tarea = asyncio.create_task(sincronizar_countdowns_waiting())
     logger.info("✅ Servicio de countdown WAITING iniciado")
+    return tarea
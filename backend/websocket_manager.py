@@ -1,16 +1,39 @@
 """
 WebSocket Manager para manejo de eventos en tiempo real
+
+El gestor de clientes (gestores_socketio) decide si los emits llegan solo a los
+clientes de este proceso o a los de todos los workers. Con un gestor distribuido la
+ocupación de las rooms también se comparte: cada worker anota en 'rooms_ocupadas'
+las rooms donde tiene clientes y lee las de los demás cada OCUPACION_SEGUNDOS.
+
+Los eventos periódicos (ticks de LIVE, countdown y hora del servidor, inicio de la
+animación) van a una room aparte por formato: 'sorteo_<id>_json' para los clientes
+normales y 'sorteo_<id>_compacto' para los que pidieron la codificación binaria
+(codificacion_compacta) al unirse o con el evento formato_compacto.
 """
+import os
 import socketio
-from typing import Dict, Set
+from datetime import timedelta
+from typing import Dict, Optional, Set
 import asyncio
 import logging
 
+import codificacion_compacta
+import gestores_socketio
+import liderazgo
+import reloj
+
 logger = logging.getLogger(__name__)
 
+db = None
+
+OCUPACION_SEGUNDOS = float(os.environ.get('ROOMS_OCUPACION_SEGUNDOS', '5'))
+INDICE_OCUPACION = 'rooms_ocupadas_ttl'
+
 # Crear el servidor Socket.IO con modo asgi
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=gestores_socketio.crear_gestor(),
     cors_allowed_origins='*',
     logger=True,
     engineio_logger=True
@@ -18,6 +41,134 @@ sio = socketio.AsyncServer(
 
 # Diccionario para rastrear usuarios conectados por sorteo
 sorteo_rooms: Dict[str, Set[str]] = {}
+# sids de cada sorteo que reciben los eventos periódicos en formato compacto
+_compactos_por_sorteo: Dict[str, Set[str]] = {}
+# Rooms con clientes en otros workers (solo con gestor distribuido)
+_rooms_remotas: Set[str] = set()
+_tarea_ocupacion: Optional[asyncio.Task] = None
+
+def init_websocket(database):
+    global db
+    db = database
+
+async def asegurar_indices():
+    # Los registros de un worker caído expiran solos
+    await db.rooms_ocupadas.create_index(
+        'renovado_en',
+        name=INDICE_OCUPACION,
+        expireAfterSeconds=int(OCUPACION_SEGUNDOS * 6)
+    )
+
+def suscriptores(sorteo_id: str) -> int:
+    """Clientes unidos a la room del sorteo en este worker"""
+    return len(sorteo_rooms.get(sorteo_id, ()))
+
+def room_ocupada(sorteo_id: str) -> bool:
+    """Si alguien recibe los eventos del sorteo (los productores periódicos omiten las vacías)"""
+    return bool(sorteo_rooms.get(sorteo_id)) or sorteo_id in _rooms_remotas
+
+async def _publicar_ocupacion(sorteo_id: str, ocupada: bool):
+    """Anotar (o borrar) que este worker tiene clientes en la room del sorteo"""
+    if db is None or not gestores_socketio.es_distribuido():
+        return
+    clave = f"{liderazgo.WORKER_ID}:{sorteo_id}"
+    try:
+        if ocupada:
+            await db.rooms_ocupadas.update_one(
+                {'_id': clave},
+                {'$set': {
+                    'sorteo_id': sorteo_id,
+                    'worker_id': liderazgo.WORKER_ID,
+                    'renovado_en': reloj.ahora()
+                }},
+                upsert=True
+            )
+        else:
+            await db.rooms_ocupadas.delete_one({'_id': clave})
+    except Exception as e:
+        logger.error(f"❌ Error publicando ocupación de sorteo {sorteo_id}: {e}")
+
+async def _agregar_a_room(sorteo_id: str, sid: str):
+    if sorteo_id not in sorteo_rooms:
+        sorteo_rooms[sorteo_id] = set()
+        await _publicar_ocupacion(sorteo_id, True)
+    sorteo_rooms[sorteo_id].add(sid)
+
+async def _quitar_de_room(sorteo_id: str, sid: str):
+    _marcar_compacto(sorteo_id, sid, False)
+    if sorteo_id in sorteo_rooms and sid in sorteo_rooms[sorteo_id]:
+        sorteo_rooms[sorteo_id].remove(sid)
+        if not sorteo_rooms[sorteo_id]:
+            del sorteo_rooms[sorteo_id]
+            await _publicar_ocupacion(sorteo_id, False)
+
+def _room_periodica(sorteo_id: str, compacto: bool) -> str:
+    return f"sorteo_{sorteo_id}_{'compacto' if compacto else 'json'}"
+
+def _marcar_compacto(sorteo_id: str, sid: str, compacto: bool):
+    if compacto:
+        _compactos_por_sorteo.setdefault(sorteo_id, set()).add(sid)
+    elif sid in _compactos_por_sorteo.get(sorteo_id, ()):
+        _compactos_por_sorteo[sorteo_id].discard(sid)
+        if not _compactos_por_sorteo[sorteo_id]:
+            del _compactos_por_sorteo[sorteo_id]
+
+async def _cambiar_formato(sorteo_id: str, sid: str, compacto: bool):
+    """Mover al cliente a la room periódica de su formato"""
+    await sio.leave_room(sid, _room_periodica(sorteo_id, not compacto))
+    await sio.enter_room(sid, _room_periodica(sorteo_id, compacto))
+    _marcar_compacto(sorteo_id, sid, compacto)
+
+def _formatos(sorteo_id: str):
+    """(json, compacto): qué formatos tienen clientes en la room del sorteo"""
+    if not room_ocupada(sorteo_id):
+        return False, False
+    if gestores_socketio.es_distribuido():
+        # No se sabe el formato de los clientes de otros workers
+        return True, True
+    compactos = len(_compactos_por_sorteo.get(sorteo_id, ()))
+    return suscriptores(sorteo_id) > compactos, compactos > 0
+
+async def sincronizar_ocupacion():
+    """Renovar las rooms propias y leer las rooms ocupadas en los demás workers"""
+    global _rooms_remotas
+    while True:
+        try:
+            ahora = reloj.ahora()
+            await db.rooms_ocupadas.update_many(
+                {'worker_id': liderazgo.WORKER_ID},
+                {'$set': {'renovado_en': ahora}}
+            )
+            remotas = await db.rooms_ocupadas.find(
+                {
+                    'worker_id': {'$ne': liderazgo.WORKER_ID},
+                    'renovado_en': {'$gt': ahora - timedelta(seconds=OCUPACION_SEGUNDOS * 3)}
+                },
+                {'_id': 0, 'sorteo_id': 1}
+            ).to_list(None)
+            _rooms_remotas = {r['sorteo_id'] for r in remotas}
+        except Exception as e:
+            logger.error(f"❌ Error sincronizando ocupación de rooms: {e}")
+        await reloj.dormir(OCUPACION_SEGUNDOS)
+
+def iniciar_ocupacion_compartida():
+    """Compartir la ocupación de rooms entre workers (solo con gestor distribuido)"""
+    global _tarea_ocupacion
+    if not gestores_socketio.es_distribuido():
+        return None
+    _tarea_ocupacion = asyncio.create_task(sincronizar_ocupacion())
+    logger.info("✅ Ocupación de rooms compartida entre workers")
+    return _tarea_ocupacion
+
+async def detener_ocupacion():
+    """Dejar de compartir y borrar las rooms de este worker"""
+    if _tarea_ocupacion:
+        _tarea_ocupacion.cancel()
+    if db is not None and gestores_socketio.es_distribuido():
+        try:
+            await db.rooms_ocupadas.delete_many({'worker_id': liderazgo.WORKER_ID})
+        except Exception as e:
+            logger.error(f"❌ Error borrando ocupación de rooms del worker: {e}")
 
 @sio.event
 async def connect(sid, environ):
@@ -31,22 +182,51 @@ async def disconnect(sid):
     logger.info(f"Cliente desconectado: {sid}")
     # Remover de todas las rooms
     for sorteo_id in list(sorteo_rooms.keys()):
-        if sid in sorteo_rooms[sorteo_id]:
-            sorteo_rooms[sorteo_id].remove(sid)
-            if not sorteo_rooms[sorteo_id]:
-                del sorteo_rooms[sorteo_id]
+        await _quitar_de_room(sorteo_id, sid)
 
 @sio.event
 async def join_sorteo(sid, data):
     """Unirse a una room de sorteo específico"""
     sorteo_id = data.get('sorteo_id')
     if sorteo_id:
+        compacto = bool(data.get('compacto'))
         await sio.enter_room(sid, f'sorteo_{sorteo_id}')
-        if sorteo_id not in sorteo_rooms:
-            sorteo_rooms[sorteo_id] = set()
-        sorteo_rooms[sorteo_id].add(sid)
+        await _cambiar_formato(sorteo_id, sid, compacto)
+        await _agregar_a_room(sorteo_id, sid)
         logger.info(f"Cliente {sid} se unió a sorteo {sorteo_id}")
-        await sio.emit('joined_sorteo', {'sorteo_id': sorteo_id}, room=sid)
+        respuesta = {'sorteo_id': sorteo_id}
+        if compacto:
+            respuesta['codigo_sorteo'] = codificacion_compacta.codigo_sorteo(sorteo_id)
+        await sio.emit('joined_sorteo', respuesta, room=sid)
+        # Estado actual para el cliente que llega: las rooms vacías no reciben los
+        # eventos periódicos, así que nadie más se lo va a enviar
+        from waiting_countdown_service import enviar_countdown
+        from live_animation_service import enviar_estado_animacion
+        await enviar_countdown(sorteo_id, sid)
+        await enviar_estado_animacion(sorteo_id, sid)
+
+@sio.event
+async def sincronizar_hora(sid, data=None):
+    """Responder (ack) con la hora del servidor para calcular el desfase del cliente"""
+    return {
+        'server_time': reloj.ahora().isoformat(),
+        'client_time': (data or {}).get('client_time')
+    }
+
+@sio.event
+async def formato_compacto(sid, data):
+    """Activar (o desactivar) la codificación compacta de los eventos periódicos de un sorteo"""
+    sorteo_id = data.get('sorteo_id')
+    if not sorteo_id or sid not in sorteo_rooms.get(sorteo_id, ()):
+        return {'error': 'Primero hay que unirse al sorteo'}
+    compacto = bool(data.get('activar', True))
+    await _cambiar_formato(sorteo_id, sid, compacto)
+    return {
+        'sorteo_id': sorteo_id,
+        'compacto': compacto,
+        'evento': codificacion_compacta.EVENTO_COMPACTO,
+        'codigo_sorteo': codificacion_compacta.codigo_sorteo(sorteo_id)
+    }
 
 @sio.event
 async def leave_sorteo(sid, data):
@@ -54,13 +234,29 @@ async def leave_sorteo(sid, data):
     sorteo_id = data.get('sorteo_id')
     if sorteo_id:
         await sio.leave_room(sid, f'sorteo_{sorteo_id}')
-        if sorteo_id in sorteo_rooms and sid in sorteo_rooms[sorteo_id]:
-            sorteo_rooms[sorteo_id].remove(sid)
-            if not sorteo_rooms[sorteo_id]:
-                del sorteo_rooms[sorteo_id]
+        await sio.leave_room(sid, _room_periodica(sorteo_id, False))
+        await sio.leave_room(sid, _room_periodica(sorteo_id, True))
+        await _quitar_de_room(sorteo_id, sid)
         logger.info(f"Cliente {sid} salió de sorteo {sorteo_id}")
 
 # Funciones para emitir eventos
+async def _emit_periodico(evento: str, sorteo_id: str, datos: dict, room: str = None):
+    """Evento periódico en JSON y/o compacto según los formatos de los clientes (o de un cliente)"""
+    if room:
+        if room in _compactos_por_sorteo.get(sorteo_id, ()):
+            datos_compactos = codificacion_compacta.codificar(evento, sorteo_id, datos)
+            await sio.emit(codificacion_compacta.EVENTO_COMPACTO, datos_compactos, room=room)
+        else:
+            await sio.emit(evento, datos, room=room)
+        return
+    
+    json_, compacto = _formatos(sorteo_id)
+    if json_:
+        await sio.emit(evento, datos, room=_room_periodica(sorteo_id, False))
+    if compacto:
+        datos_compactos = codificacion_compacta.codificar(evento, sorteo_id, datos)
+        await sio.emit(codificacion_compacta.EVENTO_COMPACTO, datos_compactos, room=_room_periodica(sorteo_id, True))
+
 async def emit_sorteo_updated(sorteo_id: str, sorteo_data: dict):
     """Emitir actualización de sorteo a todos los clientes suscritos"""
     await sio.emit('sorteo_updated', sorteo_data, room=f'sorteo_{sorteo_id}')
@@ -80,12 +276,12 @@ async def emit_sorteo_state_changed(sorteo_id: str, new_state: str, data: dict =
 
 async def emit_live_animation_start(sorteo_id: str, data: dict):
     """Iniciar animación LIVE"""
-    await sio.emit('live_animation_start', data, room=f'sorteo_{sorteo_id}')
+    await _emit_periodico('live_animation_start', sorteo_id, data)
     logger.info(f"Iniciada animación LIVE para sorteo {sorteo_id}")
 
-async def emit_live_prize_drawing(sorteo_id: str, prize_data: dict):
-    """Emitir sorteo de un premio específico"""
-    await sio.emit('live_prize_drawing', prize_data, room=f'sorteo_{sorteo_id}')
+async def emit_live_prize_drawing(sorteo_id: str, prize_data: dict, room: str = None):
+    """Emitir sorteo de un premio específico (a la room del sorteo o a un cliente)"""
+    await sio.emit('live_prize_drawing', prize_data, room=room or f'sorteo_{sorteo_id}')
     logger.info(f"Sorteando premio para sorteo {sorteo_id}")
 
 async def emit_live_winner_announced(sorteo_id: str, winner_data: dict):
@@ -93,13 +289,17 @@ async def emit_live_winner_announced(sorteo_id: str, winner_data: dict):
     await sio.emit('live_winner_announced', winner_data, room=f'sorteo_{sorteo_id}')
     logger.info(f"Ganador anunciado para sorteo {sorteo_id}")
 
-async def emit_live_time_update(sorteo_id: str, time_data: dict):
-    """Emitir actualización de tiempo cada segundo"""
-    await sio.emit('live_time_update', time_data, room=f'sorteo_{sorteo_id}')
+async def emit_live_time_update(sorteo_id: str, time_data: dict, room: str = None):
+    """Emitir actualización de tiempo cada segundo (a la room del sorteo o a un cliente)"""
+    await _emit_periodico('live_time_update', sorteo_id, time_data, room=room)
+
+async def emit_waiting_countdown_update(sorteo_id: str, countdown_data: dict, room: str = None):
+    """Emitir el vencimiento del countdown WAITING (a la room del sorteo o a un cliente)"""
+    await _emit_periodico('waiting_countdown_update', sorteo_id, countdown_data, room=room)
 
-async def emit_waiting_countdown_update(sorteo_id: str, countdown_data: dict):
-    """Emitir actualización de countdown WAITING cada segundo"""
-    await sio.emit('waiting_countdown_update', countdown_data, room=f'sorteo_{sorteo_id}')
+async def emit_hora_servidor(sorteo_id: str, hora_data: dict):
+    """Emitir la hora del servidor para que los clientes corrijan su countdown"""
+    await _emit_periodico('hora_servidor', sorteo_id, hora_data)
 
 async def emit_live_animation_complete(sorteo_id: str, data: dict):
     """Completar animación LIVE"""
@@ -132,6 +132,48 @@ class WebSocketService {
     }
   }
 
+  // Countdown de WAITING: llega el vencimiento absoluto (waiting_hasta) y la hora del
+  // servidor; el tiempo restante se calcula en local con getServerNow()
+  onWaitingCountdownUpdate(callback) {
+    if (this.socket) {
+      this.socket.on('waiting_countdown_update', (data) => {
+        this.ajustarDesfase(data.server_time);
+        callback(data);
+      });
+    }
+  }
+
+  onHoraServidor(callback) {
+    if (this.socket) {
+      this.socket.on('hora_servidor', (data) => {
+        this.ajustarDesfase(data.server_time);
+        if (callback) callback(data);
+      });
+    }
+  }
+
+  // Pedir la hora del servidor (ack) y compensar la mitad del tiempo de ida y vuelta
+  sincronizarHora() {
+    if (this.socket && this.connected) {
+      const enviado = Date.now();
+      this.socket.emit('sincronizar_hora', { client_time: new Date(enviado).toISOString() }, (data) => {
+        const latencia = (Date.now() - enviado) / 2;
+        this.ajustarDesfase(data.server_time, latencia);
+      });
+    }
+  }
+
+  ajustarDesfase(serverTime, latencia = 0) {
+    if (serverTime) {
+      this.desfaseServidor = new Date(serverTime).getTime() + latencia - Date.now();
+    }
+  }
+
+  // Hora actual según el servidor (en ms)
+  getServerNow() {
+    return Date.now() + (this.desfaseServidor || 0);
+  }
+
   onLiveWinnerAnnounced(callback) {
     if (this.socket) {
       this.socket.on('live_winner_announced', callback);
@@ -187,6 +229,18 @@ class WebSocketService {
     }
   }
 
+  offWaitingCountdownUpdate() {
+    if (this.socket) {
+      this.socket.off('waiting_countdown_update');
+    }
+  }
+
+  offHoraServidor() {
+    if (this.socket) {
+      this.socket.off('hora_servidor');
+    }
+  }
+
   offLiveWinnerAnnounced(callback) {
     if (this.socket) {
       this.socket.off('live_winner_announced', callback);
@@ -0,0 +1,12 @@
+"""
+Configuración común de las pruebas
+
+Los módulos del backend se importan por nombre (import state_machine), igual que
+los importa server.py, así que se agrega backend/ al path.
+"""
+import os
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
@@ -0,0 +1,109 @@
+"""
+Codificación compacta: empaquetar() debe producir MessagePack que lea cualquier decodificador
+
+Los bytes esperados de cada forma están escritos a mano según la especificación, así que
+el codificador se prueba aunque falte la librería msgpack; con ella instalada
+(backend/requirements.txt) también se compara contra la implementación de referencia.
+"""
+from datetime import datetime, timezone
+
+import pytest
+
+import codificacion_compacta
+
+
+@pytest.fixture
+def msgpack():
+    return pytest.importorskip('msgpack')
+
+BYTES_ESPERADOS = [
+    (None, 'c0'), (True, 'c3'), (False, 'c2'),
+    (0, '00'), (127, '7f'), (128, 'cc80'), (255, 'ccff'), (256, 'cd0100'), (65535, 'cdffff'),
+    (65536, 'ce00010000'), (2 ** 32 - 1, 'ceffffffff'), (2 ** 32, 'cf0000000100000000'),
+    (2 ** 64 - 1, 'cfffffffffffffffff'),
+    (-1, 'ff'), (-32, 'e0'), (-33, 'd0df'), (-128, 'd080'), (-129, 'd1ff7f'), (-32768, 'd18000'),
+    (-32769, 'd2ffff7fff'), (-2 ** 31, 'd280000000'), (-2 ** 31 - 1, 'd3ffffffff7fffffff'),
+    (-2 ** 63, 'd38000000000000000'),
+    (1.5, 'cb3ff8000000000000'), (-2.25, 'cbc002000000000000'),
+    ('', 'a0'), ('a', 'a161'), ('ñ', 'a2c3b1'), ('x' * 31, 'bf' + '78' * 31), ('x' * 32, 'd920' + '78' * 32),
+    ('x' * 255, 'd9ff' + '78' * 255), ('x' * 256, 'da0100' + '78' * 256),
+    ('x' * 65536, 'db00010000' + '78' * 65536),
+    (b'', 'c400'), (b'\x00\xff', 'c40200ff'), (b'b' * 256, 'c50100' + '62' * 256),
+    (b'b' * 65536, 'c600010000' + '62' * 65536),
+    ([], '90'), (list(range(15)), '9f' + ''.join(f'{n:02x}' for n in range(15))),
+    (list(range(16)), 'dc0010' + ''.join(f'{n:02x}' for n in range(16))),
+    ([0] * 65536, 'dd00010000' + '00' * 65536),
+    ({}, '80'), ({'a': 1}, '81a16101'),
+    ({chr(97 + n): n for n in range(16)}, 'de0010' + ''.join(f'a1{97 + n:02x}{n:02x}' for n in range(16))),
+    ({'a': [None, True]}, '81a16192c0c3'),
+]
+
+
+@pytest.mark.parametrize('valor,esperado', BYTES_ESPERADOS, ids=lambda v: type(v).__name__)
+def test_empaquetar_bytes_esperados(valor, esperado):
+    assert codificacion_compacta.empaquetar(valor).hex() == esperado
+
+VALORES_LIMITE = [
+    None, True, False,
+    0, 1, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 64 - 1,
+    -1, -32, -33, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1, -2 ** 63,
+    0.0, 1.5, -2.25, 1e300,
+    '', 'a', 'x' * 31, 'x' * 32, 'x' * 255, 'x' * 256, 'x' * 65536, 'ñandú ✅',
+    b'', b'\x00\xff', b'b' * 256, b'b' * 65536,
+    [], list(range(15)), list(range(16)), list(range(65536)),
+    {}, {str(n): n for n in range(15)}, {str(n): n for n in range(16)},
+    {'anidado': [1, {'a': [None, True]}, 'fin']},
+]
+
+
+@pytest.mark.parametrize('valor', VALORES_LIMITE, ids=lambda v: type(v).__name__)
+def test_empaquetar_ida_y_vuelta(msgpack, valor):
+    empaquetado = codificacion_compacta.empaquetar(valor)
+    assert msgpack.unpackb(empaquetado, raw=False, strict_map_key=False) == valor
+    # Misma forma mínima que la implementación de referencia
+    assert empaquetado == msgpack.packb(valor, use_bin_type=True)
+
+def test_tuplas_se_empaquetan_como_arrays():
+    assert codificacion_compacta.empaquetar((1, 'a')) == codificacion_compacta.empaquetar([1, 'a'])
+
+def test_fechas_se_empaquetan_en_milisegundos():
+    fecha = datetime(2026, 1, 1, 20, 0, 0, 123000, tzinfo=timezone.utc)
+    assert codificacion_compacta.empaquetar(fecha) == codificacion_compacta.empaquetar(int(fecha.timestamp() * 1000))
+
+def test_tipos_no_soportados_y_fuera_de_rango():
+    with pytest.raises(TypeError):
+        codificacion_compacta.empaquetar({1, 2})
+    with pytest.raises(OverflowError):
+        codificacion_compacta.empaquetar(2 ** 64)
+    with pytest.raises(OverflowError):
+        codificacion_compacta.empaquetar(-2 ** 63 - 1)
+
+def test_codificar_evento_periodico(msgpack):
+    sorteo_id = '6f1c2b1e-3d4f-4a5b-8c9d-0e1f2a3b4c5d'
+    timestamp = '2026-01-01T20:02:00.001500+00:00'
+    blob = codificacion_compacta.codificar('live_time_update', sorteo_id, {
+        'premio_index': 1,
+        'premio_nombre': 'no viaja',
+        'tiempo_restante': 87,
+        'total_premios': 3,
+        'timestamp': timestamp
+    })
+
+    codigo, _ = codificacion_compacta.EVENTOS_COMPACTOS['live_time_update']
+    assert msgpack.unpackb(blob) == [
+        codigo,
+        codificacion_compacta.codigo_sorteo(sorteo_id),
+        1, 87, 3,
+        int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+    ]
+
+def test_participantes_en_columnas(msgpack):
+    blob = codificacion_compacta.codificar('live_animation_start', 's', {
+        'num_premios': 2,
+        'timestamp': '2026-01-01T20:00:00+00:00',
+        'participantes': [
+            {'nombre': 'Ana', 'email': 'ana@correo.test', 'numero_boleto': 7},
+            {'nombre': 'Luis', 'email': 'luis@correo.test', 'numero_boleto': 12}
+        ]
+    })
+    assert msgpack.unpackb(blob)[-1] == [['Ana', 'Luis'], ['ana@correo.test', 'luis@correo.test'], [7, 12]]
@@ -0,0 +1,64 @@
+"""Admisión de compras: un número en proceso hace esperar a la compra siguiente, no la rechaza"""
+import asyncio
+
+import pytest
+
+import cola_compras
+
+
+@pytest.fixture(autouse=True)
+def cola(monkeypatch):
+    monkeypatch.setattr(cola_compras, 'COLA_COMPRAS_HABILITADA', True)
+    monkeypatch.setattr(cola_compras, 'COLA_COMPRAS_CONCURRENCIA', 2)
+    monkeypatch.setattr(cola_compras, '_colas', {})
+
+async def _comprar(numeros, resultado, falla=False, duracion=0.01):
+    try:
+        async with cola_compras.admitir_compra('s1', numeros) as conflictos:
+            resultado.append(conflictos)
+            if not conflictos:
+                await asyncio.sleep(duracion)
+                if falla:
+                    raise ValueError('pago rechazado')
+    except ValueError:
+        pass
+
+def test_compra_que_falla_suelta_los_numeros_a_la_que_espera():
+    primera, segunda = [], []
+
+    async def correr():
+        await asyncio.gather(
+            _comprar([1, 2], primera, falla=True),
+            _comprar([2, 3], segunda)
+        )
+
+    asyncio.run(correr())
+
+    assert primera == [[]]
+    assert segunda == [[]]
+    assert cola_compras._colas == {}
+
+def test_sin_numeros_en_comun_no_hay_espera():
+    resultados = []
+
+    async def correr():
+        await asyncio.gather(_comprar([1], resultados, duracion=0.05), _comprar([2], resultados))
+
+    asyncio.run(correr())
+    assert resultados == [[], []]
+
+def test_conflicto_si_la_espera_se_agota(monkeypatch):
+    monkeypatch.setattr(cola_compras, 'COLA_COMPRAS_ESPERA_CONFLICTO_SEGUNDOS', 0.01)
+    primera, segunda = [], []
+
+    async def correr():
+        await asyncio.gather(
+            _comprar([4, 5], primera, duracion=0.2),
+            _comprar([5, 6], segunda)
+        )
+
+    asyncio.run(correr())
+
+    assert primera == [[]]
+    assert segunda == [[5]]
+    assert cola_compras._colas == {}
@@ -0,0 +1,148 @@
+"""Bitmap de inventario: selección aleatoria por rango, ventanas run-length y reconstrucción"""
+import asyncio
+import random
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+import inventario_boletos
+from inventario_boletos import InventarioSorteo, LIBRE, RESERVADO, VENDIDO
+
+
+def _inventario(total: int, vendidos=(), reservados=()) -> InventarioSorteo:
+    inventario = InventarioSorteo('sorteo-prueba', total)
+    for numero in vendidos:
+        inventario.marcar_vendido(numero)
+    for numero in reservados:
+        inventario.marcar_reservado(numero)
+    return inventario
+
+def _ocupado_esperado(inventario: InventarioSorteo, numero: int) -> int:
+    return 0 if inventario.estado(numero) == LIBRE else 1
+
+def test_estados_y_contadores():
+    inventario = _inventario(20, vendidos=[1, 9], reservados=[2, 9, 20])
+
+    assert inventario.estado(1) == VENDIDO
+    assert inventario.estado(2) == RESERVADO
+    # Un número vendido no vuelve a reservado
+    assert inventario.estado(9) == VENDIDO
+    assert inventario.estado(20) == RESERVADO
+    assert inventario.estado(21) == LIBRE
+    assert inventario.cantidad_vendidos == 2
+    assert inventario.cantidad_reservados == 2
+    assert inventario.cantidad_libres == 16
+
+    inventario.liberar(9)
+    assert inventario.estado(9) == LIBRE
+    assert inventario.cantidad_libres == 17
+
+@pytest.mark.parametrize('total', [1, 7, 8, 13, 64, 1001])
+def test_seleccion_aleatoria_solo_libres_y_sin_repetir(total):
+    rng = random.Random(total)
+    ocupados = rng.sample(range(1, total + 1), total // 2)
+    inventario = _inventario(total, vendidos=ocupados[::2], reservados=ocupados[1::2])
+    libres = set(inventario.numeros_disponibles())
+    assert len(libres) == inventario.cantidad_libres
+
+    random.seed(total)
+    elegidos = inventario.seleccionar_aleatorios(len(libres))
+
+    # Pidiendo todos los libres se obtienen exactamente esos (nunca fuera de 1..total)
+    assert len(elegidos) == len(set(elegidos))
+    assert set(elegidos) == libres
+
+def test_seleccion_aleatoria_limita_a_los_libres():
+    inventario = _inventario(10, vendidos=range(1, 9))
+    assert sorted(inventario.seleccionar_aleatorios(5)) == [9, 10]
+
+    inventario.marcar_reservado(9)
+    inventario.marcar_reservado(10)
+    assert inventario.seleccionar_aleatorios(1) == []
+
+def test_seleccion_aleatoria_es_uniforme_entre_libres():
+    # Libres dispersos en varios bytes, incluido el último byte incompleto
+    total = 45
+    libres = [3, 8, 9, 17, 24, 31, 40, 45]
+    inventario = _inventario(total, vendidos=[n for n in range(1, total + 1) if n not in libres])
+
+    random.seed(1)
+    muestras = 8000
+    conteo = Counter(inventario.seleccionar_aleatorios(1)[0] for _ in range(muestras))
+
+    assert set(conteo) == set(libres)
+    esperado = muestras / len(libres)
+    for numero in libres:
+        assert abs(conteo[numero] - esperado) < esperado * 0.15
+
+@pytest.mark.parametrize('desde,hasta', [(1, 45), (5, 5), (7, 33), (40, 100), (-3, 2)])
+def test_rangos_y_conteos_coinciden_con_el_recorrido_numero_a_numero(desde, hasta):
+    total = 45
+    inventario = _inventario(total, vendidos=[1, 2, 3, 10, 16, 17, 44], reservados=[4, 18, 19, 45])
+
+    rangos = inventario.rangos(desde, hasta)
+    inicio, fin = max(1, desde), min(total, hasta)
+
+    # Los rangos cubren la ventana sin huecos y alternan libre/ocupado
+    assert rangos[0][0] == inicio and rangos[-1][1] == fin
+    for anterior, siguiente in zip(rangos, rangos[1:]):
+        assert siguiente[0] == anterior[1] + 1
+        assert siguiente[2] != anterior[2]
+    for rango_inicio, rango_fin, ocupado in rangos:
+        for numero in range(rango_inicio, rango_fin + 1):
+            assert _ocupado_esperado(inventario, numero) == ocupado
+
+    conteo = inventario.contar(desde, hasta)
+    estados = Counter(inventario.estado(n) for n in range(inicio, fin + 1))
+    assert conteo == {'libres': estados[LIBRE], 'reservados': estados[RESERVADO], 'vendidos': estados[VENDIDO]}
+
+def test_conteos_por_bloques_suman_el_total():
+    inventario = _inventario(50, vendidos=range(1, 11), reservados=range(45, 51))
+    bloques = inventario.conteos_bloques(16)
+
+    assert [(b['inicio'], b['fin']) for b in bloques] == [(1, 16), (17, 32), (33, 48), (49, 50)]
+    assert sum(b['ocupados'] for b in bloques) == 16
+    assert sum(b['libres'] for b in bloques) == inventario.cantidad_libres
+
+class _BoletosLentos:
+    """Colección boletos cuyo cursor cede el control entre documentos, como un cursor de Motor"""
+
+    def __init__(self, boletos, durante_recorrido):
+        self.boletos = boletos
+        self.durante_recorrido = durante_recorrido
+
+    def find(self, filtro, proyeccion):
+        async def cursor():
+            for i, boleto in enumerate(self.boletos):
+                await asyncio.sleep(0)
+                if i == len(self.boletos) - 1:
+                    self.durante_recorrido()
+                yield boleto
+        return cursor()
+
+def test_cambios_durante_la_reconstruccion_no_se_pierden(monkeypatch):
+    sorteo_id = 'sorteo-reconstruccion'
+    boletos = [
+        {'numero_boleto': 1, 'pago_confirmado': False},
+        {'numero_boleto': 2, 'pago_confirmado': True},
+        {'numero_boleto': 3, 'pago_confirmado': False},
+    ]
+
+    def durante_recorrido():
+        # El cursor ya pasó por 1 y 2: se aprueba el 1, se libera el 2 y se reserva el 5
+        inventario_boletos.registrar_venta(sorteo_id, [1])
+        inventario_boletos.registrar_liberacion(sorteo_id, [2])
+        inventario_boletos.registrar_reserva(sorteo_id, [5])
+
+    monkeypatch.setattr(inventario_boletos, 'db', SimpleNamespace(boletos=_BoletosLentos(boletos, durante_recorrido)))
+    monkeypatch.setattr(inventario_boletos, '_inventarios', {})
+    monkeypatch.setattr(inventario_boletos, '_locks', {})
+
+    inventario = asyncio.run(inventario_boletos.obtener_inventario(sorteo_id, 10))
+
+    assert inventario.estado(1) == VENDIDO
+    assert inventario.estado(2) == LIBRE
+    assert inventario.estado(3) == RESERVADO
+    assert inventario.estado(5) == RESERVADO
+    assert sorteo_id not in inventario_boletos._cambios_en_reconstruccion
@@ -0,0 +1,61 @@
+"""Heartbeat del lease: los servicios singleton nunca quedan corriendo dos veces"""
+import asyncio
+
+import pytest
+
+import liderazgo
+
+
+@pytest.fixture
+def servicios(monkeypatch):
+    iniciados = []
+    detenidos = []
+
+    def iniciar():
+        tarea = asyncio.get_running_loop().create_task(asyncio.Event().wait())
+        iniciados.append(tarea)
+        return tarea
+
+    monkeypatch.setattr(liderazgo, '_servicios', [])
+    monkeypatch.setattr(liderazgo, '_token', None)
+    monkeypatch.setattr(liderazgo, 'LIDERAZGO_HABILITADO', True)
+    monkeypatch.setattr(liderazgo, 'LEASE_HEARTBEAT_SEGUNDOS', 0)
+    liderazgo.registrar_servicio('prueba', iniciar, lambda: detenidos.append(True))
+    return iniciados, detenidos
+
+def _latidos(monkeypatch, tokens):
+    """Ejecutar el heartbeat con la secuencia de tokens dada y devolver las tareas vivas"""
+    pendientes = list(tokens)
+
+    async def intentar_adquirir():
+        if not pendientes:
+            raise asyncio.CancelledError()
+        return pendientes.pop(0)
+
+    monkeypatch.setattr(liderazgo, 'intentar_adquirir', intentar_adquirir)
+
+    async def correr():
+        with pytest.raises(asyncio.CancelledError):
+            await liderazgo._heartbeat()
+        await asyncio.sleep(0)
+        return [t for t in liderazgo._servicios[0].tareas if not t.done()]
+
+    return asyncio.run(correr())
+
+def test_renovar_con_el_mismo_token_no_reinicia(servicios, monkeypatch):
+    iniciados, detenidos = servicios
+    vivas = _latidos(monkeypatch, [4, 4, 4])
+
+    assert len(iniciados) == 1
+    assert detenidos == []
+    assert vivas == iniciados
+
+def test_token_nuevo_siendo_lider_detiene_las_tareas_anteriores(servicios, monkeypatch):
+    iniciados, detenidos = servicios
+    vivas = _latidos(monkeypatch, [4, 6])
+
+    assert len(iniciados) == 2
+    assert detenidos == [True]
+    assert iniciados[0].cancelled()
+    assert vivas == [iniciados[1]]
+    assert liderazgo._token == 6
@@ -0,0 +1,50 @@
+"""Reparto de sorteos por rendezvous hashing: solo se mueven los sorteos del worker que entra o sale"""
+import uuid
+
+import pytest
+
+import particion_sorteos
+
+SORTEOS = [str(uuid.UUID(int=n)) for n in range(2000)]
+
+
+@pytest.fixture
+def miembros(monkeypatch):
+    def usar(workers):
+        monkeypatch.setattr(particion_sorteos, '_miembros', sorted(workers))
+        return {sorteo_id: particion_sorteos.propietario(sorteo_id) for sorteo_id in SORTEOS}
+    return usar
+
+def test_sin_miembros_no_hay_propietario(miembros):
+    assert set(miembros([]).values()) == {None}
+
+def test_reparto_es_determinista_y_balanceado(miembros):
+    workers = ['host-a:1:aa', 'host-b:2:bb', 'host-c:3:cc', 'host-d:4:dd']
+    reparto = miembros(workers)
+
+    # El orden en que se conocen los workers no cambia el dueño
+    assert miembros(list(reversed(workers))) == reparto
+    por_worker = {w: sum(1 for dueno in reparto.values() if dueno == w) for w in workers}
+    for cantidad in por_worker.values():
+        assert abs(cantidad - len(SORTEOS) / len(workers)) < len(SORTEOS) * 0.05
+
+def test_al_entrar_un_worker_solo_se_mueven_sorteos_hacia_el(miembros):
+    workers = ['host-a:1:aa', 'host-b:2:bb', 'host-c:3:cc']
+    antes = miembros(workers)
+    despues = miembros(workers + ['host-nuevo:9:ff'])
+
+    movidos = [s for s in SORTEOS if antes[s] != despues[s]]
+    assert movidos
+    assert all(despues[s] == 'host-nuevo:9:ff' for s in movidos)
+    assert abs(len(movidos) - len(SORTEOS) / 4) < len(SORTEOS) * 0.05
+
+def test_al_salir_un_worker_solo_se_mueven_sus_sorteos(miembros):
+    workers = ['host-a:1:aa', 'host-b:2:bb', 'host-c:3:cc', 'host-d:4:dd']
+    antes = miembros(workers)
+    despues = miembros([w for w in workers if w != 'host-c:3:cc'])
+
+    for sorteo_id in SORTEOS:
+        if antes[sorteo_id] == 'host-c:3:cc':
+            assert despues[sorteo_id] != 'host-c:3:cc'
+        else:
+            assert despues[sorteo_id] == antes[sorteo_id]
@@ -0,0 +1,114 @@
+"""Reserva todo o nada y liberación de reservas vencidas"""
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import reservas_boletos
+from simulacion_sorteos import BaseSimulada
+
+SORTEO_ID = 'sorteo-reservas'
+
+
+class BaseConFallos(BaseSimulada):
+    """insert_many inserta los documentos sanos y falla en los índices indicados, como Mongo con ordered=False"""
+
+    def __init__(self, fallos: dict):
+        super().__init__()
+        self.fallos = fallos
+        boletos = self.boletos
+        insertar = boletos.insertar
+
+        async def insert_many(documentos, ordered=True):
+            insertar([d for i, d in enumerate(documentos) if i not in self.fallos])
+            if self.fallos:
+                raise BulkWriteError({'writeErrors': [
+                    {'index': i, 'code': codigo, 'errmsg': 'simulado'} for i, codigo in self.fallos.items()
+                ]})
+
+        boletos.insert_many = insert_many
+
+
+def _boletos(numeros):
+    return [
+        {'id': str(uuid.uuid4()), 'sorteo_id': SORTEO_ID, 'numero_boleto': n, 'pago_confirmado': False}
+        for n in numeros
+    ]
+
+@pytest.fixture
+def base(monkeypatch):
+    def usar(fallos):
+        base = BaseConFallos(fallos)
+        monkeypatch.setattr(reservas_boletos, 'db', base)
+        return base
+    return usar
+
+def test_reserva_completa(base):
+    db = base({})
+    docs = _boletos([1, 2, 3])
+
+    assert asyncio.run(reservas_boletos.reservar_boletos(docs)) == []
+    assert sorted(b['numero_boleto'] for b in db.boletos.todos()) == [1, 2, 3]
+
+def test_choque_deshace_los_insertados_y_devuelve_los_perdidos(base):
+    db = base({3: reservas_boletos.CODIGO_CLAVE_DUPLICADA, 1: reservas_boletos.CODIGO_CLAVE_DUPLICADA})
+    docs = _boletos([10, 4, 7, 2])
+
+    perdidos = asyncio.run(reservas_boletos.reservar_boletos(docs))
+
+    assert perdidos == [2, 4]
+    assert db.boletos.todos() == []
+
+def test_error_distinto_de_duplicado_lanza_excepcion_de_dominio(base):
+    db = base({0: reservas_boletos.CODIGO_CLAVE_DUPLICADA, 2: 121})
+    docs = _boletos([5, 6, 8])
+
+    with pytest.raises(reservas_boletos.BoletosNoDisponibles) as error:
+        asyncio.run(reservas_boletos.reservar_boletos(docs))
+
+    assert error.value.numeros == [8]
+    assert db.boletos.todos() == []
+
+
+def _vencidos(numeros):
+    vencio = datetime.now(timezone.utc) - timedelta(minutes=1)
+    return [{**b, 'expira_en': vencio} for b in _boletos(numeros)]
+
+@pytest.fixture
+def liberados(monkeypatch):
+    llamadas = []
+
+    async def hook(sorteo_id, numeros):
+        llamadas.append((sorteo_id, sorted(numeros)))
+
+    monkeypatch.setattr(reservas_boletos, '_hooks_expiracion', [hook])
+    return llamadas
+
+def test_expiracion_en_lotes(base, liberados, monkeypatch):
+    monkeypatch.setattr(reservas_boletos, 'LOTE_EXPIRACION', 2)
+    db = base({})
+    db.boletos.insertar(_vencidos([1, 2, 3, 4, 5]))
+
+    assert asyncio.run(reservas_boletos.liberar_reservas_expiradas()) == 5
+    assert db.boletos.todos() == []
+    assert sorted(n for _, numeros in liberados for n in numeros) == [1, 2, 3, 4, 5]
+    assert len(liberados) == 3
+
+def test_boleto_aprobado_antes_del_borrado_no_se_libera(base, liberados):
+    db = base({})
+    docs = _vencidos([7, 8, 9])
+    db.boletos.insertar(docs)
+    borrar = db.boletos.delete_many
+
+    async def aprobar_y_borrar(filtro):
+        # El admin aprueba el 8 entre la lectura de vencidos y el borrado
+        docs[1]['pago_confirmado'] = True
+        return await borrar(filtro)
+
+    db.boletos.delete_many = aprobar_y_borrar
+
+    assert asyncio.run(reservas_boletos.liberar_reservas_expiradas()) == 2
+    assert [b['numero_boleto'] for b in db.boletos.todos()] == [8]
+    assert liberados == [(SORTEO_ID, [7, 9])]
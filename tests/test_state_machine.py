@@ -0,0 +1,55 @@
+"""Reclamo de transición: CAS sobre la versión con un reclamo que vence solo"""
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import state_machine
+from simulacion_sorteos import BaseSimulada
+
+AHORA = datetime(2026, 1, 1, 20, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    base = BaseSimulada()
+    base.sorteos.insertar([{'id': 's1', 'estado': 'activo'}])
+    monkeypatch.setattr(state_machine, 'db', base)
+    return base
+
+def _reclamar(sorteo, ahora=AHORA):
+    filtro = {'id': 's1', **state_machine.filtro_version(sorteo)}
+    return asyncio.run(state_machine.reclamar_transicion(filtro, ahora))
+
+def _sorteo(db):
+    return asyncio.run(db.sorteos.find_one({'id': 's1'}, {'_id': 0}))
+
+def test_primer_reclamo_aumenta_la_version(db):
+    assert _reclamar({}) == 1
+
+    sorteo = _sorteo(db)
+    assert sorteo['version'] == 1
+    assert sorteo['transicion_reclamada_hasta'] == AHORA + state_machine.RECLAMO_TRANSICION
+
+def test_reclamo_vigente_bloquea_a_otro_proceso(db):
+    assert _reclamar({}) == 1
+    sorteo = _sorteo(db)
+
+    # Aun con la versión correcta, nadie más reclama mientras el reclamo esté vigente
+    assert _reclamar(sorteo, AHORA + state_machine.RECLAMO_TRANSICION / 2) is None
+    assert _sorteo(db)['version'] == 1
+
+def test_reclamo_abandonado_vence(db):
+    assert _reclamar({}) == 1
+    vencido = AHORA + state_machine.RECLAMO_TRANSICION
+
+    assert _reclamar(_sorteo(db), vencido) == 2
+    assert _sorteo(db)['transicion_reclamada_hasta'] == vencido + state_machine.RECLAMO_TRANSICION
+
+def test_version_leida_desactualizada_pierde(db):
+    leido = _sorteo(db)
+    assert _reclamar(leido) == 1
+
+    # Otro proceso que leyó antes del primer reclamo no puede reclamar aunque el reclamo haya vencido
+    assert _reclamar(leido, AHORA + state_machine.RECLAMO_TRANSICION * 2) is None
+    assert _sorteo(db)['version'] == 1